@@ -97,6 +97,13 @@ def run_migrations_online():
     connectable = get_engine()
 
     with connectable.connect() as connection:
+        if connection.dialect.name == "sqlite":
+            # Batch operations rebuild the tables, the DROP TABLE of the old one must
+            # neither fail on nor cascade to the rows pointing to it
+            connection.exec_driver_sql("PRAGMA foreign_keys=OFF")
+            # Ends the transaction begun by the PRAGMA, the migrations run in their own
+            connection.commit()
+
         context.configure(
             connection=connection,
             target_metadata=get_metadata(),
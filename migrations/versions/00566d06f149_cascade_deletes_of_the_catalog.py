@@ -0,0 +1,55 @@
+"""Cascade deletes of the catalog
+
+The foreign keys get ON DELETE CASCADE (favorites, weights) and SET NULL (home
+world), so deleting a user, character or planet is a single DELETE.
+
+Revision ID: 00566d06f149
+Revises: 6df9938cd86a
+Create Date: 2026-10-19 02:18:28.606205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '00566d06f149'
+down_revision = '6df9938cd86a'
+branch_labels = None
+depends_on = None
+
+
+# Unnamed foreign keys (SQLite) are found by this convention in batch mode
+NAMING_CONVENTION = {"fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s"}
+
+FOREIGN_KEYS = (
+    ('Characters', 'HomeWorldId', 'Planets', 'SET NULL'),
+    ('Characters_Favorites', 'UserId', 'Users', 'CASCADE'),
+    ('Characters_Favorites', 'CharacterId', 'Characters', 'CASCADE'),
+    ('Planets_Favorites', 'UserId', 'Users', 'CASCADE'),
+    ('Planets_Favorites', 'PlanetId', 'Planets', 'CASCADE'),
+    ('Weights', 'CharacterId', 'Characters', 'CASCADE'),
+)
+
+
+def replace_foreign_key(table, column, referred_table, ondelete):
+    """
+    Drop the foreign key of a column and create it again with another ondelete,
+    keeping its name
+    """
+    foreign_keys = sa.inspect(op.get_bind()).get_foreign_keys(table)
+    name = next(fk["name"] for fk in foreign_keys if fk["constrained_columns"] == [column])
+    name = name or f"fk_{table}_{column}_{referred_table}"
+    with op.batch_alter_table(table, naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint(name, type_='foreignkey')
+        batch_op.create_foreign_key(name, referred_table, [column], ['Id'], ondelete=ondelete)
+
+
+def upgrade():
+    for table, column, referred_table, ondelete in FOREIGN_KEYS:
+        replace_foreign_key(table, column, referred_table, ondelete)
+
+
+def downgrade():
+    for table, column, referred_table, ondelete in FOREIGN_KEYS:
+        replace_foreign_key(table, column, referred_table, None)
@@ -0,0 +1,90 @@
+"""Catalog tables
+
+The tables of the models as they were before the favorites, stats, changes and jobs
+revisions that follow. Until now they were only created by a local `flask db migrate`,
+so a database may already have them: only the missing ones are created.
+
+Revision ID: 02ee58ce4af6
+Revises: a5cffa318ac2
+Create Date: 2026-10-19 02:18:05.204610
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '02ee58ce4af6'
+down_revision = 'a5cffa318ac2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = set(sa.inspect(op.get_bind()).get_table_names())
+    if 'Planets' not in existing:
+        op.create_table('Planets',
+            sa.Column('Id', sa.Integer(), nullable=False),
+            sa.Column('Name', sa.String(length=50), nullable=False),
+            sa.Column('Climate', sa.Enum('TROPICAL', 'TEMPERATE', 'ARID', 'POLAR', 'UNKNOWN', name='climateenum'), nullable=False),
+            sa.Column('Terrain', sa.Enum('DESERT', 'GRASSLAND', 'MOUNTAIN', 'FOREST', 'SWAMP', 'OCEAN', 'UNKNOWN', name='terrainenum'), nullable=False),
+            sa.PrimaryKeyConstraint('Id'),
+            sa.UniqueConstraint('Name')
+            )
+    if 'Users' not in existing:
+        op.create_table('Users',
+            sa.Column('Id', sa.Integer(), nullable=False),
+            sa.Column('Email', sa.String(length=50), nullable=False),
+            sa.Column('Username', sa.String(length=30), nullable=False),
+            sa.Column('Password', sa.String(length=300), nullable=False),
+            sa.Column('IsActive', sa.Boolean(), nullable=False),
+            sa.Column('CreatedAt', sa.DateTime(timezone=True), nullable=False),
+            sa.PrimaryKeyConstraint('Id'),
+            sa.UniqueConstraint('Email'),
+            sa.UniqueConstraint('Username')
+            )
+    if 'Characters' not in existing:
+        op.create_table('Characters',
+            sa.Column('Id', sa.Integer(), nullable=False),
+            sa.Column('Name', sa.String(length=50), nullable=False),
+            sa.Column('Height', sa.Integer(), nullable=True),
+            sa.Column('HairColor', sa.Enum('BLACK', 'BROWN', 'BLONDE', 'RED', 'GREY', 'WHITE', 'UNKNOWN', name='haircolorenum'), nullable=False),
+            sa.Column('BirthDay', sa.Date(), nullable=True),
+            sa.Column('HomeWorldId', sa.Integer(), nullable=True),
+            sa.ForeignKeyConstraint(['HomeWorldId'], ['Planets.Id'], ),
+            sa.PrimaryKeyConstraint('Id'),
+            sa.UniqueConstraint('Name')
+            )
+    if 'Planets_Favorites' not in existing:
+        op.create_table('Planets_Favorites',
+            sa.Column('UserId', sa.Integer(), nullable=False),
+            sa.Column('PlanetId', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['PlanetId'], ['Planets.Id'], ),
+            sa.ForeignKeyConstraint(['UserId'], ['Users.Id'], ),
+            sa.PrimaryKeyConstraint('UserId', 'PlanetId')
+            )
+    if 'Characters_Favorites' not in existing:
+        op.create_table('Characters_Favorites',
+            sa.Column('UserId', sa.Integer(), nullable=False),
+            sa.Column('CharacterId', sa.Integer(), nullable=False),
+            sa.ForeignKeyConstraint(['CharacterId'], ['Characters.Id'], ),
+            sa.ForeignKeyConstraint(['UserId'], ['Users.Id'], ),
+            sa.PrimaryKeyConstraint('UserId', 'CharacterId')
+            )
+    if 'Weights' not in existing:
+        op.create_table('Weights',
+            sa.Column('CharacterId', sa.Integer(), nullable=False),
+            sa.Column('Weight', sa.Double(), nullable=False),
+            sa.Column('WeightUnit', sa.Enum('KG', 'LB', 'OZ', name='weightunitenum'), nullable=False),
+            sa.ForeignKeyConstraint(['CharacterId'], ['Characters.Id'], ),
+            sa.PrimaryKeyConstraint('CharacterId')
+            )
+
+
+def downgrade():
+    op.drop_table('Weights')
+    op.drop_table('Characters_Favorites')
+    op.drop_table('Planets_Favorites')
+    op.drop_table('Characters')
+    op.drop_table('Users')
+    op.drop_table('Planets')
@@ -1,33 +1,128 @@
 import os
+from flask import g
 from flask_admin import Admin
+from sqlalchemy import select, func, text
 from models import db, User, Planet, Character, Weight, Character_Favorite, Planet_Favorite
 from flask_admin.contrib.sqla import ModelView
 
+# Tables bigger than this (by the planner estimate) get an estimated row count instead of COUNT(*)
+ESTIMATED_COUNT_THRESHOLD = 100000
+
+
+class ScalableModelView(ModelView):
+    """
+    List pages with a bounded number of queries: the many-to-one columns are eager
+    loaded, collection columns show a count fetched with one GROUP BY for the whole page,
+    and big tables use the planner row estimate instead of a full COUNT(*).
+
+    Read-only: the writes go through the API, which keeps the change log, the stats,
+    the favorites counters and versions and the cached responses in sync with them
+    """
+    can_create = False
+    can_edit = False
+    can_delete = False
+    can_view_details = True
+    page_size = 50
+    can_set_page_size = True
+    # The exact COUNT(*) is replaced by get_row_count() in get_list
+    simple_list_pager = True
+
+    # Collection columns rendered as counts: column name -> (favorite/child model, foreign key column)
+    column_relationship_counts = {}
+
+    def __init__(self, *args, **kwargs):
+        self.column_formatters = dict(self.column_formatters)
+        for name in self.column_relationship_counts:
+            self.column_formatters[name] = self._format_relationship_count
+        super().__init__(*args, **kwargs)
+
+    def _format_relationship_count(self, view, context, model, name):
+        counts = g.get("admin_relationship_counts")
+        if counts is None:
+            # Details and exports of a single row, counting the loaded collection is fine
+            return len(getattr(model, name))
+        return counts[name].get(self.get_pk_value(model), 0)
+
+    def get_row_count(self):
+        """
+        Rows of the table, estimated from pg_class on big Postgres tables
+        """
+        table = self.model.__table__
+        if self.session.get_bind().dialect.name == "postgresql":
+            estimate = self.session.execute(
+                text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)"),
+                {"table": f'"{table.name}"'}).scalar()
+            if estimate is not None and estimate > ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return self.session.execute(select(func.count()).select_from(table)).scalar()
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        count, query = super().get_list(page, sort_column, sort_desc, search, filters,
+                                        execute, page_size)
+
+        # Searches and filters keep the simple pager, the whole table is counted otherwise
+        if not search and not filters:
+            count = self.get_row_count()
+
+        if execute and self.column_relationship_counts:
+            ids = [self.get_pk_value(model) for model in query]
+            g.admin_relationship_counts = {
+                name: self._count_related(child_model, fk_column, ids)
+                for name, (child_model, fk_column) in self.column_relationship_counts.items()
+            }
+        return count, query
+
+    def _count_related(self, child_model, fk_column, ids):
+        if not ids:
+            return {}
+        column = getattr(child_model, fk_column)
+        rows = self.session.execute(
+            select(column, func.count()).where(column.in_(ids)).group_by(column))
+        # get_pk_value() gives the keys as strings
+        return {str(key): count for key, count in rows}
+
+
 # Crear vistas personalizadas para cada modelo
-class UserView(ModelView):
+class UserView(ScalableModelView):
     column_list=('Id', 'Email', 'Username', 'Password', 'IsActive', 'CreatedAt', 'Characters_Favorites_Association', 'Planets_Favorites_Association')
+    column_relationship_counts = {
+        'Characters_Favorites_Association': (Character_Favorite, 'UserId'),
+        'Planets_Favorites_Association': (Planet_Favorite, 'UserId'),
+    }
 
-class CharacterView(ModelView):
+class CharacterView(ScalableModelView):
     column_list=('Id', 'Name', 'Height', 'HairColor', 'BirthDay', 'HomeWorldId', 'Weight', 'HomeWorld', 'Users_Favorites_Association')
+    column_select_related_list = (Character.Weight, Character.HomeWorld)
+    column_relationship_counts = {
+        'Users_Favorites_Association': (Character_Favorite, 'CharacterId'),
+    }
 
-class PlanetView(ModelView):
+class PlanetView(ScalableModelView):
     column_list=('Id', 'Name', 'Climate', 'Terrain', 'Characters', 'Users_Favorites_Association')
+    column_relationship_counts = {
+        'Characters': (Character, 'HomeWorldId'),
+        'Users_Favorites_Association': (Planet_Favorite, 'PlanetId'),
+    }
 
-class WeightView(ModelView):
+class WeightView(ScalableModelView):
     column_list=('CharacterId', 'Weight', 'WeightUnit', 'Character')
+    column_select_related_list = (Weight.Character,)
 
-class Character_FavoriteView(ModelView):
+class Character_FavoriteView(ScalableModelView):
     column_list=('UserId', 'CharacterId', 'User', 'Character')
+    column_select_related_list = (Character_Favorite.User, Character_Favorite.Character)
 
-class Planet_FavoriteView(ModelView):
+class Planet_FavoriteView(ScalableModelView):
     column_list=('UserId', 'PlanetId', 'User', 'Planet')
+    column_select_related_list = (Planet_Favorite.User, Planet_Favorite.Planet)
 
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
     app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
     admin = Admin(app, name='4Geeks Admin', template_mode='bootstrap3')
 
-    
+
     # Add your models here, for example this is how we add a the User model to the admin
     admin.add_view(UserView(User, db.session))
     admin.add_view(CharacterView(Character, db.session))
@@ -37,4 +132,4 @@ def setup_admin(app):
     admin.add_view(Planet_FavoriteView(Planet_Favorite, db.session))
 
     # You can duplicate that line to add mew models
-    # admin.add_view(ModelView(YourModelName, db.session))
\ No newline at end of file
+    # admin.add_view(ModelView(YourModelName, db.session))
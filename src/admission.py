@@ -0,0 +1,216 @@
+"""
+Admission control: per-route concurrency limits with load shedding.
+
+Every request is assigned to a pool by its endpoint. A pool runs at most max_active
+requests at a time; the next max_waiting requests wait up to max_wait seconds for a
+slot, and anything beyond that is rejected right away with a 503 and a Retry-After
+header. A slow list endpoint can then only use its own slots, and logins and cheap
+reads keep answering on their separate, reserved pool instead of timing out behind it.
+
+The limits are per worker process and only matter with threaded workers
+(e.g. gunicorn --worker-class gthread --threads 32), a sync worker runs one request
+at a time anyway.
+
+The limits of the pools and the endpoints they serve can be tuned from the config or
+the environment, both JSON (app.config takes a dict directly):
+
+- ADMISSION_POOLS: limits by pool, merged over DEFAULT_POOLS. A new name creates a
+  pool, with the limits of the default pool for the fields it leaves out, e.g.
+  {"heavy": {"max_active": 8}, "changes": {"max_active": 2, "max_waiting": 4}}
+- ADMISSION_ENDPOINTS: pool of an endpoint, over the lists below, e.g.
+  {"get_changes_since": "changes", "batch": "default"}. "exempt" exempts it.
+
+The GET handlers coalesced by singleflight.py take their slot once they know they run
+the handler: the request leading a flight does, the ones joining it only wait for its
+response and take none. A request finding the handler answered from the cache or the
+snapshot takes none either.
+
+The counters of each pool (admitted, shed, active, waiting) are served to admins by
+GET /admission.
+"""
+import json
+import os
+import threading
+import time
+from flask import current_app, g, request, jsonify
+
+# Logins, the sitemap, single reads by id and bounded pages: cheap and latency sensitive
+PRIORITY_ENDPOINTS = {
+    'sitemap', 'login_user', 'get_admission', 'get_single_flight', 'get_slow_queries',
+    'get_character', 'get_planet', 'get_all_stats', 'get_stat', 'get_job',
+    'get_favorite_characters', 'get_favorite_planets',
+}
+# Full lists, bulk deletes and scans that can hold a worker for long
+HEAVY_ENDPOINTS = {
+    'get_users', 'get_characters', 'get_planets',
+    'get_top_characters', 'get_top_planets', 'get_changes_since',
+    'delete_users', 'delete_characters', 'delete_planets', 'batch',
+}
+# Not limited here: the event streams have their own subscriber limit (see events.py)
+EXEMPT_ENDPOINTS = {'static', 'get_events'}
+
+
+class Pool:
+    """
+    Counting semaphore with a bounded wait queue and admission counters
+    """
+
+    def __init__(self, name, max_active, max_waiting, max_wait, retry_after):
+        self.name = name
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Take a slot, waiting for one if the queue has room. False when the request is shed
+        """
+        with self._condition:
+            if self.active >= self.max_active:
+                if self.waiting >= self.max_waiting:
+                    self.shed += 1
+                    return False
+                self.waiting += 1
+                deadline = time.monotonic() + self.max_wait
+                try:
+                    while self.active >= self.max_active:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.shed += 1
+                            return False
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def serialize(self):
+        return {
+            "max_active": self.max_active,
+            "max_waiting": self.max_waiting,
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "shed": self.shed,
+        }
+
+
+DEFAULT_POOLS = {
+    'priority': {'max_active': 8, 'max_waiting': 32, 'max_wait': 2.0, 'retry_after': 1},
+    'heavy': {'max_active': 4, 'max_waiting': 8, 'max_wait': 1.0, 'retry_after': 5},
+    'default': {'max_active': 16, 'max_waiting': 32, 'max_wait': 2.0, 'retry_after': 2},
+}
+POOL_SETTINGS = {'max_active': int, 'max_waiting': int, 'max_wait': float, 'retry_after': int}
+
+
+def create_pools(pools_config=None):
+    """
+    The pools of DEFAULT_POOLS with the limits of pools_config over them
+    """
+    settings = {name: dict(limits) for name, limits in DEFAULT_POOLS.items()}
+    for name, limits in (pools_config or {}).items():
+        unknown = set(limits) - set(POOL_SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown settings for the {name} admission pool: {', '.join(sorted(unknown))}")
+        settings.setdefault(name, dict(DEFAULT_POOLS['default'])).update(limits)
+
+    pools = {}
+    for name, limits in settings.items():
+        limits = {key: POOL_SETTINGS[key](value) for key, value in limits.items()}
+        if limits['max_active'] < 1 or limits['max_waiting'] < 0 or limits['max_wait'] < 0:
+            raise ValueError(f"Invalid limits for the {name} admission pool")
+        pools[name] = Pool(name, **limits)
+    return pools
+
+
+POOLS = create_pools()
+# Pool name by endpoint, over the lists above
+ENDPOINT_POOLS = {}
+
+
+def pool_for(endpoint):
+    """
+    Pool of an endpoint, or None when it isn't limited
+    """
+    if endpoint in ENDPOINT_POOLS:
+        name = ENDPOINT_POOLS[endpoint]
+        return POOLS[name] if name != 'exempt' else None
+    if endpoint in EXEMPT_ENDPOINTS:
+        return None
+    if endpoint in PRIORITY_ENDPOINTS:
+        return POOLS['priority']
+    if endpoint in HEAVY_ENDPOINTS:
+        return POOLS['heavy']
+    return POOLS['default']
+
+
+def get_admission_stats():
+    return {name: pool.serialize() for name, pool in POOLS.items()}
+
+
+def admit_request():
+    pool = pool_for(request.endpoint)
+    if pool is None:
+        return None
+    # Decided by the coalesced handler, only if this request ends up running it
+    if request.method == 'GET' and getattr(current_app.view_functions.get(request.endpoint), 'coalesced', False):
+        g.admission_deferred = pool
+        return None
+    return admit(pool)
+
+
+def admit_deferred():
+    """
+    Take the slot of a request whose admission was deferred to its coalesced handler.
+    Returns the 503 response when it's shed, None otherwise
+    """
+    pool = g.pop('admission_deferred', None)
+    if pool is None:
+        return None
+    return admit(pool)
+
+
+def admit(pool):
+    if not pool.acquire():
+        return jsonify({"message": "The server is busy, try again later"}), 503, \
+            {"Retry-After": str(pool.retry_after)}
+    g.admission_pool = pool
+    return None
+
+
+def release_request(exception=None):
+    pool = g.pop('admission_pool', None)
+    if pool is not None:
+        pool.release()
+
+
+def config_value(app, name):
+    """
+    A JSON setting from app.config or else the environment, None when unset
+    """
+    value = app.config.get(name, os.getenv(name))
+    return json.loads(value) if isinstance(value, str) else value
+
+
+def setup_admission(app):
+    global POOLS, ENDPOINT_POOLS
+    POOLS = create_pools(config_value(app, 'ADMISSION_POOLS'))
+    ENDPOINT_POOLS = dict(config_value(app, 'ADMISSION_ENDPOINTS') or {})
+    unknown = set(ENDPOINT_POOLS.values()) - set(POOLS) - {'exempt'}
+    if unknown:
+        raise ValueError(f"Unknown admission pools: {', '.join(sorted(unknown))}")
+
+    app.before_request(admit_request)
+    app.teardown_request(release_request)
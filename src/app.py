@@ -2,15 +2,38 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
+import contextlib
 import datetime
-from flask import Flask, request, jsonify, url_for
+import click
+from flask import Flask, Response, request, jsonify, url_for
 from flask_migrate import Migrate
 from flask_swagger import swagger
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from sqlalchemy import select, insert, update, delete, exists, literal, func, case
+from sqlalchemy.orm import selectinload, contains_eager
+from sqlalchemy.exc import IntegrityError
 from utils import APIException, generate_sitemap
 from admin import setup_admin
-from models import db, User, Character, Planet, Character_Favorite, Planet_Favorite, Weight, ClimateEnum, TerrainEnum, WeightUnitEnum, HairColorEnum
+from admission import setup_admission, get_admission_stats
+from singleflight import single_flight, coalesce
+from cache import ENTITIES as CACHED_ENTITIES, MemoryCache, SQLiteCache, response_cache, cached, benchmark
+from profiler import setup_profiler
+from slow_queries import MAX_STATEMENTS, setup_slow_queries, query_log
+from sqlite_tuning import DEFAULT_PRAGMAS, pragmas_from_env, setup_sqlite, benchmark as sqlite_benchmark
+from auth import admin_required
+from idempotency import idempotent, purge_expired_keys
+from batch import run_batch
+from snapshot import served_from_snapshot, json_response, get_snapshot_stats
+from invalidation import setup_invalidation, invalidate, get_invalidation_stats
+from models import db, User, Character, Planet, Character_Favorite, Planet_Favorite, Weight, ClimateEnum, TerrainEnum, WeightUnitEnum, HairColorEnum, ChangeActionEnum, Job, WEIGHT_UNIT_IN_KG
+from includes import serialize_with_includes
+from validation import USER_SCHEMA, CHARACTER_SCHEMA, PLANET_SCHEMA, raise_errors, benchmark as validation_benchmark
+from events import EVENT_ENTITIES, broker, ensure_poller, stream_events
+from dataset import IMPORT_BATCH_SIZE, export_dataset, import_dataset
+from jobs import DEFAULT_MAX_ATTEMPTS, WORKER_THREADS, JobError, Worker, job_handler, job_path, enqueue, cancel
+from changes import ENTITIES as CHANGE_ENTITIES, DEFAULT_CHANGES_PAGE, MAX_CHANGES_PAGE, favorite_id, log_change, log_deleted, get_changes, compact_changes
+from stats import STATS, CHARACTERS_PER_PLANET, HAIR_COLORS, CLIMATES, TERRAINS, FAVORITES_PER_USER, stat_key, update_stat, move_stat, get_stats, rebuild_stats, record_characters_deleted, record_planets_deleted, record_users_deleted
 # from models import Person
 
 app = Flask(__name__)
@@ -29,10 +52,18 @@ else:
     app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-MIGRATE = Migrate(app, db)
+# Batch mode, SQLite can only alter a table by rebuilding it
+MIGRATE = Migrate(app, db, render_as_batch=True)
 db.init_app(app)
+
+# WAL, busy timeout, foreign keys... on every SQLite connection, see sqlite_tuning.py
+setup_sqlite()
 CORS(app)
 setup_admin(app)
+setup_admission(app)
+setup_invalidation(app)
+setup_profiler(app)
+setup_slow_queries(app)
 
 # Handle/serialize errors like a JSON object
 
@@ -41,6 +72,286 @@ setup_admin(app)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
+# Commit the pending changes of the request. Flask-SQLAlchemy removes the session
+# when the request ends, so the handlers don't close it themselves.
+
+
+def commit_session(error_message):
+    """
+    Commit the current session, or roll it back and raise a 500 with the error
+    """
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise APIException(error_message, status_code=500,
+                           payload={"error": str(e)})
+
+# Size of the top lists when ?n= isn't given, and the largest one allowed
+DEFAULT_TOP_SIZE = 10
+MAX_TOP_SIZE = 100
+
+
+def get_top_favorited(model):
+    """
+    Read the n most favorited rows of a model straight from the indexed favorites counter
+    """
+    n = request.args.get('n', DEFAULT_TOP_SIZE, type=int)
+    if n < 1 or n > MAX_TOP_SIZE:
+        raise APIException(
+            f"n must be between 1 and {MAX_TOP_SIZE}", status_code=400)
+
+    rows = db.session.execute(
+        select(model.Id, model.Name, model.FavoritesCount)
+        .order_by(model.FavoritesCount.desc(), model.Id)
+        .limit(n)
+    )
+    return [{"id": id, "name": name, "favorites_count": count} for id, name, count in rows]
+
+# Eager loads covering everything serialize() reads, so many rows are serialized
+# with one query per relationship instead of lazy loads per row
+SERIALIZE_LOADERS = {
+    User: (
+        selectinload(User.Characters_Favorites_Association).joinedload(
+            Character_Favorite.Character),
+        selectinload(User.Planets_Favorites_Association).joinedload(
+            Planet_Favorite.Planet),
+    ),
+    Character: (
+        selectinload(Character.Weight),
+        selectinload(Character.HomeWorld),
+        selectinload(Character.Users_Favorites_Association).joinedload(
+            Character_Favorite.User),
+    ),
+    Planet: (
+        selectinload(Planet.Characters),
+        selectinload(Planet.Users_Favorites_Association).joinedload(
+            Planet_Favorite.User),
+    ),
+}
+
+# Entities each kind of cached response is built from, a change to any of them invalidates it
+# (the names of the related resources are part of every serialization)
+USER_SOURCES = ("user", "character_favorite", "planet_favorite", "character", "planet")
+CHARACTER_SOURCES = ("character", "character_favorite", "planet", "user")
+PLANET_SOURCES = ("planet", "planet_favorite", "character", "user")
+
+# The character list joins the weights itself, to filter and sort by them
+CHARACTER_LIST_LOADERS = (
+    selectinload(Character.HomeWorld),
+    selectinload(Character.Users_Favorites_Association).joinedload(
+        Character_Favorite.User),
+)
+
+
+WEIGHT_UNITS = frozenset(WeightUnitEnum.get_all())
+
+
+def get_weight_unit(unit_arg):
+    """
+    The unit of ?unit=, or None when not given
+    """
+    if unit_arg is None:
+        return None
+    if unit_arg not in WEIGHT_UNITS:
+        raise APIException("Invalid unit", status_code=400,
+                           payload={"units": WeightUnitEnum.get_all()})
+    return WeightUnitEnum(unit_arg)
+
+
+def get_weight_limit(arg, unit):
+    """
+    The weight of a query argument converted to kg, or None when not given
+    """
+    if arg not in request.args:
+        return None
+    limit = request.args.get(arg, type=float)
+    if limit is None:
+        raise APIException(f"{arg} must be a number", status_code=400)
+    return limit * WEIGHT_UNIT_IN_KG[unit or WeightUnitEnum.KG]
+
+# Batch reads (?ids=1,2,3) accept at most this many ids per request
+MAX_BATCH_SIZE = 100
+
+
+def parse_ids(ids_arg):
+    """
+    The ids of ?ids=1,5,9, without repeats and in the requested order
+    """
+    try:
+        # dict.fromkeys drops repeated ids but keeps the requested order
+        ids = list(dict.fromkeys(int(id) for id in ids_arg.split(',') if id.strip()))
+    except ValueError:
+        raise APIException("Ids must be integers", status_code=400)
+
+    if not ids:
+        raise APIException("Ids are required", status_code=400)
+
+    if len(ids) > MAX_BATCH_SIZE:
+        raise APIException(
+            f"At most {MAX_BATCH_SIZE} ids are allowed", status_code=400)
+    return ids
+
+
+def get_batch(model, ids_arg):
+    """
+    Serialize the rows of a model listed in ?ids=1,5,9 with a single IN query,
+    keeping the requested order and reporting the ids that don't exist
+    """
+    ids = parse_ids(ids_arg)
+    rows = db.session.execute(
+        select(model).where(model.Id.in_(ids)).options(*SERIALIZE_LOADERS[model])
+    ).scalars()
+    found = {row.Id: row for row in rows}
+
+    return {
+        "results": [found[id].serialize() for id in ids if id in found],
+        "missing": [id for id in ids if id not in found],
+    }
+
+# Bulk deletes accept at most this many ids per request
+MAX_BULK_DELETE = 1000
+
+
+def get_ids_from_body(body):
+    """
+    Read and validate the list of ids of a bulk request body
+    Example:
+    {
+        "ids": [1, 2, 3]
+    }
+    """
+    if not body or 'ids' not in body:
+        raise APIException("Ids are required", status_code=400)
+
+    if not isinstance(body['ids'], list) or not body['ids']:
+        raise APIException("Ids must be a non empty list", status_code=400)
+
+    if len(body['ids']) > MAX_BULK_DELETE:
+        raise APIException(
+            f"At most {MAX_BULK_DELETE} ids are allowed", status_code=400)
+
+    try:
+        return list({int(id) for id in body['ids']})
+    except (TypeError, ValueError):
+        raise APIException("Ids must be integers", status_code=400)
+
+
+def delete_by_ids(model, ids, favorites=()):
+    """
+    Delete the rows of a model with a single DELETE. The database cascades it to the
+    favorites and weights, so nothing is loaded into the session.
+    The users losing a favorite get their favorites version bumped first.
+    Returns the number of deleted rows
+    """
+    for favorite_model, fk_column in favorites:
+        table = favorite_model.__table__
+        db.session.execute(
+            update(User)
+            .where(User.Id.in_(
+                select(table.c.UserId).where(table.c[fk_column].in_(ids))))
+            .values(FavoritesVersion=User.FavoritesVersion + 1)
+            .execution_options(synchronize_session=False)
+        )
+
+    return db.session.execute(
+        delete(model).where(model.Id.in_(ids))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def lock_users(ids):
+    """
+    Lock the rows of users before the characters and planets they favorited, the order
+    every favorite write takes them in (see changes.py)
+    """
+    db.session.execute(select(User.Id).where(User.Id.in_(ids)).order_by(User.Id).with_for_update())
+
+
+def purge_users(ids):
+    """
+    Delete users by id with their favorites, keeping the counters and the change log
+    in sync. Runs in the current transaction, returns the number of deleted users
+    """
+    lock_users(ids)
+    release_favorites_counts(ids)
+    log_deleted(User, ids)
+    deleted = delete_by_ids(User, ids)
+    record_users_deleted(ids)
+    return deleted
+
+
+def purge_characters(ids):
+    """
+    Delete characters by id like purge_users()
+    """
+    record_characters_deleted(ids)
+    log_deleted(Character, ids)
+    return delete_by_ids(Character, ids, [(Character_Favorite, "CharacterId")])
+
+
+def purge_planets(ids):
+    """
+    Delete planets by id like purge_users()
+    """
+    record_planets_deleted(ids)
+    log_deleted(Planet, ids)
+    return delete_by_ids(Planet, ids, [(Planet_Favorite, "PlanetId")])
+
+
+PURGES = {"users": purge_users, "characters": purge_characters, "planets": purge_planets}
+
+
+def serve_characters(snapshot):
+    """
+    /characters from the catalog snapshot, with the arguments and errors of get_characters()
+    """
+    if 'ids' in request.args:
+        return json_response(snapshot.batch("characters", parse_ids(request.args['ids'])))
+
+    unit = get_weight_unit(request.args.get('unit'))
+    weight_gte = get_weight_limit('weight_gte', unit)
+    weight_lte = get_weight_limit('weight_lte', unit)
+    sort = request.args.get('sort')
+    if sort not in (None, 'weight', '-weight'):
+        raise APIException("sort must be weight or -weight", status_code=400)
+
+    if not snapshot.characters and weight_gte is None and weight_lte is None:
+        return jsonify({"message": "No characters found"}), 404
+    return json_response(snapshot.character_list(unit, weight_gte, weight_lte, sort))
+
+
+def serve_planets(snapshot):
+    """
+    /planets from the catalog snapshot
+    """
+    if 'ids' in request.args:
+        return json_response(snapshot.batch("planets", parse_ids(request.args['ids'])))
+
+    if not snapshot.planets:
+        return jsonify({"message": "No planets found"}), 404
+    return json_response(snapshot.planets_json)
+
+
+def serve_one(snapshot, kind, id, message):
+    """
+    /<kind>/<id> from the catalog snapshot, the requests with ?include= go to the handler
+    """
+    if request.args.get('include'):
+        return None
+    body = snapshot.get(kind, id)
+    if body is None:
+        return jsonify({"message": message}), 404
+    return json_response(body)
+
+
+def serve_character(snapshot, character_id):
+    return serve_one(snapshot, "characters", character_id, "Character not found")
+
+
+def serve_planet(snapshot, planet_id):
+    return serve_one(snapshot, "planets", planet_id, "Planet not found")
+
 # generate sitemap with all your endpoints
 
 
@@ -86,10 +397,15 @@ def login_user():
 
 # -------------------------------------------------------------Get Users
 @app.route('/users', methods=['GET'])
+@cached(*USER_SOURCES)
+@coalesce
 def get_users():
     """
-    Get all users
+    Get all users, or only some of them with ?ids=1,5,9
     """
+    if 'ids' in request.args:
+        return jsonify(get_batch(User, request.args['ids'])), 200
+
     users = User.query.all()
 
     if not users:
@@ -100,20 +416,25 @@ def get_users():
 
 # ----------------------------------------------Get User by ID
 @app.route('/users/<int:user_id>', methods=['GET'])
+@cached(*USER_SOURCES)
+@coalesce
 def get_user(user_id):
     """
     Get a user by id
+    Related resources can be embedded with ?include=, e.g. ?include=characters_favorites,planets_favorites
+    The resource itself then only has its own fields, the related ones are under "included"
     """
     user = User.query.get(user_id)
 
     if not user:
         return jsonify({"message": "User not found"}), 404
 
-    return jsonify(user.serialize()), 200
+    return jsonify(serialize_with_includes(User, user, request.args.get('include'))), 200
 
 
 # -----------------------------------------------Create User
 @app.route('/users', methods=['POST'])
+@idempotent
 def create_user():
     """
     Create a new user
@@ -125,48 +446,32 @@ def create_user():
         "is_active": true
     }
     """
-    body = request.get_json()
-
-    if not body:
-        return jsonify({"message": "No input data provided"}), 400
-
-    if 'username' not in body:
-        return jsonify({"message": "Username is required"}), 400
-
-    if 'email' not in body:
-        return jsonify({"message": "Email is required"}), 400
-
-    if 'password' not in body:
-        return jsonify({"message": "Password is required"}), 400
+    body, errors = USER_SCHEMA.check(request.get_json())
 
-    # Check if the username already exists
-    if User.query.filter_by(Username=body['username']).first():
-        return jsonify({"message": "Username already exists"}), 400
-
-    # Check if the email already exists
-    if User.query.filter_by(Email=body['email']).first():
-        return jsonify({"message": "Email already exists"}), 400
-
-    # Check if the password is strong enough
-    if len(body['password']) < 8:
-        return jsonify({"message": "Password must be at least 8 characters long"}), 400
+    # Check if the username and the email already exist
+    if 'username' in body and User.query.filter_by(Username=body['username']).first():
+        errors['username'] = "Username already exists"
+    if 'email' in body and User.query.filter_by(Email=body['email']).first():
+        errors['email'] = "Email already exists"
+    raise_errors(errors)
 
     new_user = User(
         Username=body['username'],
         Email=body['email'],
         Password=body['password'],
-        IsActive=body.get('is_active', False)
+        IsActive=body.get('is_active', False),
+        # A new user has no favorites yet, don't query for them after the insert
+        Characters_Favorites_Association=[],
+        Planets_Favorites_Association=[]
     )
 
-    try:
-        db.session.add(new_user)
-        db.session.commit()
-        return jsonify(new_user.serialize()), 201
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error creating user", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    db.session.add(new_user)
+    # Flush to get the new id for the change log
+    db.session.flush()
+    log_change(User, new_user.Id, ChangeActionEnum.UPSERT)
+
+    commit_session("Error creating user")
+    return jsonify(new_user.serialize()), 201
 
 
 # --------------------------------------------------Update User
@@ -183,56 +488,38 @@ def update_user(user_id):
         "is_active": true
     }
     """
-    body = request.get_json()
-
-    if not body:
-        return jsonify({"message": "No input data provided"}), 400
+    body, errors = USER_SCHEMA.check(request.get_json(), partial=True)
 
     user = User.query.get(user_id)
 
     if not user:
         return jsonify({"message": "User not found"}), 404
 
-    if 'username' in body:
-        # Check if the username is different from the current one
-        if body['username'] != user.Username:
-            # Check if the username already exists
-            if User.query.filter_by(Username=body['username']).first():
-                return jsonify({"message": "Username already exists"}), 400
-
-    if 'email' in body:
-        # Check if the email is different from the current one
-        if body['email'] != user.Email:
-            # Check if the email already exists
-            if User.query.filter_by(Email=body['email']).first():
-                return jsonify({"message": "Email already exists"}), 400
+    # Check if the username and the email, when they change, already exist
+    if 'username' in body and body['username'] != user.Username:
+        if User.query.filter_by(Username=body['username']).first():
+            errors['username'] = "Username already exists"
+    if 'email' in body and body['email'] != user.Email:
+        if User.query.filter_by(Email=body['email']).first():
+            errors['email'] = "Email already exists"
 
     # To update the password, the user must provide the current password
     if 'password' in body:
         if 'current_password' not in body:
-            return jsonify({"message": "Current password is required to update the password"}), 400
-        if body['current_password'] != user.Password:
-            return jsonify({"message": "Current password is incorrect"}), 400
-        if len(body['password']) < 8:
-            return jsonify({"message": "Password must be at least 8 characters long"}), 400
-        user.Password = body['password']
-
-    if 'is_active' in body:
-        user.IsActive = body['is_active']
+            errors['current_password'] = "Current password is required to update the password"
+        elif body['current_password'] != user.Password:
+            errors['current_password'] = "Current password is incorrect"
+    raise_errors(errors)
 
     user.Username = body.get('username', user.Username)
     user.Email = body.get('email', user.Email)
     user.Password = body.get('password', user.Password)
     user.IsActive = body.get('is_active', user.IsActive)
 
-    try:
-        db.session.commit()
-        return jsonify(user.serialize()), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error updating user", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    log_change(User, user.Id, ChangeActionEnum.UPSERT)
+
+    commit_session("Error updating user")
+    return jsonify(user.serialize()), 200
 
 
 # ------------------------------------------------------Delete User
@@ -241,20 +528,41 @@ def delete_user(user_id):
     """
     Delete a user by id
     """
-    user = User.query.get(user_id)
+    lock_users([user_id])
+    release_favorites_counts([user_id])
+    log_deleted(User, [user_id])
 
-    if not user:
+    if not delete_by_ids(User, [user_id]):
+        db.session.rollback()
         return jsonify({"message": "User not found"}), 404
 
-    try:
-        db.session.delete(user)
-        db.session.commit()
-        return jsonify({"message": "User deleted successfully"}), 200
-    except Exception as e:
+    record_users_deleted([user_id])
+
+    commit_session("Error deleting user")
+    return jsonify({"message": "User deleted successfully"}), 200
+
+
+# ------------------------------------------------------Delete Users in bulk
+@app.route('/users', methods=['DELETE'])
+@admin_required
+def delete_users():
+    """
+    Delete many users by id
+    Example:
+    {
+        "ids": [1, 2, 3]
+    }
+    """
+    ids = get_ids_from_body(request.get_json(silent=True))
+
+    deleted = purge_users(ids)
+
+    if not deleted:
         db.session.rollback()
-        return jsonify({"message": "Error deleting user", "error": str(e)}), 500
-    finally:
-        db.session.close()
+        return jsonify({"message": "No users found"}), 404
+
+    commit_session("Error deleting users")
+    return jsonify({"message": "Users deleted successfully", "deleted": deleted}), 200
 
 
 # -------------------------------------------------------Add Character to Favorites without JWT
@@ -305,9 +613,248 @@ def delete_user(user_id):
 #         db.session.close()
 
 
+# -------------------------------------------------------Favorites helpers
+def bump_favorites_version(user_id):
+    """
+    Increment the favorites version of a user in the current transaction.
+    Returns the new version, or None if the user doesn't exist
+    """
+    updated = db.session.execute(
+        update(User)
+        .where(User.Id == user_id)
+        .values(FavoritesVersion=User.FavoritesVersion + 1)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not updated:
+        return None
+    # Read back rather than UPDATE ... RETURNING, which MySQL doesn't have. The row
+    # stays locked by the UPDATE until the commit, so this is the version just set
+    return db.session.execute(
+        select(User.FavoritesVersion).where(User.Id == user_id)
+    ).scalar()
+
+
+def bump_favorites_count(target_model, target_id, delta):
+    """
+    Add delta to the favorites counter of a character or planet
+    """
+    db.session.execute(
+        update(target_model)
+        .where(target_model.Id == target_id)
+        .values(FavoritesCount=target_model.FavoritesCount + delta)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def insert_favorite(favorite_model, fk_column, target_model, user_id, target_id):
+    """
+    Insert a favorite row with a single INSERT ... SELECT that only matches when the
+    target exists and isn't already a favorite, and count it on the target.
+    Returns the number of inserted rows
+    """
+    table = favorite_model.__table__
+    already_favorite = exists().where(
+        table.c.UserId == user_id, table.c[fk_column] == target_id)
+    try:
+        inserted = db.session.execute(
+            insert(table).from_select(
+                ["UserId", fk_column],
+                select(literal(user_id), target_model.Id)
+                .where(target_model.Id == target_id, ~already_favorite)
+            )
+        ).rowcount
+    except IntegrityError:
+        # A concurrent request inserted the same favorite after the NOT EXISTS was checked
+        db.session.rollback()
+        return 0
+    if inserted:
+        bump_favorites_count(target_model, target_id, inserted)
+    return inserted
+
+
+def delete_favorite(favorite_model, fk_column, target_model, user_id, target_id):
+    """
+    Delete a favorite row with a single DELETE and uncount it from the target.
+    Returns the number of deleted rows
+    """
+    table = favorite_model.__table__
+    deleted = db.session.execute(
+        delete(table).where(
+            table.c.UserId == user_id, table.c[fk_column] == target_id)
+    ).rowcount
+    if deleted:
+        bump_favorites_count(target_model, target_id, -deleted)
+    return deleted
+
+
+# Favorites pages (?after=&limit=) hold this many favorites by default, and at most
+DEFAULT_FAVORITES_PAGE = 50
+MAX_FAVORITES_PAGE = 200
+
+
+def get_favorites_page(favorite_model, fk_column, target_model, user_id):
+    """
+    One page of a user's favorites, by increasing id after the ?after= cursor, with a
+    single join walking the primary key index of the favorites table.
+    Returns None if the user doesn't exist
+    """
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', DEFAULT_FAVORITES_PAGE, type=int)
+
+    if after < 0:
+        raise APIException("after must be a positive cursor", status_code=400)
+
+    if limit < 1 or limit > MAX_FAVORITES_PAGE:
+        raise APIException(f"limit must be between 1 and {MAX_FAVORITES_PAGE}", status_code=400)
+
+    table = favorite_model.__table__
+    # One more row than asked tells whether there is a next page
+    rows = db.session.execute(
+        select(target_model)
+        .join(table, table.c[fk_column] == target_model.Id)
+        .where(table.c.UserId == user_id, table.c[fk_column] > after)
+        .order_by(table.c[fk_column])
+        .limit(limit + 1)
+    ).scalars().all()
+
+    # An empty page may be an unknown user, find out only on this path
+    if not rows and not db.session.get(User, user_id):
+        return None
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "results": [row.serialize_summary() for row in rows],
+        "next_cursor": rows[-1].Id if rows else after,
+        "has_more": has_more,
+    }
+
+
+def get_favorited_ids(favorite_model, fk_column, user_id, ids_arg):
+    """
+    Which of the ids in ?ids=1,5,9 are favorites of a user, with a single IN query on
+    the primary key of the favorites table. Returns None if the user doesn't exist
+    """
+    ids = parse_ids(ids_arg)
+    table = favorite_model.__table__
+    favorited = set(db.session.execute(
+        select(table.c[fk_column]).where(table.c.UserId == user_id, table.c[fk_column].in_(ids))
+    ).scalars())
+
+    if not favorited and not db.session.get(User, user_id):
+        return None
+
+    return {
+        "favorited": [id for id in ids if id in favorited],
+        "not_favorited": [id for id in ids if id not in favorited],
+    }
+
+
+def favorites_count_of(favorite_model, fk_column, target_model, *where):
+    """
+    Correlated subquery counting the favorites of each target row
+    """
+    table = favorite_model.__table__
+    return (
+        select(func.count())
+        .where(table.c[fk_column] == target_model.Id, *where)
+        .scalar_subquery()
+    )
+
+
+# Favorite tables and the model they point to, with the foreign key column
+FAVORITE_TARGETS = (
+    (Character_Favorite, "CharacterId", Character),
+    (Planet_Favorite, "PlanetId", Planet),
+)
+
+
+def release_favorites_counts(user_ids):
+    """
+    Uncount the favorites of users about to be deleted, must run before the DELETE
+    since the database cascade removes their favorites rows
+    """
+    for favorite_model, fk_column, target_model in FAVORITE_TARGETS:
+        table = favorite_model.__table__
+        db.session.execute(
+            update(target_model)
+            .where(target_model.Id.in_(
+                select(table.c[fk_column]).where(table.c.UserId.in_(user_ids))))
+            .values(FavoritesCount=target_model.FavoritesCount - favorites_count_of(
+                favorite_model, fk_column, target_model, table.c.UserId.in_(user_ids)))
+            .execution_options(synchronize_session=False)
+        )
+
+
+# ------------------------------------------------------Reconcile Favorites counters command
+@app.cli.command("reconcile-favorites")
+def reconcile_favorites_command():
+    """
+    Recount the favorites of every character and planet, repairing any drift
+    """
+    repaired_entities = []
+    for favorite_model, fk_column, target_model in FAVORITE_TARGETS:
+        actual_count = favorites_count_of(favorite_model, fk_column, target_model)
+        repaired = db.session.execute(
+            update(target_model)
+            .where(target_model.FavoritesCount != actual_count)
+            .values(FavoritesCount=actual_count)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if repaired:
+            repaired_entities.append(CHANGE_ENTITIES[target_model])
+        click.echo(f"{target_model.__tablename__}: {repaired} counters repaired")
+    db.session.commit()
+    # The top lists and the snapshot serve the counters
+    invalidate(repaired_entities)
+
+
+# -------------------------------------------------------Get Favorite Characters
+@app.route('/users/<int:user_id>/favorites/characters', methods=['GET'])
+@cached("character_favorite", "character", "user")
+@coalesce
+def get_favorite_characters(user_id):
+    """
+    Get a page of the user's favorite characters, e.g. ?after=120&limit=50
+    Start without after and keep passing the returned next_cursor while has_more is true.
+    Check which characters are favorites with ?ids=1,5,9 instead
+    """
+    if 'ids' in request.args:
+        result = get_favorited_ids(Character_Favorite, "CharacterId", user_id, request.args['ids'])
+    else:
+        result = get_favorites_page(Character_Favorite, "CharacterId", Character, user_id)
+
+    if result is None:
+        return jsonify({"message": "User not found"}), 404
+
+    return jsonify(result), 200
+
+
+# -------------------------------------------------------Get Favorite Planets
+@app.route('/users/<int:user_id>/favorites/planets', methods=['GET'])
+@cached("planet_favorite", "planet", "user")
+@coalesce
+def get_favorite_planets(user_id):
+    """
+    Get a page of the user's favorite planets, e.g. ?after=3&limit=50
+    Start without after and keep passing the returned next_cursor while has_more is true.
+    Check which planets are favorites with ?ids=1,5,9 instead
+    """
+    if 'ids' in request.args:
+        result = get_favorited_ids(Planet_Favorite, "PlanetId", user_id, request.args['ids'])
+    else:
+        result = get_favorites_page(Planet_Favorite, "PlanetId", Planet, user_id)
+
+    if result is None:
+        return jsonify({"message": "User not found"}), 404
+
+    return jsonify(result), 200
+
+
 # -------------------------------------------------------Add Character to Favorites with JWT
 @app.route('/users/<int:user_id>/favorites/characters', methods=['POST'])
 @jwt_required()
+@idempotent
 def add_character_to_favorites(user_id):
     """
     Add a character to the user's favorites
@@ -328,34 +875,33 @@ def add_character_to_favorites(user_id):
     if 'character_id' not in body:
         return jsonify({"message": "Character ID is required"}), 400
 
-    user = User.query.get(user_id)
-
-    if not user:
-        return jsonify({"message": "User not found"}), 404
+    try:
+        character_id = int(body['character_id'])
+    except (TypeError, ValueError):
+        return jsonify({"message": "Character ID must be an integer"}), 400
 
-    character = Character.query.get(body['character_id'])
+    favorites_version = bump_favorites_version(user_id)
 
-    if not character:
-        return jsonify({"message": "Character not found"}), 404
+    if favorites_version is None:
+        db.session.rollback()
+        return jsonify({"message": "User not found"}), 404
 
-    # Check if the character is already in the user's favorites
-    if Character_Favorite.query.filter_by(UserId=user.Id, CharacterId=character.Id).first():
+    if not insert_favorite(Character_Favorite, "CharacterId", Character, user_id, character_id):
+        db.session.rollback()
+        # Nothing was inserted, find out why only on this slow path
+        if not db.session.get(Character, character_id):
+            return jsonify({"message": "Character not found"}), 404
         return jsonify({"message": "Character already in favorites"}), 400
 
-    favorite = Character_Favorite(
-        UserId=user.Id,
-        CharacterId=character.Id
-    )
+    update_stat(FAVORITES_PER_USER, stat_key(user_id), 1)
+    log_change(Character_Favorite, favorite_id(user_id, character_id), ChangeActionEnum.UPSERT)
 
-    try:
-        db.session.add(favorite)
-        db.session.commit()
-        return jsonify(user.serialize()["characters_favorites"]), 201
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error adding character to favorites", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    commit_session("Error adding character to favorites")
+    return jsonify({
+        "user_id": user_id,
+        "character_id": character_id,
+        "favorites_version": favorites_version
+    }), 201
 
 
 # -------------------------------------------------------Remove Character from Favorites with JWT
@@ -369,36 +915,26 @@ def remove_character_from_favorites(user_id, character_id):
     if int(current_user_id) != user_id:
         return jsonify({"message": "Unauthorized"}), 401
 
-    user = User.query.get(user_id)
-
-    if not user:
-        return jsonify({"message": "User not found"}), 404
-
-    character = Character.query.get(character_id)
-
-    if not character:
-        return jsonify({"message": "Character not found"}), 404
-
-    favorite = Character_Favorite.query.filter_by(
-        UserId=user.Id, CharacterId=character.Id).first()
-
-    if not favorite:
+    if not delete_favorite(Character_Favorite, "CharacterId", Character, user_id, character_id):
+        db.session.rollback()
         return jsonify({"message": "Favorite not found"}), 404
 
-    try:
-        db.session.delete(favorite)
-        db.session.commit()
-        return jsonify(user.serialize()["characters_favorites"]), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error removing character from favorites", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    favorites_version = bump_favorites_version(user_id)
+    update_stat(FAVORITES_PER_USER, stat_key(user_id), -1)
+    log_change(Character_Favorite, favorite_id(user_id, character_id), ChangeActionEnum.DELETE)
+
+    commit_session("Error removing character from favorites")
+    return jsonify({
+        "user_id": user_id,
+        "character_id": character_id,
+        "favorites_version": favorites_version
+    }), 200
 
 
 # ------------------------------------------------------Add Planet to Favorites
 @app.route('/users/<int:user_id>/favorites/planets', methods=['POST'])
 @jwt_required()
+@idempotent
 def add_planet_to_favorites(user_id):
     """
     Add a planet to the user's favorites
@@ -419,34 +955,33 @@ def add_planet_to_favorites(user_id):
     if 'planet_id' not in body:
         return jsonify({"message": "Planet ID is required"}), 400
 
-    user = User.query.get(user_id)
-
-    if not user:
-        return jsonify({"message": "User not found"}), 404
+    try:
+        planet_id = int(body['planet_id'])
+    except (TypeError, ValueError):
+        return jsonify({"message": "Planet ID must be an integer"}), 400
 
-    planet = Planet.query.get(body['planet_id'])
+    favorites_version = bump_favorites_version(user_id)
 
-    if not planet:
-        return jsonify({"message": "Planet not found"}), 404
+    if favorites_version is None:
+        db.session.rollback()
+        return jsonify({"message": "User not found"}), 404
 
-    # Check if the planet is already in the user's favorites
-    if Planet_Favorite.query.filter_by(UserId=user.Id, PlanetId=planet.Id).first():
+    if not insert_favorite(Planet_Favorite, "PlanetId", Planet, user_id, planet_id):
+        db.session.rollback()
+        # Nothing was inserted, find out why only on this slow path
+        if not db.session.get(Planet, planet_id):
+            return jsonify({"message": "Planet not found"}), 404
         return jsonify({"message": "Planet already in favorites"}), 400
 
-    favorite = Planet_Favorite(
-        UserId=user.Id,
-        PlanetId=planet.Id
-    )
+    update_stat(FAVORITES_PER_USER, stat_key(user_id), 1)
+    log_change(Planet_Favorite, favorite_id(user_id, planet_id), ChangeActionEnum.UPSERT)
 
-    try:
-        db.session.add(favorite)
-        db.session.commit()
-        return jsonify(user.serialize()["planets_favorites"]), 201
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error adding planet to favorites", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    commit_session("Error adding planet to favorites")
+    return jsonify({
+        "user_id": user_id,
+        "planet_id": planet_id,
+        "favorites_version": favorites_version
+    }), 201
 
 
 # -------------------------------------------------------------Remove Planet from Favorites
@@ -460,31 +995,20 @@ def remove_planet_from_favorites(user_id, planet_id):
     if int(current_user_id) != user_id:
         return jsonify({"message": "Unauthorized"}), 401
 
-    user = User.query.get(user_id)
-
-    if not user:
-        return jsonify({"message": "User not found"}), 404
-
-    planet = Planet.query.get(planet_id)
-
-    if not planet:
-        return jsonify({"message": "Planet not found"}), 404
-
-    favorite = Planet_Favorite.query.filter_by(
-        UserId=user.Id, PlanetId=planet.Id).first()
-
-    if not favorite:
+    if not delete_favorite(Planet_Favorite, "PlanetId", Planet, user_id, planet_id):
+        db.session.rollback()
         return jsonify({"message": "Favorite not found"}), 404
 
-    try:
-        db.session.delete(favorite)
-        db.session.commit()
-        return jsonify(user.serialize()["planets_favorites"]), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error removing planet from favorites", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    favorites_version = bump_favorites_version(user_id)
+    update_stat(FAVORITES_PER_USER, stat_key(user_id), -1)
+    log_change(Planet_Favorite, favorite_id(user_id, planet_id), ChangeActionEnum.DELETE)
+
+    commit_session("Error removing planet from favorites")
+    return jsonify({
+        "user_id": user_id,
+        "planet_id": planet_id,
+        "favorites_version": favorites_version
+    }), 200
 
 
 ############################################################
@@ -492,77 +1016,96 @@ def remove_planet_from_favorites(user_id, planet_id):
 ############################################################
 # ------------------------------------------------------------------------Get Characters
 @app.route('/characters', methods=['GET'])
+@served_from_snapshot(serve_characters)
+@cached(*CHARACTER_SOURCES)
+@coalesce
 def get_characters():
     """
-    Get all characters
+    Get all characters, or only some of them with ?ids=1,5,9
+    Filter by weight with ?weight_gte=50&weight_lte=90, sort with ?sort=weight (or -weight for
+    the heaviest first) and show the weights in one unit with ?unit=lb. The weight filters are
+    in that unit too, kg by default
     """
-    characters = Character.query.all()
-
-    if not characters:
+    if 'ids' in request.args:
+        return jsonify(get_batch(Character, request.args['ids'])), 200
+
+    unit = get_weight_unit(request.args.get('unit'))
+    query = select(Character).outerjoin(Character.Weight).options(
+        contains_eager(Character.Weight), *CHARACTER_LIST_LOADERS)
+
+    weight_gte = get_weight_limit('weight_gte', unit)
+    if weight_gte is not None:
+        query = query.where(Weight.WeightKg >= weight_gte)
+    weight_lte = get_weight_limit('weight_lte', unit)
+    if weight_lte is not None:
+        query = query.where(Weight.WeightKg <= weight_lte)
+
+    sort = request.args.get('sort')
+    if sort not in (None, 'weight', '-weight'):
+        raise APIException("sort must be weight or -weight", status_code=400)
+    if sort:
+        # Characters without weight go last either way
+        weight_kg = Weight.WeightKg.desc() if sort == '-weight' else Weight.WeightKg
+        query = query.order_by(Weight.WeightKg.is_(None), weight_kg, Character.Id)
+    else:
+        # Not in the order of whichever index the filters use
+        query = query.order_by(Character.Id)
+
+    characters = db.session.execute(query).scalars().all()
+
+    # An empty result of a filter isn't an error
+    if not characters and weight_gte is None and weight_lte is None:
         return jsonify({"message": "No characters found"}), 404
 
-    return jsonify([character.serialize() for character in characters]), 200
+    return jsonify([character.serialize(unit) for character in characters]), 200
+
+
+# -----------------------------------------------------------------------Get Top Characters
+@app.route('/characters/top', methods=['GET'])
+@cached(*CHARACTER_SOURCES)
+@coalesce
+def get_top_characters():
+    """
+    Get the most favorited characters, e.g. /characters/top?n=10
+    """
+    return jsonify(get_top_favorited(Character)), 200
 
 
 # -----------------------------------------------------------------------Get Character by ID
 @app.route('/characters/<int:character_id>', methods=['GET'])
+@served_from_snapshot(serve_character)
+@cached(*CHARACTER_SOURCES)
+@coalesce
 def get_character(character_id):
     """
     Get a character by id
+    Related resources can be embedded with ?include=, e.g. ?include=home_world,weight,users_favorites
+    The resource itself then only has its own fields, the related ones are under "included"
     """
     character = Character.query.get(character_id)
 
     if not character:
         return jsonify({"message": "Character not found"}), 404
 
-    return jsonify(character.serialize()), 200
+    return jsonify(serialize_with_includes(Character, character, request.args.get('include'))), 200
 
 
 # -------------------------------------------------------------------------Create Character
 @app.route('/characters', methods=['POST'])
+@idempotent
 def create_character():
     """
     Create a new character
     """
-    body = request.get_json()
-
-    if not body:
-        return jsonify({"message": "No input data provided"}), 400
-
-    if 'name' not in body:
-        return jsonify({"message": "Name is required"}), 400
+    body, errors = CHARACTER_SCHEMA.check(request.get_json())
 
     # Check if the name already exists
-    if Character.query.filter_by(Name=body['name']).first():
-        return jsonify({"message": "Name already exists"}), 400
-
-    # Check if the hair color is valid
-    if 'hair_color' in body:
-        if body['hair_color'] not in HairColorEnum.get_all():
-            return jsonify({"message": "Invalid hair color"}), 400
-
-    # Check if the height is a valid integer
-    if 'height' in body:
-        try:
-            body['height'] = int(body['height'])
-        except ValueError:
-            return jsonify({"message": "Height must be an integer"}), 400
-
-    # Check if the birth day is a valid date
-    if 'birth_day' in body:
-        try:
-            body['birth_day'] = datetime.datetime.strptime(
-                body['birth_day'], '%d-%m-%Y').date()
-        except ValueError:
-            return jsonify({"message": "Birth day must be in DD-MM-YYYY format"}), 400
-
-    # Check if the home world id is a valid integer
-    if 'home_world_id' in body:
-        try:
-            body['home_world_id'] = int(body['home_world_id'])
-        except ValueError:
-            return jsonify({"message": "Home world id must be an integer"}), 400
+    if 'name' in body and Character.query.filter_by(Name=body['name']).first():
+        errors['name'] = "Name already exists"
+    raise_errors(errors)
+
     # Check if the home world id exists
+    home_world = None
     if 'home_world_id' in body:
         home_world = Planet.query.get(body['home_world_id'])
         if not home_world:
@@ -571,41 +1114,31 @@ def create_character():
     new_character = Character(
         Name=body['name'],
         Height=body.get('height', None),
-        HairColor=body['hair_color'],
-        BirthDay=body['birth_day'],
-        HomeWorldId=body['home_world_id']
+        HairColor=body.get('hair_color', HairColorEnum.UNKNOWN),
+        BirthDay=body.get('birth_day', None),
+        # Reuse the planet loaded above instead of lazy loading it again
+        HomeWorld=home_world,
+        Users_Favorites_Association=[]
     )
 
     if 'weight' in body:
-        # Check if the weight is a valid float
-        try:
-            body['weight'] = float(body['weight'])
-        except ValueError:
-            return jsonify({"message": "Weight must be a float"}), 400
-
-        # Check if the weight unit is valid
-        if 'weight_unit' in body:
-            if body['weight_unit'] not in WeightUnitEnum.get_all():
-                return jsonify({"message": "Invalid weight unit"}), 400
-        else:
-            body['weight_unit'] = WeightUnitEnum.KG.value
-
-        # Create a new weight object
+        # Create a new weight object, in kg unless told otherwise
         new_weight = Weight(
             Weight=body['weight'],
-            WeightUnit=body['weight_unit']
+            WeightUnit=body.get('weight_unit', WeightUnitEnum.KG)
         )
         new_character.Weight = new_weight
 
-    try:
-        db.session.add(new_character)
-        db.session.commit()
-        return jsonify(new_character.serialize()), 201
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error creating character", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    db.session.add(new_character)
+    update_stat(HAIR_COLORS, stat_key(new_character.HairColor), 1)
+    update_stat(CHARACTERS_PER_PLANET, stat_key(
+        home_world.Id if home_world else None), 1)
+    # Flush to get the new id for the change log
+    db.session.flush()
+    log_change(Character, new_character.Id, ChangeActionEnum.UPSERT)
+
+    commit_session("Error creating character")
+    return jsonify(new_character.serialize()), 201
 
 
 # ---------------------------------------------------------------------Update Character
@@ -614,81 +1147,44 @@ def update_character(character_id):
     """
     Update a character by id
     """
-    body = request.get_json()
-
-    if not body:
-        return jsonify({"message": "No input data provided"}), 400
+    body, errors = CHARACTER_SCHEMA.check(request.get_json(), partial=True)
 
     character = Character.query.get(character_id)
 
     if not character:
         return jsonify({"message": "Character not found"}), 404
 
-    if 'name' in body:
-        # Check if the name is different from the current one
-        if body['name'] != character.Name:
-            # Check if the name already exists
-            if Character.query.filter_by(Name=body['name']).first():
-                return jsonify({"message": "Name already exists"}), 400
-
-    if 'hair_color' in body:
-        # Check if the hair color is different from the current one
-        if body['hair_color'] != character.HairColor:
-            # Check if the hair color is valid
-            if body['hair_color'] not in HairColorEnum.get_all():
-                return jsonify({"message": "Invalid hair color"}), 400
-
-    # Check if the height is a valid integer
-    if 'height' in body:
-        try:
-            body['height'] = int(body['height'])
-        except ValueError:
-            return jsonify({"message": "Height must be an integer"}), 400
-
-    # Check if the birth day is a valid date
-    if 'birth_day' in body:
-        try:
-            body['birth_day'] = datetime.datetime.strptime(
-                body['birth_day'], '%d-%m-%Y').date()
-        except ValueError:
-            return jsonify({"message": "Birth day must be in DD-MM-YYYY format"}), 400
-
-    # Check if the home world id is a valid integer
+    # Check if the name, when it changes, already exists
+    if 'name' in body and body['name'] != character.Name:
+        if Character.query.filter_by(Name=body['name']).first():
+            errors['name'] = "Name already exists"
+    raise_errors(errors)
+
     if 'home_world_id' in body:
-        try:
-            body['home_world_id'] = int(body['home_world_id'])
-        except ValueError:
-            return jsonify({"message": "Home world id must be an integer"}), 400
         # Check if the home world id exists
         home_world = Planet.query.get(body['home_world_id'])
         if not home_world:
             return jsonify({"message": "Home world not found"}), 404
 
-    # Check if the weight is a valid float
     if 'weight' in body:
-        try:
-            body['weight'] = float(body['weight'])
-        except ValueError:
-            return jsonify({"message": "Weight must be a float"}), 400
-
-        # Check if the weight unit is valid
-        if 'weight_unit' in body:
-            if body['weight_unit'] not in WeightUnitEnum.get_all():
-                return jsonify({"message": "Invalid weight unit"}), 400
-        else:
-            body['weight_unit'] = WeightUnitEnum.KG.value
-
-        # Update the weight object
+        # Update the weight object, in kg unless told otherwise
+        weight_unit = body.get('weight_unit', WeightUnitEnum.KG)
         if character.Weight:
             character.Weight.Weight = body['weight']
-            character.Weight.WeightUnit = body['weight_unit']
+            character.Weight.WeightUnit = weight_unit
         else:
             new_weight = Weight(
                 Weight=body['weight'],
-                WeightUnit=body['weight_unit']
+                WeightUnit=weight_unit
             )
             character.Weight = new_weight
 
+    # Keep the rollups in sync before the values change
+    move_stat(HAIR_COLORS, character.HairColor,
+              body.get('hair_color', character.HairColor))
+    move_stat(CHARACTERS_PER_PLANET, character.HomeWorldId,
+              body.get('home_world_id', character.HomeWorldId))
+
     # Update the character object
     character.Name = body.get('name', character.Name)
     character.Height = body.get('height', character.Height)
@@ -696,14 +1192,10 @@ def update_character(character_id):
     character.BirthDay = body.get('birth_day', character.BirthDay)
     character.HomeWorldId = body.get('home_world_id', character.HomeWorldId)
 
-    try:
-        db.session.commit()
-        return jsonify(character.serialize()), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error updating character", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    log_change(Character, character.Id, ChangeActionEnum.UPSERT)
+
+    commit_session("Error updating character")
+    return jsonify(character.serialize()), 200
 
 
 # --------------------------------------------------------------Delete Character
@@ -712,20 +1204,38 @@ def delete_character(character_id):
     """
     Delete a character by id
     """
-    character = Character.query.get(character_id)
+    record_characters_deleted([character_id])
+    log_deleted(Character, [character_id])
 
-    if not character:
+    if not delete_by_ids(Character, [character_id], [(Character_Favorite, "CharacterId")]):
+        db.session.rollback()
         return jsonify({"message": "Character not found"}), 404
 
-    try:
-        db.session.delete(character)
-        db.session.commit()
-        return jsonify({"message": "Character deleted successfully"}), 200
-    except Exception as e:
+    commit_session("Error deleting character")
+    return jsonify({"message": "Character deleted successfully"}), 200
+
+
+# --------------------------------------------------------------Delete Characters in bulk
+@app.route('/characters', methods=['DELETE'])
+@admin_required
+def delete_characters():
+    """
+    Delete many characters by id
+    Example:
+    {
+        "ids": [1, 2, 3]
+    }
+    """
+    ids = get_ids_from_body(request.get_json(silent=True))
+
+    deleted = purge_characters(ids)
+
+    if not deleted:
         db.session.rollback()
-        return jsonify({"message": "Error deleting character", "error": str(e)}), 500
-    finally:
-        db.session.close()
+        return jsonify({"message": "No characters found"}), 404
+
+    commit_session("Error deleting characters")
+    return jsonify({"message": "Characters deleted successfully", "deleted": deleted}), 200
 
 
 ############################################################
@@ -733,11 +1243,17 @@ def delete_character(character_id):
 ############################################################
 # -----------------------------------------------------------------Get Planets
 @app.route('/planets', methods=['GET'])
+@served_from_snapshot(serve_planets)
+@cached(*PLANET_SOURCES)
+@coalesce
 def get_planets():
     """
-    Get all planets
+    Get all planets, or only some of them with ?ids=1,5,9
     """
-    planets = Planet.query.all()
+    if 'ids' in request.args:
+        return jsonify(get_batch(Planet, request.args['ids'])), 200
+
+    planets = Planet.query.order_by(Planet.Id).all()
 
     if not planets:
         return jsonify({"message": "No planets found"}), 404
@@ -745,63 +1261,68 @@ def get_planets():
     return jsonify([planet.serialize() for planet in planets]), 200
 
 
+# --------------------------------------------------------------Get Top Planets
+@app.route('/planets/top', methods=['GET'])
+@cached(*PLANET_SOURCES)
+@coalesce
+def get_top_planets():
+    """
+    Get the most favorited planets, e.g. /planets/top?n=10
+    """
+    return jsonify(get_top_favorited(Planet)), 200
+
+
 # --------------------------------------------------------------Get Planet by ID
 @app.route('/planets/<int:planet_id>', methods=['GET'])
+@served_from_snapshot(serve_planet)
+@cached(*PLANET_SOURCES)
+@coalesce
 def get_planet(planet_id):
     """
     Get a planet by id
+    Related resources can be embedded with ?include=, e.g. ?include=characters,characters.weight,users_favorites
+    The resource itself then only has its own fields, the related ones are under "included"
     """
     planet = Planet.query.get(planet_id)
 
     if not planet:
         return jsonify({"message": "Planet not found"}), 404
 
-    return jsonify(planet.serialize()), 200
+    return jsonify(serialize_with_includes(Planet, planet, request.args.get('include'))), 200
 
 
 # -----------------------------------------------------------Create Planet
 @app.route('/planets', methods=['POST'])
+@idempotent
 def create_planet():
     """
     Create a new planet
     """
-    body = request.get_json()
-
-    if not body:
-        return jsonify({"message": "No input data provided"}), 400
-
-    if 'name' not in body:
-        return jsonify({"message": "Name is required"}), 400
+    body, errors = PLANET_SCHEMA.check(request.get_json())
 
     # Check if the name already exists
-    if Planet.query.filter_by(Name=body['name']).first():
-        return jsonify({"message": "Name already exists"}), 400
-
-    # Check if the climate is valid
-    if 'climate' in body:
-        if body['climate'] not in ClimateEnum.get_all():
-            return jsonify({"message": "Invalid climate"}), 400
-
-    # Check if the terrain is valid
-    if 'terrain' in body:
-        if body['terrain'] not in TerrainEnum.get_all():
-            return jsonify({"message": "Invalid terrain"}), 400
+    if 'name' in body and Planet.query.filter_by(Name=body['name']).first():
+        errors['name'] = "Name already exists"
+    raise_errors(errors)
 
     new_planet = Planet(
         Name=body['name'],
-        Climate=body.get('climate', ClimateEnum.UNKNOWN.value),
-        Terrain=body.get('terrain', TerrainEnum.UNKNOWN.value)
+        Climate=body.get('climate', ClimateEnum.UNKNOWN),
+        Terrain=body.get('terrain', TerrainEnum.UNKNOWN),
+        # A new planet has no residents nor favorites yet
+        Characters=[],
+        Users_Favorites_Association=[]
     )
 
-    try:
-        db.session.add(new_planet)
-        db.session.commit()
-        return jsonify(new_planet.serialize()), 201
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error creating planet", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    db.session.add(new_planet)
+    update_stat(CLIMATES, stat_key(new_planet.Climate), 1)
+    update_stat(TERRAINS, stat_key(new_planet.Terrain), 1)
+    # Flush to get the new id for the change log
+    db.session.flush()
+    log_change(Planet, new_planet.Id, ChangeActionEnum.UPSERT)
+
+    commit_session("Error creating planet")
+    return jsonify(new_planet.serialize()), 201
 
 
 # ------------------------------------------------------------Update Planet
@@ -810,50 +1331,32 @@ def update_planet(planet_id):
     """
     Update a planet by id
     """
-    body = request.get_json()
-
-    if not body:
-        return jsonify({"message": "No input data provided"}), 400
+    body, errors = PLANET_SCHEMA.check(request.get_json(), partial=True)
 
     planet = Planet.query.get(planet_id)
 
     if not planet:
         return jsonify({"message": "Planet not found"}), 404
 
-    if 'name' in body:
-        # Check if the name is different from the current one
-        if body['name'] != planet.Name:
-            # Check if the name already exists
-            if Planet.query.filter_by(Name=body['name']).first():
-                return jsonify({"message": "Name already exists"}), 400
-
-    if 'climate' in body:
-        # Check if the climate is different from the current one
-        if body['climate'] != planet.Climate.value:
-            # Check if the climate is valid
-            if body['climate'] not in ClimateEnum.get_all():
-                return jsonify({"message": "Invalid climate"}), 400
-
-    if 'terrain' in body:
-        # Check if the terrain is different from the current one
-        if body['terrain'] != planet.Terrain.value:
-            # Check if the terrain is valid
-            if body['terrain'] not in TerrainEnum.get_all():
-                return jsonify({"message": "Invalid terrain"}), 400
+    # Check if the name, when it changes, already exists
+    if 'name' in body and body['name'] != planet.Name:
+        if Planet.query.filter_by(Name=body['name']).first():
+            errors['name'] = "Name already exists"
+    raise_errors(errors)
+
+    # Keep the rollups in sync before the values change
+    move_stat(CLIMATES, planet.Climate, body.get('climate', planet.Climate))
+    move_stat(TERRAINS, planet.Terrain, body.get('terrain', planet.Terrain))
 
     # Update the planet object
     planet.Name = body.get('name', planet.Name)
-    planet.Climate = body.get('climate', planet.Climate.value)
-    planet.Terrain = body.get('terrain', planet.Terrain.value)
+    planet.Climate = body.get('climate', planet.Climate)
+    planet.Terrain = body.get('terrain', planet.Terrain)
 
-    try:
-        db.session.commit()
-        return jsonify(planet.serialize()), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error updating planet", "error": str(e)}), 500
-    finally:
-        db.session.close()
+    log_change(Planet, planet.Id, ChangeActionEnum.UPSERT)
+
+    commit_session("Error updating planet")
+    return jsonify(planet.serialize()), 200
 
 
 # ------------------------------------------------------------Delete Planet
@@ -862,20 +1365,519 @@ def delete_planet(planet_id):
     """
     Delete a planet by id
     """
-    planet = Planet.query.get(planet_id)
+    record_planets_deleted([planet_id])
+    log_deleted(Planet, [planet_id])
 
-    if not planet:
+    if not delete_by_ids(Planet, [planet_id], [(Planet_Favorite, "PlanetId")]):
+        db.session.rollback()
         return jsonify({"message": "Planet not found"}), 404
 
+    commit_session("Error deleting planet")
+    return jsonify({"message": "Planet deleted successfully"}), 200
+
+
+# ------------------------------------------------------------Delete Planets in bulk
+@app.route('/planets', methods=['DELETE'])
+@admin_required
+def delete_planets():
+    """
+    Delete many planets by id
+    Example:
+    {
+        "ids": [1, 2, 3]
+    }
+    """
+    ids = get_ids_from_body(request.get_json(silent=True))
+
+    deleted = purge_planets(ids)
+
+    if not deleted:
+        db.session.rollback()
+        return jsonify({"message": "No planets found"}), 404
+
+    commit_session("Error deleting planets")
+    return jsonify({"message": "Planets deleted successfully", "deleted": deleted}), 200
+
+
+############################################################
+# STATS
+############################################################
+# ------------------------------------------------------------Get all Stats
+@app.route('/stats', methods=['GET'])
+@cached(*CACHED_ENTITIES)
+@coalesce
+def get_all_stats():
+    """
+    Get every dashboard statistic, read from the rollup table
+    """
+    return jsonify(get_stats()), 200
+
+
+# ------------------------------------------------------------Get Stat by name
+@app.route('/stats/<string:name>', methods=['GET'])
+@cached(*CACHED_ENTITIES)
+@coalesce
+def get_stat(name):
+    """
+    Get one dashboard statistic, e.g. /stats/hair_colors
+    """
+    if name not in STATS:
+        return jsonify({"message": "Stat not found", "stats": list(STATS)}), 404
+
+    return jsonify(get_stats(name)[name]), 200
+
+
+# ------------------------------------------------------------Get Admission counters
+@app.route('/admission', methods=['GET'])
+@admin_required
+def get_admission():
+    """
+    Concurrency limits and counters (admitted, shed, active, waiting) of this worker
+    """
+    return jsonify(get_admission_stats()), 200
+
+
+# ------------------------------------------------------------Get Single-flight counters
+@app.route('/singleflight', methods=['GET'])
+@admin_required
+def get_single_flight():
+    """
+    Counters of the GET requests coalesced by this worker: leaders ran the handler,
+    coalesced requests got a copy of a leader's response
+    """
+    return jsonify(single_flight.serialize()), 200
+
+
+# ------------------------------------------------------------Get Response Cache counters
+@app.route('/cache', methods=['GET'])
+@admin_required
+def get_cache():
+    """
+    Backend, size and hit/miss counters (of this worker) of the response cache,
+    and the counters of the invalidation bus between the nodes and of the catalog snapshot
+    """
+    return jsonify(dict(response_cache.serialize(), invalidation=get_invalidation_stats(),
+                        snapshot=get_snapshot_stats())), 200
+
+
+# ------------------------------------------------------------Get Slow Queries
+@app.route('/slow-queries', methods=['GET'])
+@admin_required
+def get_slow_queries():
+    """
+    Statements of this worker with the most total time (when SLOW_QUERY_MS is set), and
+    the recent slow ones with their route, redacted parameters and plan, e.g. /slow-queries?limit=20
+    """
+    limit = request.args.get('limit', 20, type=int)
+
+    if limit < 1 or limit > MAX_STATEMENTS:
+        return jsonify({"message": f"limit must be between 1 and {MAX_STATEMENTS}"}), 400
+
+    return jsonify(query_log.serialize(limit)), 200
+
+
+# ------------------------------------------------------------Reset Slow Queries
+@app.route('/slow-queries', methods=['DELETE'])
+@admin_required
+def reset_slow_queries():
+    """
+    Start the statement totals and the slow query log over
+    """
+    query_log.reset()
+    return jsonify({"message": "Slow query log cleared"}), 200
+
+
+# ------------------------------------------------------------Rebuild Stats command
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """
+    Recompute every statistic rollup from the catalog
+    """
+    counts = rebuild_stats()
+    db.session.commit()
+    invalidate(CACHED_ENTITIES)
+    for name, values in counts.items():
+        click.echo(f"{name}: {len(values)} keys")
+
+
+############################################################
+# CHANGES
+############################################################
+# ------------------------------------------------------------Get Changes
+@app.route('/changes', methods=['GET'])
+def get_changes_since():
+    """
+    Get the changes made after a cursor, oldest first, e.g. /changes?since=120&limit=500
+    Start with since=0 and keep passing the returned next_cursor while has_more is true.
+    Changes are numbered in commit order (see changes.py), none is committed behind a
+    cursor already returned, so following next_cursor misses none
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', DEFAULT_CHANGES_PAGE, type=int)
+
+    if since < 0:
+        return jsonify({"message": "since must be a positive cursor"}), 400
+
+    if limit < 1 or limit > MAX_CHANGES_PAGE:
+        return jsonify({"message": f"limit must be between 1 and {MAX_CHANGES_PAGE}"}), 400
+
+    return jsonify(get_changes(since, limit)), 200
+
+
+# ------------------------------------------------------------Stream Events
+@app.route('/events', methods=['GET'])
+def get_events():
+    """
+    Server-Sent Events stream of the changes, as they happen
+    Filter with ?entities=character,planet_favorite and/or ?user_id=1 (a user and its favorites).
+    Reconnecting clients send Last-Event-ID to get the events they missed.
+    An "overflow" event means the client fell behind: resync with /changes?since=<last id>
+    """
+    entities = None
+    if request.args.get('entities'):
+        entities = request.args['entities'].split(',')
+        if not set(entities) <= set(EVENT_ENTITIES):
+            return jsonify({"message": "Invalid entities", "entities": list(EVENT_ENTITIES)}), 400
+
+    user_id = request.args.get('user_id', type=int)
+
+    subscription = broker.subscribe(entities, user_id)
+    if subscription is None:
+        return jsonify({"message": "Too many open event streams, try again later"}), 503, {"Retry-After": "5"}
+
     try:
-        db.session.delete(planet)
+        # The poller reads its starting cursor first, a change committed before the
+        # replay below is read is then either replayed or published
+        if not ensure_poller(app):
+            broker.unsubscribe(subscription)
+            return jsonify({"message": "Event stream not available, try again later"}), 503, {"Retry-After": "5"}
+
+        # Replay what the client missed since its last event, the subscription is already
+        # registered so nothing published meanwhile is lost
+        replay = []
+        last_event_id = request.headers.get('Last-Event-ID', type=int)
+        if last_event_id is not None:
+            page = get_changes(last_event_id, MAX_CHANGES_PAGE)
+            replay = page["changes"]
+            if page["has_more"]:
+                subscription.overflowed = True
+    except Exception:
+        broker.unsubscribe(subscription)
+        raise
+    # The stream never touches the database, release the connection now
+    db.session.remove()
+
+    response = Response(stream_events(subscription, replay), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # The generator only unsubscribes once started, a client gone before the first
+    # chunk would leave its subscription behind
+    response.call_on_close(lambda: broker.unsubscribe(subscription))
+    return response
+
+
+def normalize_weights():
+    """
+    Set the weight in kg of every weight with a single UPDATE, returns the number of rows
+    """
+    weight_kg = Weight.Weight * case(
+        *((Weight.WeightUnit == unit, factor) for unit, factor in WEIGHT_UNIT_IN_KG.items()))
+    return db.session.execute(update(Weight).values(WeightKg=weight_kg)).rowcount
+
+
+# ------------------------------------------------------------Normalize Weights command
+@app.cli.command("normalize-weights")
+def normalize_weights_command():
+    """
+    Recompute the weights in kg of every character, e.g. after adding the column
+    """
+    count = normalize_weights()
+    db.session.commit()
+    invalidate(["character"])
+    click.echo(f"{count} weights normalized")
+
+
+# ------------------------------------------------------------Compact Changes command
+@app.cli.command("compact-changes")
+@click.option("--days", type=int, default=None,
+              help="Only compact the changes older than this many days")
+def compact_changes_command(days):
+    """
+    Drop the changes superseded by a later change of the same entity
+    """
+    before = None
+    if days is not None:
+        before = datetime.datetime.now() - datetime.timedelta(days=days)
+    deleted = compact_changes(before)
+    db.session.commit()
+    click.echo(f"{deleted} superseded changes removed")
+
+
+# ------------------------------------------------------------Purge Idempotency Keys command
+@app.cli.command("purge-idempotency-keys")
+def purge_idempotency_keys_command():
+    """
+    Delete the stored responses of the expired idempotency keys
+    """
+    click.echo(f"{purge_expired_keys()} expired idempotency keys removed")
+
+
+############################################################
+# EXPORT / IMPORT
+############################################################
+# ------------------------------------------------------------Export command
+@app.cli.command("export")
+@click.argument("output", type=click.File("w"), default="-")
+def export_command(output):
+    """
+    Export every table as NDJSON, to a file or stdout
+    Example: flask export backup.ndjson
+    """
+    counts = export_dataset(output)
+    for table, count in counts.items():
+        click.echo(f"{table}: {count} rows exported", err=True)
+
+
+# ------------------------------------------------------------Import command
+@app.cli.command("import")
+@click.argument("input", type=click.File("r"))
+@click.option("--checkpoint", type=click.Path(dir_okay=False), default=None,
+              help="File saving the progress, a rerun resumes where the last one stopped")
+@click.option("--batch-size", type=int, default=IMPORT_BATCH_SIZE, show_default=True)
+def import_command(input, checkpoint, batch_size):
+    """
+    Import an NDJSON export into an empty database, then rebuild the stats rollups
+    Example: flask import backup.ndjson --checkpoint backup.checkpoint
+    """
+    counts = import_dataset(input, checkpoint, batch_size)
+    # Exports made before the WeightKg column don't have it
+    normalize_weights()
+    rebuild_stats()
+    db.session.commit()
+    # The import doesn't go through the change log
+    invalidate(CACHED_ENTITIES)
+    for table, count in counts.items():
+        click.echo(f"{table}: {count} rows imported")
+
+
+# ------------------------------------------------------------Cache Benchmark command
+@app.cli.command("cache-benchmark")
+@click.option("--workers", type=int, default=4, show_default=True)
+@click.option("--requests", type=int, default=2000, show_default=True, help="Requests per worker")
+@click.option("--keys", type=int, default=200, show_default=True, help="Distinct URLs requested")
+def cache_benchmark_command(workers, requests, keys):
+    """
+    Compare one cache per worker process with the cache shared by the workers of the host
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.sqlite")
+        SQLiteCache(path)
+        backends = {
+            "per-process (memory)": (MemoryCache, False),
+            "shared (sqlite)": (lambda: SQLiteCache(path), True),
+        }
+        for name, (factory, shared) in backends.items():
+            result = benchmark(factory, workers, requests, keys, shared=shared)
+            click.echo(f"{name}: hit rate {result['hit_rate']}, {result['computations']} computations, "
+                       f"{result['seconds']}s, {result['entries']} entries and {result['bytes']} bytes held")
+
+
+# ------------------------------------------------------------Validation Benchmark command
+@app.cli.command("validation-benchmark")
+@click.option("--iterations", type=int, default=100000, show_default=True)
+def validation_benchmark_command(iterations):
+    """
+    Compare the compiled request validation with the if-chains it replaced
+    """
+    result = validation_benchmark(iterations)
+    click.echo(f"if-chain: {result['if_chain']:.2f} us per body")
+    click.echo(f"compiled: {result['compiled']:.2f} us per body")
+
+
+# ------------------------------------------------------------SQLite Benchmark command
+@app.cli.command("sqlite-benchmark")
+@click.option("--workers", type=int, default=4, show_default=True)
+@click.option("--operations", type=int, default=2000, show_default=True, help="Operations per worker")
+@click.option("--write-ratio", type=float, default=0.2, show_default=True)
+def sqlite_benchmark_command(workers, operations, write_ratio):
+    """
+    Compare SQLite's default settings with the tuned ones (from the SQLITE_* variables)
+    with worker processes reading and writing the same file
+    """
+    settings = {"default": DEFAULT_PRAGMAS, "tuned": pragmas_from_env()}
+    for name, pragmas in settings.items():
+        result = sqlite_benchmark(pragmas, workers, operations, write_ratio)
+        click.echo(f"{name}: {result['per_second']} operations/s, {result['seconds']}s, "
+                   f"{result['locked']} failed on a locked database")
+
+
+############################################################
+# BATCH
+############################################################
+# ------------------------------------------------------------Batch
+@app.route('/batch', methods=['POST'])
+def batch():
+    """
+    Run many sub-requests in one round trip, see batch.py
+    Example:
+    {
+        "requests": [
+            {"id": "me", "method": "GET", "path": "/users/1"},
+            {"id": "planets", "method": "GET", "path": "/planets"},
+            {"method": "GET", "path": "/characters?ids=1,2,3"},
+            {"method": "POST", "path": "/users/1/favorites/planets", "body": {"planet_id": 3}, "depends_on": ["me"]}
+        ]
+    }
+    Returns {"responses": [{"id": "me", "status": 200, "body": {...}}, ...]} in the same order
+    """
+    return jsonify({"responses": run_batch(request.get_json(silent=True))}), 200
+
+
+############################################################
+# JOBS
+############################################################
+# Ids a purge job accepts, deleted MAX_BULK_DELETE at a time
+MAX_PURGE_IDS = 100000
+
+
+# ------------------------------------------------------------Create Job
+@app.route('/jobs', methods=['POST'])
+@admin_required
+@idempotent
+def create_job():
+    """
+    Queue a background job, run by `flask jobs-worker`. Poll GET /jobs/<id> for its progress
+    Example:
+    {
+        "kind": "purge",
+        "params": {"entity": "characters", "ids": [1, 2, 3]},
+        "max_attempts": 3
+    }
+    Kinds: rebuild-stats, normalize-weights, export ({"file": name}, optional),
+    import ({"file": name} of a file in JOBS_DIR), purge ({"entity": users|characters|planets, "ids": [...]})
+    """
+    body = request.get_json(silent=True)
+    if not body or not isinstance(body, dict) or 'kind' not in body:
+        return jsonify({"message": "Kind is required"}), 400
+
+    job = enqueue(body['kind'], body.get('params'), int(get_jwt_identity()),
+                  body.get('max_attempts', DEFAULT_MAX_ATTEMPTS))
+    commit_session("Error creating job")
+    return jsonify(job.serialize()), 202, {"Location": url_for('get_job', job_id=job.Id)}
+
+
+# ------------------------------------------------------------Get Job by ID
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+@admin_required
+def get_job(job_id):
+    """
+    Status, progress and result (or last error) of a job
+    """
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+
+    return jsonify(job.serialize()), 200
+
+
+# ------------------------------------------------------------Cancel Job
+@app.route('/jobs/<int:job_id>', methods=['DELETE'])
+@admin_required
+def cancel_job(job_id):
+    """
+    Cancel a job: right away when it's still queued, at its next progress report when
+    it's running. What a running job already committed stays
+    """
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({"message": "Job not found"}), 404
+
+    if not cancel(job):
+        return jsonify({"message": "Job already finished", "job": job.serialize()}), 409
+
+    return jsonify({"message": "Job cancellation requested", "job": job.serialize()}), 200
+
+
+@job_handler("rebuild-stats")
+def rebuild_stats_job(context):
+    counts = rebuild_stats()
+    db.session.commit()
+    invalidate(CACHED_ENTITIES)
+    return {name: len(values) for name, values in counts.items()}
+
+
+@job_handler("normalize-weights")
+def normalize_weights_job(context):
+    count = normalize_weights()
+    db.session.commit()
+    invalidate(["character"])
+    return {"normalized": count}
+
+
+@job_handler("export")
+def export_job(context, file=None):
+    path = job_path(file or f"export-{context.job_id}.ndjson")
+    # Written aside and renamed once complete, a failed attempt never leaves half an export
+    with open(f"{path}.part", "w") as output:
+        counts = export_dataset(output, progress=context.progress)
+    os.replace(f"{path}.part", path)
+    return {"file": os.path.basename(path), "counts": counts}
+
+
+@job_handler("import")
+def import_job(context, file):
+    path = job_path(file)
+    if not os.path.exists(path):
+        raise JobError(f"{file} not found in the jobs directory")
+
+    # A retry resumes after the last batch the failed attempt committed
+    checkpoint = job_path(f"import-{context.job_id}.checkpoint")
+    with open(path) as input:
+        counts = import_dataset(input, checkpoint, progress=context.progress)
+    normalize_weights()
+    rebuild_stats()
+    db.session.commit()
+    invalidate(CACHED_ENTITIES)
+    # An import with no line to import never got to write its checkpoint
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(checkpoint)
+    return {"counts": counts}
+
+
+@job_handler("purge")
+def purge_job(context, entity, ids):
+    purge = PURGES.get(entity)
+    if purge is None:
+        raise JobError(f"Entity must be one of {', '.join(PURGES)}")
+    try:
+        ids = sorted({int(id) for id in ids})
+    except (TypeError, ValueError):
+        raise JobError("Ids must be integers")
+    if len(ids) > MAX_PURGE_IDS:
+        raise JobError(f"At most {MAX_PURGE_IDS} ids are allowed")
+
+    # One transaction per batch, a retry skips the ids already gone
+    context.progress(0, len(ids))
+    deleted = 0
+    for start in range(0, len(ids), MAX_BULK_DELETE):
+        batch = ids[start:start + MAX_BULK_DELETE]
+        deleted += purge(batch)
         db.session.commit()
-        return jsonify({"message": "Planet deleted successfully"}), 200
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({"message": "Error deleting planet", "error": str(e)}), 500
-    finally:
-        db.session.close()
+        context.progress(start + len(batch))
+    return {"deleted": deleted}
+
+
+# ------------------------------------------------------------Jobs Worker command
+@app.cli.command("jobs-worker")
+@click.option("--threads", type=int, default=WORKER_THREADS, show_default=True,
+              help="Jobs run at the same time")
+def jobs_worker_command(threads):
+    """
+    Run the queued background jobs until stopped, SIGTERM lets the running ones finish
+    """
+    worker = Worker(app, threads)
+    click.echo(f"Job worker {worker.id} started with {threads} threads")
+    worker.run()
 
 
 # this only runs if `$ python src/app.py` is executed
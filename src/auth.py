@@ -0,0 +1,37 @@
+"""
+Admins of the API: the users listed by id in ADMIN_USER_IDS (e.g. ADMIN_USER_IDS=1,7),
+identified by their JWT like every other user.
+"""
+import functools
+import os
+from flask import jsonify
+from flask_jwt_extended import get_jwt_identity, jwt_required, verify_jwt_in_request
+
+ADMIN_USER_IDS = frozenset(
+    id.strip() for id in os.getenv("ADMIN_USER_IDS", "").split(",") if id.strip())
+
+
+def is_admin():
+    """
+    Whether the request carries a valid JWT of an admin. Never fails, for optional checks
+    """
+    if not ADMIN_USER_IDS:
+        return False
+    try:
+        verify_jwt_in_request(optional=True)
+    except Exception:
+        return False
+    return get_jwt_identity() in ADMIN_USER_IDS
+
+
+def admin_required(view):
+    """
+    Decorator for the routes only admins may call: 401 without a JWT, 403 for other users
+    """
+    @functools.wraps(view)
+    @jwt_required()
+    def wrapper(*args, **kwargs):
+        if get_jwt_identity() not in ADMIN_USER_IDS:
+            return jsonify({"message": "Admins only"}), 403
+        return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,180 @@
+"""
+Batch endpoint: many sub-requests in one round trip, e.g. the dozen calls of a page load.
+
+POST /batch takes a list of sub-requests and dispatches each one in process through
+the URL map of the app, to the same view functions as a real request, with the
+Authorization header of the batch. The before/after request hooks aren't run again:
+admission control, profiling and the rest apply to the batch as a whole.
+
+Sub-requests can name the ones they depend on with depends_on. They run in waves:
+a wave holds every sub-request whose dependencies are done, in the order given.
+A sub-request whose dependency failed (status >= 400) isn't run and gets a 424.
+
+In a wave, the writes run first, one at a time, then the reads run concurrently on
+BATCH_THREADS threads. Every sub-request, sequential or not, runs in its own app
+context: its own session, so nothing read before a write is served stale after it,
+and its own g. The teardown of a sub-request then can't touch the state of the batch
+request, like the admission slot it holds or its JWT, nor leave its own to the next
+sub-request.
+"""
+import concurrent.futures
+import logging
+import os
+from flask import current_app, request
+from werkzeug.test import EnvironBuilder
+from models import db
+from utils import APIException
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_REQUESTS = 20
+BATCH_THREADS = int(os.getenv("BATCH_THREADS", "4"))
+METHODS = ("GET", "POST", "PUT", "DELETE")
+# Streams can't be batched, and batches don't nest
+EXCLUDED_ENDPOINTS = {"static", "get_events", "batch"}
+# Headers of the batch request passed on to its sub-requests
+FORWARDED_HEADERS = ("Authorization",)
+
+executor = concurrent.futures.ThreadPoolExecutor(BATCH_THREADS, thread_name_prefix="batch")
+
+
+def parse_batch(body):
+    """
+    Validate the sub-requests of a batch body, giving each one an id (its index by
+    default) and a list of dependencies
+    Example:
+    {
+        "requests": [
+            {"id": "me", "method": "GET", "path": "/users/1"},
+            {"method": "GET", "path": "/planets"},
+            {"method": "POST", "path": "/users/1/favorites/planets", "body": {"planet_id": 3}, "depends_on": ["me"]}
+        ]
+    }
+    """
+    if not body or not isinstance(body, dict) or not isinstance(body.get("requests"), list) \
+            or not body["requests"]:
+        raise APIException("Requests must be a non empty list")
+    if len(body["requests"]) > MAX_BATCH_REQUESTS:
+        raise APIException(f"At most {MAX_BATCH_REQUESTS} requests are allowed")
+
+    subrequests = []
+    for index, sub in enumerate(body["requests"]):
+        if not isinstance(sub, dict):
+            raise APIException(f"Request {index} must be an object")
+        subrequest = {
+            "id": str(sub.get("id", index)),
+            "method": str(sub.get("method", "GET")).upper(),
+            "path": sub.get("path"),
+            "body": sub.get("body"),
+            "depends_on": sub.get("depends_on", []),
+        }
+        if subrequest["method"] not in METHODS:
+            raise APIException(f"Method of request {subrequest['id']} must be one of {', '.join(METHODS)}")
+        if not isinstance(subrequest["path"], str) or not subrequest["path"].startswith("/"):
+            raise APIException(f"Path of request {subrequest['id']} must start with /")
+        if not isinstance(subrequest["depends_on"], list):
+            raise APIException(f"Dependencies of request {subrequest['id']} must be a list of ids")
+        subrequest["depends_on"] = [str(id) for id in subrequest["depends_on"]]
+        subrequests.append(subrequest)
+
+    ids = [subrequest["id"] for subrequest in subrequests]
+    if len(set(ids)) != len(ids):
+        raise APIException("Request ids must be unique")
+    for subrequest in subrequests:
+        unknown = set(subrequest["depends_on"]) - set(ids)
+        if unknown:
+            raise APIException(f"Request {subrequest['id']} depends on unknown requests",
+                               payload={"unknown": sorted(unknown)})
+    return subrequests
+
+
+def plan_waves(subrequests):
+    """
+    Group the sub-requests in waves, each depending only on the previous ones
+    """
+    waves = []
+    done = set()
+    remaining = list(subrequests)
+    while remaining:
+        wave = [sub for sub in remaining if set(sub["depends_on"]) <= done]
+        if not wave:
+            raise APIException("Dependencies form a cycle",
+                               payload={"requests": [sub["id"] for sub in remaining]})
+        waves.append(wave)
+        done.update(sub["id"] for sub in wave)
+        remaining = [sub for sub in remaining if sub["id"] not in done]
+    return waves
+
+
+def dispatch(app, subrequest, headers, base_url):
+    """
+    Run one sub-request through the URL map and the view, returns its result
+    """
+    builder = EnvironBuilder(path=subrequest["path"], method=subrequest["method"], base_url=base_url,
+                             headers=headers, json=subrequest["body"] if subrequest["body"] is not None else None)
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+
+    with app.request_context(environ):
+        if request.endpoint in EXCLUDED_ENDPOINTS:
+            return result(subrequest, 400, {"message": "This endpoint can't be batched"})
+        try:
+            try:
+                response = app.make_response(app.dispatch_request())
+            except Exception as e:
+                # Routing errors, APIException... as they'd be answered to a real request
+                response = app.make_response(app.handle_user_exception(e))
+        except Exception:
+            logger.exception(f"Batched {subrequest['method']} {subrequest['path']} failed")
+            db.session.rollback()
+            return result(subrequest, 500, {"message": "Internal server error"})
+
+    body = response.get_json(silent=True) if response.is_json else response.get_data(as_text=True)
+    return result(subrequest, response.status_code, body)
+
+
+def dispatch_in_context(app, subrequest, headers, base_url):
+    with app.app_context():
+        return dispatch(app, subrequest, headers, base_url)
+
+
+def result(subrequest, status, body):
+    return {"id": subrequest["id"], "status": status, "body": body}
+
+
+def run_batch(body):
+    """
+    Run the sub-requests of a batch body, returns their results in the given order
+    """
+    subrequests = parse_batch(body)
+    waves = plan_waves(subrequests)
+    app = current_app._get_current_object()
+    headers = {name: request.headers[name] for name in FORWARDED_HEADERS if name in request.headers}
+    base_url = request.host_url
+
+    results = {}
+    for wave in waves:
+        runnable = []
+        for sub in wave:
+            failed = [id for id in sub["depends_on"] if results[id]["status"] >= 400]
+            if failed:
+                results[sub["id"]] = result(sub, 424, {"message": "A dependency failed", "failed": failed})
+            else:
+                runnable.append(sub)
+
+        reads = [sub for sub in runnable if sub["method"] == "GET"]
+        for sub in runnable:
+            if sub["method"] != "GET":
+                results[sub["id"]] = dispatch_in_context(app, sub, headers, base_url)
+
+        if len(reads) > 1 and BATCH_THREADS > 1:
+            futures = {sub["id"]: executor.submit(dispatch_in_context, app, sub, headers, base_url) for sub in reads}
+            for id, future in futures.items():
+                results[id] = future.result()
+        else:
+            for sub in reads:
+                results[sub["id"]] = dispatch_in_context(app, sub, headers, base_url)
+
+    return [results[sub["id"]] for sub in subrequests]
@@ -0,0 +1,344 @@
+"""
+Response cache for the GET handlers, shared by all the workers of a host.
+
+Caching is off unless CACHE_BACKEND is set. CACHE_BACKEND=sqlite is a SQLite file in
+WAL mode: every gunicorn worker started from wsgi.py opens the same file, so a payload
+computed by one worker is a hit for all the others and is stored only once. The
+per-process MemoryCache (CACHE_BACKEND=memory) has the same interface.
+
+The file holds whole responses, emails included, so it's only readable by the user
+running the app: CACHE_PATH defaults to ~/.cache/api/responses.sqlite, the directory
+is created with mode 0700 and the file with 0600 (SQLite gives its -wal and -shm
+files the mode of the database).
+
+Invalidation is by entity. Each cached route declares the entities its payload is built
+from, and each entity has a generation counter. An entry is stored together with the
+generations it was computed from, and it's a hit only while they're all current.
+After a commit, the entities written (collected by changes.log_change) get their
+generation bumped with a single UPDATE, which any worker sees at once, and the other
+nodes are told through the invalidation bus (see invalidation.py). An entry
+computed from data read before a write is never served after that write, even if it's
+stored after the invalidation.
+
+Stale and expired entries are simply never hit again. They're evicted, least recently
+used first, when the cache grows above max_bytes.
+
+`flask cache-benchmark` compares the hit rate, the computations and the memory of both
+backends with several worker processes.
+"""
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from flask import Response, current_app, g, request
+from changes import ENTITIES as CHANGE_ENTITIES
+
+logger = logging.getLogger(__name__)
+
+ENTITIES = tuple(CHANGE_ENTITIES.values())
+
+# Seconds an entry is served at most, whatever the invalidations
+DEFAULT_TTL = 300
+# Size of the cached payloads before the least recently used ones are evicted
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# The last access of an entry is only written when older than this, so hits stay reads
+ACCESS_RESOLUTION = 10
+
+
+class MemoryCache:
+    """
+    Cache of a single process, the reference the shared cache is measured against
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = {}
+        self._generations = dict.fromkeys(ENTITIES, 0)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def generations(self, entities):
+        with self._lock:
+            return {entity: self._generations[entity] for entity in entities}
+
+    def get(self, key, entities):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            generations, expires_at, value = entry
+            if expires_at < time.time() or any(
+                    self._generations[entity] != generation for entity, generation in generations.items()):
+                return None
+            # Move to the end, the dict keeps the least recently used entries first
+            self._entries[key] = self._entries.pop(key)
+            return value
+
+    def set(self, key, value, generations):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous[2][0])
+            self._entries[key] = (generations, time.time() + self.ttl, value)
+            self._size += len(value[0])
+            while self._size > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._size -= len(self._entries.pop(oldest)[2][0])
+
+    def invalidate(self, entities):
+        with self._lock:
+            for entity in entities:
+                self._generations[entity] += 1
+
+    def size(self):
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def create_private_file(path):
+    """
+    Create a file, and its directory, readable by the current user only
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+    # Also for a file created before, or with a umask ignoring the mode
+    os.chmod(path, 0o600)
+
+
+class SQLiteCache:
+    """
+    Cache in a SQLite file, shared by every process opening the same path
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        create_private_file(path)
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS generations (entity TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, generations TEXT NOT NULL, "
+            "body BLOB NOT NULL, status INTEGER NOT NULL, mimetype TEXT NOT NULL, "
+            "size INTEGER NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_entries_accessed_at ON entries (accessed_at)")
+        connection.executemany(
+            "INSERT OR IGNORE INTO generations (entity, generation) VALUES (?, 0)",
+            [(entity,) for entity in ENTITIES])
+
+    def _connection(self):
+        # One connection per thread, in autocommit mode: every statement is atomic
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            # Losing the cache on a power failure is fine
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+        return connection
+
+    def generations(self, entities):
+        rows = self._connection().execute(
+            f"SELECT entity, generation FROM generations WHERE entity IN ({','.join('?' * len(entities))})",
+            list(entities))
+        return dict(rows.fetchall())
+
+    def get(self, key, entities):
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT generations, body, status, mimetype, expires_at, accessed_at FROM entries WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return None
+        generations, body, status, mimetype, expires_at, accessed_at = row
+        now = time.time()
+        if expires_at < now or json.loads(generations) != self.generations(entities):
+            return None
+        if accessed_at < now - ACCESS_RESOLUTION:
+            connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return body, status, mimetype
+
+    def set(self, key, value, generations):
+        body, status, mimetype = value
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO entries (key, generations, body, status, mimetype, size, expires_at, accessed_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, json.dumps(generations), body, status, mimetype, len(body), now + self.ttl, now))
+        if self.size() > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """
+        Delete the least recently used entries until the cache is back to 90% of max_bytes
+        """
+        self._connection().execute(
+            "DELETE FROM entries WHERE key IN ("
+            " SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY accessed_at DESC) AS kept FROM entries)"
+            " WHERE kept > ?)",
+            (int(self.max_bytes * 0.9),))
+
+    def invalidate(self, entities):
+        entities = list(entities)
+        self._connection().execute(
+            f"UPDATE generations SET generation = generation + 1 WHERE entity IN ({','.join('?' * len(entities))})",
+            entities)
+
+    def size(self):
+        return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+
+class ResponseCache:
+    """
+    The configured backend, with hit/miss counters. Backend errors are logged and the
+    request goes on uncached
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _call(self, method, *args):
+        if self.backend is None:
+            return None
+        try:
+            return getattr(self.backend, method)(*args)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning(f"Response cache {method} failed: {e}")
+            return None
+
+    def get(self, key, entities):
+        value = self._call("get", key, entities)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def generations(self, entities):
+        return self._call("generations", entities)
+
+    def set(self, key, value, generations):
+        self._call("set", key, value, generations)
+
+    def invalidate(self, entities):
+        if entities:
+            self._call("invalidate", entities)
+
+    def serialize(self):
+        return {
+            "backend": type(self.backend).__name__ if self.backend is not None else None,
+            "entries": self._call("__len__"),
+            "size": self._call("size"),
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "api", "responses.sqlite")
+
+
+def create_backend():
+    backend = os.getenv("CACHE_BACKEND", "none")
+    if backend == "none":
+        return None
+    if backend == "memory":
+        return MemoryCache()
+    if backend == "sqlite":
+        return SQLiteCache(os.getenv("CACHE_PATH", DEFAULT_CACHE_PATH))
+    raise ValueError("CACHE_BACKEND must be one of none, memory, sqlite")
+
+
+response_cache = ResponseCache(create_backend())
+
+
+def cached(*entities):
+    """
+    Decorator for GET handlers: serve the response from the cache while none of the
+    entities it is built from changed. Only 200 responses are stored
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # A profiled request (see profiler.py) must run the handler
+            if g.get("profiling") is not None:
+                return view(*args, **kwargs)
+            key = request.full_path
+            value = response_cache.get(key, entities)
+            if value is not None:
+                body, status, mimetype = value
+                return Response(body, status=status, mimetype=mimetype)
+
+            # Read the generations before the data, a write committed meanwhile makes
+            # the entry stale instead of hiding the write
+            generations = response_cache.generations(entities)
+            response = current_app.make_response(view(*args, **kwargs))
+            if generations is not None and response.status_code == 200:
+                response_cache.set(key, (response.get_data(), response.status_code, response.mimetype), generations)
+            return response
+        return wrapper
+    return decorator
+
+
+def benchmark(backend_factory, workers=4, requests=2000, keys=200, payload_size=20000, compute_time=0.002,
+              shared=False):
+    """
+    Run worker processes reading hot keys (the low ones more often) through a cache
+    and return the totals: hits, computations, seconds, entries and bytes held.
+    A shared backend is counted once, not once per worker
+    """
+    import multiprocessing
+    import random
+
+    def worker(results, seed):
+        cache = backend_factory()
+        rng = random.Random(seed)
+        hits = 0
+        start = time.perf_counter()
+        for _ in range(requests):
+            key = f"/planets/{int(rng.paretovariate(1.2)) % keys}"
+            if cache.get(key, ENTITIES) is not None:
+                hits += 1
+                continue
+            generations = cache.generations(ENTITIES)
+            time.sleep(compute_time)
+            cache.set(key, (b"x" * payload_size, 200, "application/json"), generations)
+        results.put((hits, time.perf_counter() - start, len(cache), cache.size()))
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(results, seed)) for seed in range(workers)]
+    for process in processes:
+        process.start()
+    totals = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    hits = sum(total[0] for total in totals)
+    held = max if shared else sum
+    return {
+        "requests": workers * requests,
+        "hits": hits,
+        "hit_rate": round(hits / (workers * requests), 3),
+        "computations": workers * requests - hits,
+        "seconds": round(max(total[1] for total in totals), 2),
+        "entries": held(total[2] for total in totals),
+        "bytes": held(total[3] for total in totals),
+    }
@@ -0,0 +1,168 @@
+"""
+Change feed for clients that mirror the catalog.
+
+The write handlers in app.py append one row per changed entity to the Changes table in
+the same transaction as the change. GET /changes?since=<cursor> then returns only what
+changed after the cursor, so a sync costs time proportional to the changes.
+`flask compact-changes` drops the entries superseded by a later change of the same
+entity, which never loses information for a client.
+
+The cursor is the Id of the change, so a change must never become visible below a
+cursor a client already read past. An autoincrement id is taken at INSERT time, not
+at commit: a transaction holding id N can commit after one holding N+1 was read. So
+the handlers only collect their changes in the session, and they are inserted when the
+transaction commits, as its very last statements: the transaction locks the single
+row of the ChangeLock table (an UPDATE, on every database), inserts its changes and
+commits, which releases the lock. The changes take their ids one transaction after
+the other, and a change is visible before any change with a greater Id. The guarantee
+for clients: every committed change has an Id greater than the cursors read before it
+committed, so following next_cursor never misses one. The ids can still have gaps,
+from rolled back transactions and compaction.
+
+Only the commits are serialized, not the transactions: the lock is held from the
+INSERT of the changes to the commit. Every transaction takes its locks in the same
+order, its catalog rows while the handler runs, then the Stats rows (see stats.py),
+then the ChangeLock, and holding the ChangeLock it waits for nothing else, so it can't
+be part of a deadlock.
+"""
+import datetime
+from sqlalchemy import select, insert, update, delete, event, cast, String, func
+from models import db, Change, ChangeLock, ChangeActionEnum, User, Character, Planet, Character_Favorite, Planet_Favorite
+
+ENTITIES = {
+    User: "user",
+    Character: "character",
+    Planet: "planet",
+    Character_Favorite: "character_favorite",
+    Planet_Favorite: "planet_favorite",
+}
+
+# Largest page of changes returned at once, and the default one
+MAX_CHANGES_PAGE = 1000
+DEFAULT_CHANGES_PAGE = 500
+
+
+def favorite_id(user_id, target_id):
+    return f"{user_id}:{target_id}"
+
+
+def record_changed(model):
+    """
+    Remember the entity changed by the transaction, for the invalidations after the commit (see cache.py)
+    """
+    db.session.info.setdefault("changed_entities", set()).add(ENTITIES[model])
+
+
+def pending_changes():
+    # In a transaction, even without a statement yet, so that its rollback drops them
+    if not db.session().in_transaction():
+        db.session.begin()
+    return db.session.info.setdefault("pending_changes", [])
+
+
+def log_change(model, entity_id, action):
+    """
+    Append a change of a single entity when the transaction commits
+    """
+    record_changed(model)
+    pending_changes().append({
+        "Entity": ENTITIES[model], "EntityId": str(entity_id), "Action": action,
+        "CreatedAt": datetime.datetime.now()})
+
+
+def log_changes_from(model, entity_ids, action):
+    """
+    Append a change for every entity id returned by a SELECT when the transaction
+    commits. The SELECT runs now, e.g. before the DELETE of the rows
+    """
+    record_changed(model)
+    now = datetime.datetime.now()
+    pending_changes().extend(
+        {"Entity": ENTITIES[model], "EntityId": str(entity_id), "Action": action, "CreatedAt": now}
+        for entity_id in db.session.execute(entity_ids).scalars())
+
+
+@event.listens_for(db.session, "before_commit")
+def write_change_log(session):
+    """
+    Lock the ChangeLock row and insert the changes of the transaction, as its last
+    statements, so the changes of concurrent transactions are numbered in commit order
+    """
+    session.flush()
+    changes = session.info.pop("pending_changes", None)
+    if not changes:
+        return
+    session.execute(
+        update(ChangeLock).where(ChangeLock.Id == 1)
+        .values(Transactions=ChangeLock.Transactions + 1)
+        .execution_options(synchronize_session=False))
+    session.execute(insert(Change.__table__), changes)
+
+
+@event.listens_for(db.session, "after_commit")
+@event.listens_for(db.session, "after_soft_rollback")
+def forget_changes(session, previous_transaction=None):
+    session.info.pop("pending_changes", None)
+
+
+# Favorites removed by the database cascade when rows of a model are deleted:
+# (favorite model, column pointing to the deleted row, column pointing to the favorite target)
+CASCADED_FAVORITES = {
+    User: ((Character_Favorite, "UserId", "CharacterId"), (Planet_Favorite, "UserId", "PlanetId")),
+    Character: ((Character_Favorite, "CharacterId", "CharacterId"),),
+    Planet: ((Planet_Favorite, "PlanetId", "PlanetId"),),
+}
+
+
+def log_deleted(model, ids):
+    """
+    Log the deletion of the rows that exist among ids, must run before the DELETE.
+    The favorites removed by the database cascade are logged too
+    """
+    log_changes_from(model, select(model.Id).where(model.Id.in_(ids)), ChangeActionEnum.DELETE)
+
+    for favorite_model, owner_column, target_column in CASCADED_FAVORITES[model]:
+        table = favorite_model.__table__
+        log_changes_from(
+            favorite_model,
+            select(cast(table.c.UserId, String) + ":" + cast(table.c[target_column], String))
+            .where(table.c[owner_column].in_(ids)),
+            ChangeActionEnum.DELETE)
+
+    # Deleting a planet leaves its residents without home world
+    if model is Planet:
+        log_changes_from(
+            Character, select(Character.Id).where(Character.HomeWorldId.in_(ids)),
+            ChangeActionEnum.UPSERT)
+
+
+def get_changes(since, limit):
+    """
+    Read the changes after a cursor, oldest first
+    """
+    changes = db.session.execute(
+        select(Change).where(Change.Id > since).order_by(Change.Id).limit(limit + 1)
+    ).scalars().all()
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return {
+        "changes": [change.serialize() for change in changes],
+        "next_cursor": changes[-1].Id if changes else since,
+        "has_more": has_more,
+    }
+
+
+def compact_changes(before=None):
+    """
+    Delete the changes superseded by a later change of the same entity, optionally only
+    the ones older than a datetime. Returns the number of deleted entries
+    """
+    latest = (
+        select(func.max(Change.Id).label("Id"))
+        .group_by(Change.Entity, Change.EntityId)
+    )
+    query = delete(Change).where(Change.Id.not_in(latest))
+    if before is not None:
+        query = query.where(Change.CreatedAt < before)
+    return db.session.execute(query.execution_options(synchronize_session=False)).rowcount
@@ -0,0 +1,175 @@
+"""
+Streaming NDJSON export and import of the whole dataset, used by `flask export` and
+`flask import` for backups and environment clones.
+
+Every line is one row: {"table": "Users", "row": {"Id": 1, ...}}. Tables are written
+in dependency order so an import never references a row that isn't there yet.
+Exports read through a server-side cursor in chunks and imports insert in batches,
+so memory use doesn't grow with the size of the tables.
+
+An import checkpoint is created when the import starts and updated after each batch
+is committed, so a crash between the two leaves a batch in the database that the
+checkpoint doesn't count. An import resumed from a checkpoint therefore inserts with
+the conflicts on the primary keys ignored, and the rows already there are skipped. A fresh import still fails on an id that already exists.
+"""
+import datetime
+import enum
+import json
+import os
+from sqlalchemy import select, insert, func, text, Enum, Date, DateTime
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, User, Planet, Character, Weight, Character_Favorite, Planet_Favorite
+
+# Parents before children: characters point to planets, weights to characters, ...
+EXPORT_ORDER = (User, Planet, Character, Weight, Character_Favorite, Planet_Favorite)
+TABLES = {model.__tablename__: model.__table__ for model in EXPORT_ORDER}
+
+# Rows fetched per round trip from the server-side cursor on export
+EXPORT_CHUNK_SIZE = 1000
+# Rows inserted per statement (and per commit) on import
+IMPORT_BATCH_SIZE = 1000
+
+
+def encode_value(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def decode_value(column, value):
+    if value is None:
+        return None
+    if isinstance(column.type, Enum) and column.type.enum_class is not None:
+        return column.type.enum_class(value)
+    if isinstance(column.type, DateTime):
+        return datetime.datetime.fromisoformat(value)
+    if isinstance(column.type, Date):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+def export_dataset(output, progress=None):
+    """
+    Write every table to a text stream as NDJSON. Returns the row count per table.
+    progress(rows) is called with the number of rows written after every table, once
+    its cursor is closed
+    """
+    counts = {}
+    for model in EXPORT_ORDER:
+        table = model.__table__
+        result = db.session.execute(
+            select(table).order_by(*table.primary_key.columns)
+            .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        )
+        counts[table.name] = 0
+        for chunk in result.partitions():
+            output.write("".join(
+                json.dumps({
+                    "table": table.name,
+                    "row": {key: encode_value(value) for key, value in row._mapping.items()},
+                }) + "\n"
+                for row in chunk
+            ))
+            counts[table.name] += len(chunk)
+        if progress:
+            progress(sum(counts.values()))
+    return counts
+
+
+def read_checkpoint(path):
+    """
+    Number of lines already imported according to a checkpoint file, 0 without one
+    """
+    try:
+        with open(path) as checkpoint:
+            return int(checkpoint.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, line_number):
+    with open(path, "w") as checkpoint:
+        checkpoint.write(str(line_number))
+
+
+def insert_ignoring_conflicts(table):
+    """
+    INSERT skipping the rows whose primary key already exists
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        return dialect_insert(table).on_conflict_do_nothing()
+    if dialect == "mysql":
+        return insert(table).prefix_with("IGNORE")
+    return insert(table)
+
+
+def import_dataset(input, checkpoint_path=None, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    """
+    Insert the NDJSON rows of a text stream in batches, committing each batch.
+    With a checkpoint file, the number of imported lines is saved after every commit
+    and a later run resumes after them, skipping the rows already there.
+    progress(line_number) is called after every commit too. Returns the row count per
+    table
+    """
+    resumed = checkpoint_path is not None and os.path.exists(checkpoint_path)
+    start_after = read_checkpoint(checkpoint_path) if resumed else 0
+    if checkpoint_path and not resumed:
+        # Written before the first batch, a run crashing after it is a resumed one too
+        write_checkpoint(checkpoint_path, 0)
+    # The batch after the checkpoint may have been committed already
+    make_insert = insert_ignoring_conflicts if resumed else insert
+    counts = {}
+    batch, batch_table = [], None
+    # Line number of the last row added to the batch
+    batch_last_line = start_after
+
+    def flush():
+        if not batch:
+            return
+        db.session.execute(make_insert(TABLES[batch_table]), batch)
+        db.session.commit()
+        counts[batch_table] = counts.get(batch_table, 0) + len(batch)
+        batch.clear()
+        if checkpoint_path:
+            write_checkpoint(checkpoint_path, batch_last_line)
+        if progress:
+            progress(batch_last_line)
+
+    for line_number, line in enumerate(input, start=1):
+        if line_number <= start_after or not line.strip():
+            continue
+
+        record = json.loads(line)
+        table = TABLES[record["table"]]
+        # A batch only ever holds rows of one table
+        if record["table"] != batch_table or len(batch) >= batch_size:
+            flush()
+            batch_table = record["table"]
+
+        batch.append({key: decode_value(table.c[key], value)
+                      for key, value in record["row"].items()})
+        batch_last_line = line_number
+
+    flush()
+    reset_sequences()
+    return counts
+
+
+def reset_sequences():
+    """
+    Move the Postgres id sequences past the imported ids, so new rows don't collide
+    """
+    if db.session.get_bind().dialect.name != "postgresql":
+        return
+    for model in (User, Planet, Character):
+        table = model.__tablename__
+        max_id = db.session.execute(select(func.max(model.Id))).scalar()
+        if max_id:
+            db.session.execute(
+                text("SELECT setval(pg_get_serial_sequence(:table, 'Id'), :max_id)"),
+                {"table": f'"{table}"', "max_id": max_id})
+    db.session.commit()
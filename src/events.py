@@ -0,0 +1,215 @@
+"""
+Live events for the Server-Sent Events stream (GET /events).
+
+Each worker runs one Broker. A single background thread per worker tails the Changes
+table (see changes.py) and publishes every new change to the broker, which fans it out
+to the in-memory queue of each matching subscriber. Subscribers never touch the
+database, so a thousand open streams still cost one connection per worker, and changes
+made by other workers or nodes reach every stream.
+
+Each subscriber queue is bounded: a client too slow to keep up is sent an "overflow"
+event and disconnected, and it resyncs with /changes?since=<last event id>. Idle streams
+get a heartbeat comment so proxies don't close them.
+
+Every open stream holds a worker thread, so the app is served by threaded workers
+(gunicorn --worker-class gthread --threads 32, see the Procfile). A worker accepts
+EVENTS_MAX_SUBSCRIBERS streams (16 by default), which leaves the other threads to the
+requests. With more threads, raise both together.
+
+A poller started on the first subscription reads its starting cursor before the stream
+replays what the client missed, so a change committed in between is in one or the other
+(the stream skips what it already replayed). A poller restarted after a failure goes on
+from the cursor of the previous one.
+
+The broker can be fed directly with Broker.publish(), which is how it's tested without
+a database or any external service.
+"""
+import json
+import os
+import queue
+import threading
+from sqlalchemy import select, func
+from models import db, Change
+from changes import ENTITIES, MAX_CHANGES_PAGE, get_changes
+
+# Seconds between two polls of the Changes table
+POLL_INTERVAL = 1.0
+# Seconds without events before a heartbeat comment is sent
+HEARTBEAT_INTERVAL = 15.0
+# Events buffered per subscriber before it's considered too slow and dropped
+MAX_QUEUED_EVENTS = 1000
+# Open streams allowed per worker, each one holds a thread of the worker
+MAX_SUBSCRIBERS = int(os.getenv("EVENTS_MAX_SUBSCRIBERS", "16"))
+# Seconds a new stream waits for the poller to read its starting cursor
+POLLER_START_TIMEOUT = 5.0
+# Delay before browsers reconnect a dropped stream
+RETRY_MILLISECONDS = 3000
+
+EVENT_ENTITIES = tuple(ENTITIES.values())
+
+
+class Subscription:
+    """
+    Queue of the events a client is interested in, filtered by entity and user
+    """
+
+    def __init__(self, entities=None, user_id=None, max_queued=MAX_QUEUED_EVENTS):
+        self.entities = frozenset(entities) if entities else None
+        self.user_id = str(user_id) if user_id is not None else None
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.overflowed = False
+
+    def matches(self, event):
+        if self.entities is not None and event["entity"] not in self.entities:
+            return False
+        if self.user_id is not None:
+            # Only the user itself and its favorites ("UserId:TargetId")
+            if event["entity"] == "user":
+                return event["id"] == self.user_id
+            return event["id"].split(":")[0] == self.user_id and ":" in event["id"]
+        return True
+
+    def push(self, event):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+
+class Broker:
+    """
+    In-process fan-out of events to subscribers
+    """
+
+    def __init__(self, max_subscribers=MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, entities=None, user_id=None):
+        """
+        Register a new subscription, or return None when the worker is full
+        """
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscription = Subscription(entities, user_id)
+            self._subscribers.add(subscription)
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            if subscription.matches(event):
+                subscription.push(event)
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+
+class ChangePoller(threading.Thread):
+    """
+    Background thread tailing the Changes table and publishing new entries to a broker
+    """
+
+    def __init__(self, app, broker, interval=POLL_INTERVAL, cursor=None):
+        super().__init__(name="change-poller", daemon=True)
+        self.app = app
+        self.broker = broker
+        self.interval = interval
+        # Last change published, the latest one in the table when None
+        self.cursor = cursor
+        # Set once the starting cursor is read, the changes committed after it are published
+        self.ready = threading.Event()
+        self._stopping = threading.Event()
+
+    def run(self):
+        with self.app.app_context():
+            if self.cursor is None:
+                self.cursor = db.session.execute(select(func.max(Change.Id))).scalar() or 0
+                db.session.remove()
+            self.ready.set()
+            while not self._stopping.is_set():
+                has_more = False
+                try:
+                    page = get_changes(self.cursor, MAX_CHANGES_PAGE)
+                    for event in page["changes"]:
+                        self.broker.publish(event)
+                        self.cursor = event["cursor"]
+                    has_more = page["has_more"]
+                except Exception as e:
+                    self.app.logger.warning(f"Change poller failed: {e}")
+                finally:
+                    # Give the connection back to the pool between polls
+                    db.session.remove()
+                if not has_more:
+                    self._stopping.wait(self.interval)
+
+    def stop(self):
+        self._stopping.set()
+
+
+broker = Broker()
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def ensure_poller(app):
+    """
+    Start the change poller of this worker on the first subscription, or again from
+    where it stopped, and wait for its starting cursor. Call it before reading the
+    changes to replay. Returns False if the poller isn't ready in time
+    """
+    global _poller
+    with _poller_lock:
+        if _poller is None or not _poller.is_alive():
+            _poller = ChangePoller(app, broker, cursor=_poller.cursor if _poller is not None else None)
+            _poller.start()
+        poller = _poller
+    return poller.ready.wait(POLLER_START_TIMEOUT)
+
+
+def format_event(event):
+    """
+    Encode an event in the text/event-stream format, with the change cursor as its id
+    so clients can resume with Last-Event-ID
+    """
+    return f"id: {event['cursor']}\nevent: {event['action']}\ndata: {json.dumps(event)}\n\n"
+
+
+def stream_events(subscription, replay=(), heartbeat=HEARTBEAT_INTERVAL):
+    """
+    Generator of the text/event-stream body of a subscription. The replayed events
+    (missed since Last-Event-ID) go first, live events already replayed are skipped
+    """
+    last_cursor = 0
+    try:
+        # Sent right away so the headers are flushed, it also sets the reconnection delay
+        yield f"retry: {RETRY_MILLISECONDS}\n\n"
+
+        for event in replay:
+            if subscription.matches(event):
+                yield format_event(event)
+            last_cursor = event["cursor"]
+
+        while True:
+            if subscription.overflowed:
+                yield "event: overflow\ndata: {}\n\n"
+                return
+            try:
+                event = subscription.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            if event["cursor"] > last_cursor:
+                yield format_event(event)
+    finally:
+        broker.unsubscribe(subscription)
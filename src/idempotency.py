@@ -0,0 +1,173 @@
+"""
+Idempotency keys for the POST endpoints.
+
+A client retrying a POST on a flaky network sends the same Idempotency-Key header
+(a UUID it generated) with every attempt. The first attempt runs the handler, and its
+response (status, body, Content-Type and Location) is stored in the IdempotencyKeys
+table for IDEMPOTENCY_TTL seconds, a day by default. The retries get that response
+back, with an Idempotent-Replayed: true header, without running the handler again.
+
+- Keys are scoped by client (JWT identity) and route, and tied to the body of the
+  first request: the same key with another body is a 422.
+- The row is inserted before the handler runs, so it's also the lock: a duplicate
+  arriving meanwhile, on any worker or node, waits up to WAIT_TIMEOUT seconds for the
+  response and then gets a 409 telling it to retry. A lock older than LOCK_TIMEOUT
+  was left by a dead worker and is taken over.
+- 5xx responses and unhandled errors aren't stored, the row is dropped so a retry
+  runs the handler again.
+
+Requests without the header work as before. The rows are read and written on their
+own connection, outside the session of the handler. `flask purge-idempotency-keys`
+deletes the expired ones.
+"""
+import datetime
+import functools
+import hashlib
+import os
+import time
+from flask import current_app, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from sqlalchemy import and_, or_, select, insert, update, delete
+from sqlalchemy.exc import IntegrityError
+from models import db, IdempotencyKey
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", str(24 * 3600)))
+MAX_KEY_LENGTH = 255
+# Seconds a duplicate waits for the response of the request holding its key
+WAIT_TIMEOUT = 10.0
+WAIT_INTERVAL = 0.05
+# Seconds after which a key still without response is considered abandoned
+LOCK_TIMEOUT = 60.0
+# Stored with the body, the other headers are rebuilt by the app on replay
+REPLAYED_HEADERS = ("Content-Type", "Location")
+
+KEYS = IdempotencyKey.__table__
+
+
+def client_identity():
+    """
+    JWT identity of the request, "" when it has none. Never fails
+    """
+    try:
+        verify_jwt_in_request(optional=True)
+    except Exception:
+        return ""
+    return get_jwt_identity() or ""
+
+
+def key_filter(scope):
+    key, user_id, endpoint = scope
+    return and_(KEYS.c.Key == key, KEYS.c.UserId == user_id, KEYS.c.Endpoint == endpoint)
+
+
+def acquire(scope, fingerprint):
+    """
+    Take a key for this request. Returns (True, None) when it got it and must run the
+    handler, else (False, row) with the row of the request holding it, None if that
+    row just disappeared
+    """
+    now = datetime.datetime.now()
+    values = {"Fingerprint": fingerprint, "Status": None, "Body": None, "Headers": None,
+              "LockedAt": now, "ExpiresAt": now + datetime.timedelta(seconds=IDEMPOTENCY_TTL)}
+    where = key_filter(scope)
+    # Expired, or never answered by a request that died
+    reusable = or_(KEYS.c.ExpiresAt < now, and_(
+        KEYS.c.Status.is_(None), KEYS.c.LockedAt < now - datetime.timedelta(seconds=LOCK_TIMEOUT)))
+
+    with db.engine.begin() as connection:
+        row = connection.execute(select(KEYS, reusable.label("reusable")).where(where)).first()
+        if row is not None and not row.reusable:
+            return False, row
+        if row is not None:
+            # The condition is checked again by the UPDATE, only one request takes it over
+            if connection.execute(update(KEYS).where(where, reusable).values(**values)).rowcount:
+                return True, None
+            return False, connection.execute(select(KEYS).where(where)).first()
+
+    key, user_id, endpoint = scope
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(insert(KEYS).values(Key=key, UserId=user_id, Endpoint=endpoint, **values))
+        return True, None
+    except IntegrityError:
+        # A duplicate inserted it first
+        with db.engine.connect() as connection:
+            return False, connection.execute(select(KEYS).where(where)).first()
+
+
+def store(scope, response):
+    headers = {name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers}
+    with db.engine.begin() as connection:
+        connection.execute(
+            update(KEYS).where(key_filter(scope))
+            .values(Status=response.status_code, Body=response.get_data(), Headers=headers))
+
+
+def release(scope):
+    with db.engine.begin() as connection:
+        connection.execute(delete(KEYS).where(key_filter(scope), KEYS.c.Status.is_(None)))
+
+
+def replay(row):
+    response = current_app.response_class(row.Body, status=row.Status, headers=row.Headers)
+    response.headers["Idempotent-Replayed"] = "true"
+    return response
+
+
+def run_once(view, scope, args, kwargs):
+    """
+    Run the handler holding the key, and store its response
+    """
+    try:
+        response = make_response(view(*args, **kwargs))
+    except Exception as e:
+        try:
+            # The errors with a handler (like APIException) are responses worth storing
+            response = make_response(current_app.handle_user_exception(e))
+        except Exception:
+            release(scope)
+            raise
+    if response.status_code >= 500:
+        release(scope)
+    else:
+        store(scope, response)
+    return response
+
+
+def idempotent(view):
+    """
+    Decorator for the POST routes: honour the Idempotency-Key header.
+    Goes below jwt_required(), so the identity is checked first
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return view(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({"message": f"Idempotency-Key must have 1 to {MAX_KEY_LENGTH} characters"}), 400
+
+        scope = (key, client_identity(), f"{request.method} {request.path}")
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while True:
+            acquired, row = acquire(scope, fingerprint)
+            if acquired:
+                return run_once(view, scope, args, kwargs)
+            if row is not None and row.Fingerprint != fingerprint:
+                return jsonify({"message": "Idempotency-Key already used for another request"}), 422
+            if row is not None and row.Status is not None:
+                return replay(row)
+            if time.monotonic() >= deadline:
+                return jsonify({"message": "A request with this Idempotency-Key is in progress, retry later"}), \
+                    409, {"Retry-After": "1"}
+            time.sleep(WAIT_INTERVAL)
+    return wrapper
+
+
+def purge_expired_keys():
+    """
+    Delete the expired keys, returns their number
+    """
+    with db.engine.begin() as connection:
+        return connection.execute(delete(KEYS).where(KEYS.c.ExpiresAt < datetime.datetime.now())).rowcount
@@ -0,0 +1,186 @@
+"""
+Compound documents: embed related resources in a response with ?include=.
+
+    GET /planets/1?include=characters,characters.weight,users_favorites
+
+Every relationship is loaded with one query per level for all the parents at once,
+and a ROW_NUMBER() window caps the rows kept per parent, so a planet with thousands
+of residents can't blow up the response. With ?include=, the row itself is serialized
+from its columns only (serialize_summary()): its related rows are the capped ones
+under "included", never its full collections. Without ?include=, the favorites lists
+of a user are capped the same way.
+"""
+from collections import namedtuple
+from sqlalchemy import select, func, inspect
+from sqlalchemy.orm import aliased
+from utils import APIException
+from models import db, User, Character, Planet, Weight, Character_Favorite, Planet_Favorite
+
+# How deep includes can be nested, e.g. "characters.weight" has depth 2
+MAX_INCLUDE_DEPTH = 2
+# Largest number of related rows embedded per parent and relationship
+MAX_INCLUDE_ITEMS = 50
+
+# target: related model
+# parent_column: column holding the id of the parent the related row belongs to
+# join: (model, onclause) to reach parent_column, None when it's on the target
+# many: embed a list, otherwise a single object (or None)
+Include = namedtuple("Include", ["target", "parent_column", "join", "many"])
+
+INCLUDES = {
+    User: {
+        "characters_favorites": Include(
+            Character, Character_Favorite.UserId,
+            (Character_Favorite, Character_Favorite.CharacterId == Character.Id), True),
+        "planets_favorites": Include(
+            Planet, Planet_Favorite.UserId,
+            (Planet_Favorite, Planet_Favorite.PlanetId == Planet.Id), True),
+    },
+    Character: {
+        "weight": Include(Weight, Weight.CharacterId, None, False),
+        "home_world": Include(
+            Planet, Character.Id,
+            (Character, Character.HomeWorldId == Planet.Id), False),
+        "users_favorites": Include(
+            User, Character_Favorite.CharacterId,
+            (Character_Favorite, Character_Favorite.UserId == User.Id), True),
+    },
+    Planet: {
+        "characters": Include(Character, Character.HomeWorldId, None, True),
+        "users_favorites": Include(
+            User, Planet_Favorite.PlanetId,
+            (Planet_Favorite, Planet_Favorite.UserId == User.Id), True),
+    },
+    Weight: {},
+}
+
+
+# Collections of serialize() capped like the includes when the row is read alone
+CAPPED_COLLECTIONS = {
+    User: ("characters_favorites", "planets_favorites"),
+}
+
+
+def parse_includes(model, include_arg):
+    """
+    Turn "characters,characters.weight" into the tree {"characters": {"weight": {}}},
+    validating every name against the relationships of the model
+    """
+    tree = {}
+    for path in filter(None, (path.strip() for path in include_arg.split(','))):
+        names = path.split('.')
+        if len(names) > MAX_INCLUDE_DEPTH:
+            raise APIException(
+                f"Includes can be nested at most {MAX_INCLUDE_DEPTH} levels", status_code=400)
+
+        node, node_model = tree, model
+        for name in names:
+            if name not in INCLUDES[node_model]:
+                raise APIException(f"Invalid include: {path}", status_code=400,
+                                   payload={"includes": list(INCLUDES[node_model])})
+            node = node.setdefault(name, {})
+            node_model = INCLUDES[node_model][name].target
+    return tree
+
+
+def load_related(include, parent_ids):
+    """
+    Load the related rows of many parents in one query, keeping at most
+    MAX_INCLUDE_ITEMS + 1 per parent (the extra one tells the list was truncated).
+    Returns {parent_id: [rows]}
+    """
+    target_key = inspect(include.target).primary_key[0]
+    row_number = func.row_number().over(
+        partition_by=include.parent_column, order_by=target_key)
+
+    query = select(include.target, include.parent_column.label("parent_id"),
+                   row_number.label("row_number"))
+    if include.join is not None:
+        query = query.join(*include.join)
+    ranked = query.where(include.parent_column.in_(parent_ids)).subquery()
+
+    entity = aliased(include.target, ranked)
+    rows = db.session.execute(
+        select(ranked.c.parent_id, entity)
+        .where(ranked.c.row_number <= MAX_INCLUDE_ITEMS + 1)
+        .order_by(ranked.c.parent_id, ranked.c.row_number)
+    )
+
+    related = {}
+    for parent_id, row in rows:
+        related.setdefault(parent_id, []).append(row)
+    return related
+
+
+def embed_includes(model, parents, tree, prefix="", truncated=None):
+    """
+    Load the includes of a tree for a list of (parent id, serialized dict) pairs and
+    add them to the dicts. Returns the include paths that were cut at MAX_INCLUDE_ITEMS
+    """
+    truncated = [] if truncated is None else truncated
+    parent_ids = [parent_id for parent_id, _ in parents]
+
+    for name, subtree in tree.items():
+        include = INCLUDES[model][name]
+        related = load_related(include, parent_ids) if parent_ids else {}
+        target_key = inspect(include.target).primary_key[0].key
+
+        children = []
+        for parent_id, serialized in parents:
+            rows = related.get(parent_id, [])
+            if len(rows) > MAX_INCLUDE_ITEMS:
+                rows = rows[:MAX_INCLUDE_ITEMS]
+                if prefix + name not in truncated:
+                    truncated.append(prefix + name)
+
+            embedded = [(getattr(row, target_key), row.serialize_summary()) for row in rows]
+            children.extend(embedded)
+            if include.many:
+                serialized[name] = [child for _, child in embedded]
+            else:
+                serialized[name] = embedded[0][1] if embedded else None
+
+        if subtree:
+            embed_includes(include.target, children, subtree,
+                           prefix + name + ".", truncated)
+    return truncated
+
+
+def serialize_capped(model, row):
+    """
+    row.serialize() with its favorites lists loaded like the includes, at most
+    MAX_INCLUDE_ITEMS by increasing id. The cut lists are named in "favorites_truncated",
+    the favorites endpoints page through them whole
+    """
+    favorites, truncated = {}, []
+    for name in CAPPED_COLLECTIONS[model]:
+        rows = load_related(INCLUDES[model][name], [row.Id]).get(row.Id, [])
+        if len(rows) > MAX_INCLUDE_ITEMS:
+            rows = rows[:MAX_INCLUDE_ITEMS]
+            truncated.append(name)
+        favorites[name] = rows
+
+    serialized = row.serialize(**favorites)
+    if truncated:
+        serialized["favorites_truncated"] = truncated
+    return serialized
+
+
+def serialize_with_includes(model, row, include_arg):
+    """
+    Serialize a row and, when ?include= is given, embed the requested related resources
+    under "included". The row is then serialized without its collections, which
+    serialize() would load whole
+    """
+    if not include_arg:
+        return serialize_capped(model, row) if model in CAPPED_COLLECTIONS else row.serialize()
+
+    tree = parse_includes(model, include_arg)
+    serialized = row.serialize_summary()
+    included = {}
+    truncated = embed_includes(model, [(row.Id, included)], tree)
+
+    serialized["included"] = included
+    if truncated:
+        serialized["included_truncated"] = truncated
+    return serialized
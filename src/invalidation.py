@@ -0,0 +1,260 @@
+"""
+Cache invalidation bus between the nodes running the API.
+
+The response cache (see cache.py) is shared by the workers of one host only. After a
+commit, the entities it wrote are invalidated in the local cache and published on the
+bus; every other node receives the message and invalidates them in its own cache.
+
+Backends:
+- PostgresBus, the default on Postgres: NOTIFY on the "cache_invalidation" channel,
+  sent after the commit on a dedicated connection, and a LISTEN thread per worker.
+- LoopbackBus, the default otherwise: delivers in process to the buses of the same
+  network, which is enough for a single node and lets several nodes be simulated in a
+  test. INVALIDATION_BUS=postgres|loopback overrides the choice.
+
+Messages can be lost: a NOTIFY failing after a commit, a listener disconnected while
+other nodes write. Each message carries the id of the publishing process and a
+sequence number, so a receiver that sees a gap in the sequence of a node flushes its
+whole cache. A listener connecting doesn't flush: a worker starting would empty the
+cache of the whole host. After a reconnect, what was missed meanwhile shows up as a gap
+in the next message of each node; the changes of a node that stays silent afterwards
+are only dropped by the cache TTL.
+"""
+import abc
+import itertools
+import json
+import logging
+import os
+import select
+import threading
+import time
+import uuid
+from sqlalchemy import event
+from models import db
+from cache import ENTITIES, response_cache
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "cache_invalidation"
+# Seconds between two checks that the listening connection is still alive
+LISTEN_TIMEOUT = 5.0
+# Delays before reconnecting the listener, doubled after every failure
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+
+
+class InvalidationBus(abc.ABC):
+    """
+    Sequencing, gap detection and delivery shared by the backends
+    """
+
+    def __init__(self):
+        self.node_id = uuid.uuid4().hex
+        self._sequence = itertools.count(1)
+        self._last_sequences = {}
+        self._handlers = []
+        self._lock = threading.Lock()
+        self.published = 0
+        self.received = 0
+        self.gaps = 0
+        self.flushes = 0
+        self.errors = 0
+
+    def subscribe(self, handler):
+        """
+        Register handler(entities), called with every entity of ENTITIES on a flush
+        """
+        self._handlers.append(handler)
+
+    def publish(self, entities):
+        # Sequence numbers are taken and sent under the lock, so they go out in order
+        with self._lock:
+            message = {"node": self.node_id, "seq": next(self._sequence), "entities": sorted(entities)}
+            try:
+                self.send(message)
+                self.published += 1
+            except Exception as e:
+                # The receivers will notice the missing sequence number and flush
+                self.errors += 1
+                logger.warning(f"Publishing the invalidation of {message['entities']} failed: {e}")
+
+    @abc.abstractmethod
+    def send(self, message):
+        """
+        Deliver message to the buses of the other nodes
+        """
+
+    def receive(self, message):
+        if message["node"] == self.node_id:
+            return
+        self.received += 1
+        last = self._last_sequences.get(message["node"])
+        self._last_sequences[message["node"]] = max(message["seq"], last or 0)
+        if last is not None and message["seq"] > last + 1:
+            self.gaps += 1
+            self.flush()
+        else:
+            self.deliver(message["entities"])
+
+    def flush(self):
+        self.flushes += 1
+        self.deliver(ENTITIES)
+
+    def deliver(self, entities):
+        for handler in self._handlers:
+            handler(entities)
+
+    def start(self):
+        pass
+
+    def serialize(self):
+        return {
+            "backend": type(self).__name__,
+            "published": self.published,
+            "received": self.received,
+            "gaps": self.gaps,
+            "flushes": self.flushes,
+            "errors": self.errors,
+        }
+
+
+class LoopbackBus(InvalidationBus):
+    """
+    In-process bus: a message goes to every bus of the same network (a list)
+    """
+
+    def __init__(self, network=None):
+        super().__init__()
+        self.network = network if network is not None else []
+        self.network.append(self)
+
+    def send(self, message):
+        # Encoded like on the wire, the receivers never share the sender's objects
+        payload = json.dumps(message)
+        for bus in list(self.network):
+            bus.receive(json.loads(payload))
+
+
+class PostgresBus(InvalidationBus):
+    """
+    LISTEN/NOTIFY bus, with its own two connections outside the SQLAlchemy pool
+    """
+
+    def __init__(self, dsn):
+        super().__init__()
+        self.dsn = dsn
+        self._publisher = None
+        self._listener = None
+        self.reconnects = 0
+
+    def _connect(self):
+        import psycopg2
+        connection = psycopg2.connect(self.dsn)
+        connection.autocommit = True
+        return connection
+
+    def send(self, message):
+        payload = json.dumps(message)
+        for attempt in range(2):
+            try:
+                if self._publisher is None or self._publisher.closed:
+                    self._publisher = self._connect()
+                with self._publisher.cursor() as cursor:
+                    cursor.execute("SELECT pg_notify(%s, %s)", (CHANNEL, payload))
+                return
+            except Exception:
+                # Retry once on a new connection, the old one may have been dropped
+                if self._publisher is not None:
+                    self._publisher.close()
+                self._publisher = None
+                if attempt:
+                    raise
+
+    def start(self):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name="invalidation-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        delay = RECONNECT_DELAY
+        while True:
+            connection = None
+            try:
+                connection = self._connect()
+                with connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+                delay = RECONNECT_DELAY
+                while True:
+                    readable, _, _ = select.select([connection], [], [], LISTEN_TIMEOUT)
+                    if not readable:
+                        # Nothing for a while, make sure the connection is still alive
+                        with connection.cursor() as cursor:
+                            cursor.execute("SELECT 1")
+                    connection.poll()
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        self.receive(json.loads(notify.payload))
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Invalidation listener disconnected: {e}")
+            finally:
+                if connection is not None:
+                    connection.close()
+            self.reconnects += 1
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def serialize(self):
+        return dict(super().serialize(), reconnects=self.reconnects)
+
+
+def create_bus(database_url):
+    backend = os.getenv("INVALIDATION_BUS")
+    if backend is None:
+        backend = "postgres" if database_url.startswith("postgresql") else "loopback"
+    if backend == "postgres":
+        # psycopg2 takes the URL without the SQLAlchemy driver name
+        return PostgresBus(database_url.replace("postgresql+psycopg2://", "postgresql://"))
+    return LoopbackBus()
+
+
+bus = None
+
+
+def invalidate(entities):
+    """
+    Invalidate entities in the cache of this host and publish them to the other nodes
+    """
+    entities = sorted(set(entities))
+    if not entities:
+        return
+    response_cache.invalidate(entities)
+    if bus is not None:
+        bus.publish(entities)
+
+
+def get_invalidation_stats():
+    return bus.serialize() if bus is not None else None
+
+
+def invalidate_committed(session):
+    invalidate(session.info.pop("changed_entities", ()))
+
+
+def forget_rolled_back(session):
+    session.info.pop("changed_entities", None)
+
+
+def setup_invalidation(app):
+    global bus
+    bus = create_bus(app.config['SQLALCHEMY_DATABASE_URI'])
+    bus.subscribe(response_cache.invalidate)
+
+    event.listen(db.session, "after_commit", invalidate_committed)
+    event.listen(db.session, "after_rollback", forget_rolled_back)
+
+    # Each worker starts listening with its first request, not when a CLI command imports the app
+    @app.before_request
+    def start_invalidation_bus():
+        bus.start()
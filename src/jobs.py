@@ -0,0 +1,306 @@
+"""
+Background jobs, for the operations too long for a request: imports, exports, stats
+rebuilds and purges of many rows.
+
+POST /jobs stores a Job row and answers 202 right away; `flask jobs-worker`, started as
+its own process (the worker entry of the Procfile), claims the queued jobs and runs them
+on a pool of threads. The Jobs table is the queue, so there is no broker to run: the
+worker works anywhere the app does, against the same database.
+
+- Claiming is a compare-and-set UPDATE ... WHERE Status = 'queued', several workers can
+  poll the same table and only one of them gets each job.
+- A handler reports its progress with context.progress(done, total), between its
+  transactions. That's also where a cancellation (DELETE /jobs/<id>) is noticed: it
+  raises JobCancelled, and what the job already committed stays. It raises JobLost when
+  the job no longer belongs to the worker, requeued after its heartbeat went stale:
+  the attempt stops there and leaves the job to its new worker.
+- A failed attempt is retried after RETRY_DELAY * 2 ** (attempts - 1) seconds, up to
+  MaxAttempts. A handler raising JobError fails for good, retrying won't help.
+- The worker refreshes the heartbeat of its running jobs every poll. A running job
+  whose heartbeat is older than STALE_AFTER lost its worker: it's requeued, the lost
+  attempt counting as a failed one.
+
+Handlers are registered with @job_handler("kind"), take (context, **params) and return
+the JSON result of the job. They run in an app context with their own session and
+commit themselves, so they should be safe to run again after a partial attempt.
+"""
+import concurrent.futures
+import datetime
+import inspect
+import logging
+import os
+import signal
+import socket
+import threading
+from sqlalchemy import select, update
+from models import db, Job, JobStatusEnum
+from utils import APIException
+
+logger = logging.getLogger(__name__)
+
+# Threads of a worker, so jobs running at the same time
+WORKER_THREADS = int(os.getenv("JOBS_WORKER_THREADS", "2"))
+# Seconds between two polls of the queue, the heartbeat is refreshed at the same pace
+POLL_INTERVAL = 1.0
+# A running job without heartbeat for this many seconds is considered lost
+STALE_AFTER = 60.0
+# Seconds before the first retry, doubled on every later one
+RETRY_DELAY = 5.0
+DEFAULT_MAX_ATTEMPTS = 3
+# Where the jobs read and write their files: exports, checkpoints, files to import
+JOBS_DIR = os.getenv("JOBS_DIR", "/tmp/jobs")
+
+HANDLERS = {}
+
+
+class JobError(Exception):
+    """
+    Failure that retrying can't fix, like invalid params
+    """
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobLost(Exception):
+    """
+    The job was taken from this worker, another attempt runs it now
+    """
+
+
+def job_handler(kind):
+    """
+    Register the function running the jobs of a kind
+    """
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+    return register
+
+
+def job_path(name):
+    """
+    Path of a file in JOBS_DIR. Only plain file names are accepted, a job can't be
+    pointed at any other file of the server
+    """
+    if not isinstance(name, str) or not name or os.path.basename(name) != name or name.startswith("."):
+        raise JobError(f"Invalid file name {name!r}")
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    return os.path.join(JOBS_DIR, name)
+
+
+def enqueue(kind, params=None, user_id=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Add a job to the session after checking its kind and params, the caller commits
+    """
+    handler = HANDLERS.get(kind)
+    if handler is None:
+        raise APIException("Invalid job kind", payload={"kinds": sorted(HANDLERS)})
+    params = params if params is not None else {}
+    if not isinstance(params, dict):
+        raise APIException("Params must be an object")
+    try:
+        inspect.signature(handler).bind(None, **params)
+    except TypeError as e:
+        raise APIException(f"Invalid params for {kind}: {e}")
+    if not isinstance(max_attempts, int) or isinstance(max_attempts, bool) or max_attempts < 1:
+        raise APIException("Max attempts must be a positive integer")
+
+    job = Job(Kind=kind, Params=params, UserId=user_id, MaxAttempts=max_attempts,
+              Status=JobStatusEnum.QUEUED, RunAfter=datetime.datetime.now())
+    db.session.add(job)
+    return job
+
+
+def cancel(job):
+    """
+    Cancel a queued job right away, or ask a running one to stop at its next progress
+    report. Returns False when the job is already finished
+    """
+    cancelled = db.session.execute(
+        update(Job)
+        .where(Job.Id == job.Id, Job.Status == JobStatusEnum.QUEUED)
+        .values(Status=JobStatusEnum.CANCELLED, CancelRequested=True, FinishedAt=datetime.datetime.now())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not cancelled:
+        cancelled = db.session.execute(
+            update(Job)
+            .where(Job.Id == job.Id, Job.Status == JobStatusEnum.RUNNING)
+            .values(CancelRequested=True)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    db.session.commit()
+    db.session.refresh(job)
+    return bool(cancelled)
+
+
+class JobContext:
+    """
+    What a handler knows of its job: its id, and progress() to report to
+    """
+
+    def __init__(self, job_id, worker_id):
+        self.job_id = job_id
+        self.worker_id = worker_id
+
+    def progress(self, done, total=None):
+        """
+        Save the progress of the job, raise JobCancelled when it was asked to stop and
+        JobLost when it no longer belongs to this worker.
+        Runs in its own transaction, call it between the handler's commits
+        """
+        values = {"Progress": done}
+        if total is not None:
+            values["Total"] = total
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                update(Job)
+                .where(Job.Id == self.job_id, Job.WorkerId == self.worker_id, Job.Status == JobStatusEnum.RUNNING)
+                .values(**values)).rowcount
+            if not updated:
+                raise JobLost()
+            cancel_requested = connection.execute(
+                select(Job.CancelRequested).where(Job.Id == self.job_id)).scalar()
+        if cancel_requested:
+            raise JobCancelled()
+
+
+def claim(worker_id):
+    """
+    Take the oldest queued job that is due, or None. Returns its id
+    """
+    now = datetime.datetime.now()
+    candidates = db.session.execute(
+        select(Job.Id)
+        .where(Job.Status == JobStatusEnum.QUEUED, Job.RunAfter <= now)
+        .order_by(Job.Id)
+        .limit(10)
+    ).scalars().all()
+    for job_id in candidates:
+        # Another worker may have taken it since the select
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.Id == job_id, Job.Status == JobStatusEnum.QUEUED)
+            .values(Status=JobStatusEnum.RUNNING, WorkerId=worker_id, Attempts=Job.Attempts + 1,
+                    StartedAt=now, HeartbeatAt=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+def retry_or_fail(job_id, worker_id, error):
+    """
+    Requeue a job after a failed attempt with a growing delay, or fail it when it has
+    no attempt left. Only while the job still belongs to the worker
+    """
+    job = db.session.get(Job, job_id, populate_existing=True)
+    if job is None or job.WorkerId != worker_id or job.Status != JobStatusEnum.RUNNING:
+        return
+    now = datetime.datetime.now()
+    if job.Attempts < job.MaxAttempts and not isinstance(error, JobError) and not job.CancelRequested:
+        job.Status = JobStatusEnum.QUEUED
+        job.RunAfter = now + datetime.timedelta(seconds=RETRY_DELAY * 2 ** (job.Attempts - 1))
+        job.WorkerId = None
+    else:
+        job.Status = JobStatusEnum.CANCELLED if job.CancelRequested else JobStatusEnum.FAILED
+        job.FinishedAt = now
+    job.Error = str(error) or type(error).__name__
+    db.session.commit()
+
+
+def requeue_stale():
+    """
+    Give the running jobs of dead workers another attempt, or fail them. Returns their number
+    """
+    stale_before = datetime.datetime.now() - datetime.timedelta(seconds=STALE_AFTER)
+    stale = db.session.execute(
+        select(Job).where(Job.Status == JobStatusEnum.RUNNING, Job.HeartbeatAt < stale_before)
+    ).scalars().all()
+    for job in stale:
+        logger.warning(f"Job {job.Id} lost its worker {job.WorkerId}")
+        retry_or_fail(job.Id, job.WorkerId, Exception(f"Worker {job.WorkerId} stopped responding"))
+    return len(stale)
+
+
+class Worker:
+    """
+    Polls the queue and runs the claimed jobs on a thread pool, until stopped
+    """
+
+    def __init__(self, app, threads=WORKER_THREADS, poll_interval=POLL_INTERVAL):
+        self.app = app
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.id = f"{socket.gethostname()}:{os.getpid()}"
+        self.running = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix="job")
+        self._stopping = threading.Event()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        try:
+            while not self._stopping.is_set():
+                self.poll()
+                self._stopping.wait(self.poll_interval)
+        finally:
+            # Let the running jobs finish, or be requeued once their heartbeat is stale
+            self._executor.shutdown(wait=True)
+
+    def poll(self):
+        self.running = {job_id: future for job_id, future in self.running.items() if not future.done()}
+        with self.app.app_context():
+            if self.running:
+                db.session.execute(
+                    update(Job)
+                    .where(Job.Id.in_(list(self.running)), Job.WorkerId == self.id)
+                    .values(HeartbeatAt=datetime.datetime.now())
+                    .execution_options(synchronize_session=False)
+                )
+                db.session.commit()
+            requeue_stale()
+            while len(self.running) < self.threads and not self._stopping.is_set():
+                job_id = claim(self.id)
+                if job_id is None:
+                    break
+                self.running[job_id] = self._executor.submit(self.run_job, job_id)
+
+    def run_job(self, job_id):
+        with self.app.app_context():
+            job = db.session.get(Job, job_id, populate_existing=True)
+            handler = HANDLERS.get(job.Kind)
+            context = JobContext(job_id, self.id)
+            try:
+                if handler is None:
+                    raise JobError(f"No handler for {job.Kind} jobs")
+                result = handler(context, **job.Params)
+            except JobCancelled:
+                db.session.rollback()
+                self.finish(job_id, JobStatusEnum.CANCELLED)
+            except JobLost:
+                db.session.rollback()
+                logger.warning(f"Job {job_id} ({job.Kind}) was taken from worker {self.id}, stopping")
+            except Exception as e:
+                db.session.rollback()
+                logger.exception(f"Job {job_id} ({job.Kind}) failed")
+                retry_or_fail(job_id, self.id, e)
+            else:
+                self.finish(job_id, JobStatusEnum.SUCCEEDED, result)
+
+    def finish(self, job_id, status, result=None):
+        values = {"Status": status, "FinishedAt": datetime.datetime.now(), "Error": None}
+        if result is not None:
+            values["Result"] = result
+        db.session.execute(
+            update(Job).where(Job.Id == job_id, Job.WorkerId == self.id).values(**values)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+    def stop(self):
+        self._stopping.set()
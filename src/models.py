@@ -2,10 +2,15 @@ import datetime
 import enum
 from typing import Optional
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, Boolean, DateTime, Date, Enum
+from sqlalchemy import String, Boolean, DateTime, Date, Enum, Text, JSON, LargeBinary, event
 from sqlalchemy.orm import Mapped, mapped_column
 
-db = SQLAlchemy()
+# Deletes cascade in the database (ON DELETE CASCADE / SET NULL on every foreign key)
+# and the relationships use passive_deletes, so the ORM never loads the children
+# of a row just to delete them.
+# Objects keep their loaded state after commit, so the write handlers can build
+# the response from memory instead of reloading every row and relationship.
+db = SQLAlchemy(session_options={"expire_on_commit": False})
 
 ###############################
 # Enums
@@ -62,6 +67,35 @@ class WeightUnitEnum(str, enum.Enum):
         return [unit.value for unit in cls]
 
 
+# Kilograms in one of each unit
+WEIGHT_UNIT_IN_KG = {
+    WeightUnitEnum.KG: 1.0,
+    WeightUnitEnum.LB: 0.45359237,
+    WeightUnitEnum.OZ: 0.028349523125,
+}
+
+
+class ChangeActionEnum(str, enum.Enum):
+    UPSERT = "upsert"
+    DELETE = "delete"
+
+    @classmethod
+    def get_all(cls):
+        return [action.value for action in cls]
+
+
+class JobStatusEnum(str, enum.Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    @classmethod
+    def get_all(cls):
+        return [status.value for status in cls]
+
+
 ###############################
 # Database Models
 ###############################
@@ -76,11 +110,13 @@ class User(db.Model):
     IsActive: Mapped[bool] = mapped_column(Boolean())
     CreatedAt: Mapped[datetime.datetime] = mapped_column(
         DateTime(timezone=True), default=datetime.datetime.now)
+    # Bumped on every favorite added or removed, so clients can tell whether their copy is stale
+    FavoritesVersion: Mapped[int] = mapped_column(default=0, server_default="0")
 
     Characters_Favorites_Association: Mapped[Optional[list["Character_Favorite"]]] = db.relationship(
-        back_populates="User", cascade="all, delete-orphan")
+        back_populates="User", cascade="all, delete-orphan", passive_deletes=True)
     Planets_Favorites_Association: Mapped[Optional[list["Planet_Favorite"]]] = db.relationship(
-        back_populates="User", cascade="all, delete-orphan")
+        back_populates="User", cascade="all, delete-orphan", passive_deletes=True)
 
     def __str__(self):
         return self.Username
@@ -88,15 +124,29 @@ class User(db.Model):
     def __repr__(self):
         return f"User(Id={self.Id}, Username={self.Username})"
 
-    def serialize(self):
+    # The favorites lists are the whole relationships unless given
+    def serialize(self, characters_favorites=None, planets_favorites=None):
+        if characters_favorites is None:
+            characters_favorites = [fav.Character for fav in self.Characters_Favorites_Association]
+        if planets_favorites is None:
+            planets_favorites = [fav.Planet for fav in self.Planets_Favorites_Association]
         return {
             "id": self.Id,
             "email": self.Email,
             "username": self.Username,
             "is_active": self.IsActive,
             "created_at": self.CreatedAt,
-            "characters_favorites": [{"id": fav.Character.Id, "name": fav.Character.Name} for fav in self.Characters_Favorites_Association],
-            "planets_favorites": [{"id": fav.Planet.Id, "name": fav.Planet.Name} for fav in self.Planets_Favorites_Association],
+            "favorites_version": self.FavoritesVersion,
+            "characters_favorites": [{"id": character.Id, "name": character.Name} for character in characters_favorites],
+            "planets_favorites": [{"id": planet.Id, "name": planet.Name} for planet in planets_favorites],
+        }
+
+    # Only the columns, used when the user is embedded in another resource
+    def serialize_summary(self):
+        return {
+            "id": self.Id,
+            "username": self.Username,
+            "is_active": self.IsActive,
         }
 
 
@@ -109,15 +159,20 @@ class Character(db.Model):
         Enum(HairColorEnum), default=HairColorEnum.UNKNOWN.value)
     BirthDay: Mapped[Optional[datetime.date]] = mapped_column(Date())
     HomeWorldId: Mapped[Optional[int]] = mapped_column(
-        db.ForeignKey("Planets.Id"))
+        db.ForeignKey("Planets.Id", ondelete="SET NULL"))
+    # Denormalized number of users having this character as favorite, indexed for the top lists
+    FavoritesCount: Mapped[int] = mapped_column(
+        default=0, server_default="0", index=True)
 
     Weight: Mapped[Optional["Weight"]] = db.relationship(
-        back_populates="Character", uselist=False, cascade="all, delete-orphan")
+        back_populates="Character", uselist=False, cascade="all, delete-orphan", passive_deletes=True)
     HomeWorld: Mapped[Optional["Planet"]] = db.relationship(
         back_populates="Characters")
 
+    # In a fixed order, the one of the catalog snapshot too
     Users_Favorites_Association: Mapped[Optional[list["Character_Favorite"]]] = db.relationship(
-        back_populates="Character", cascade="all, delete-orphan")
+        back_populates="Character", cascade="all, delete-orphan", passive_deletes=True,
+        order_by="Character_Favorite.UserId")
 
     def __str__(self):
         return self.Name
@@ -125,26 +180,42 @@ class Character(db.Model):
     def __repr__(self):
         return f"Character(Id={self.Id}, Name={self.Name})"
 
-    def serialize(self):
+    def serialize(self, weight_unit=None):
         return {
             "id": self.Id,
             "name": self.Name,
             "height": self.Height,
-            "weight": self.Weight.serialize()["weight"] if self.Weight else None,
+            "weight": self.Weight.format(weight_unit) if self.Weight else None,
             "hair_color": self.HairColor.value,
             "birth_day": self.BirthDay,
-            "home_world": self.HomeWorld.serialize()["name"] if self.HomeWorld else None,
+            "home_world": self.HomeWorld.Name if self.HomeWorld else None,
+            "favorites_count": self.FavoritesCount,
             "users_favorites": [fav.User.Username for fav in self.Users_Favorites_Association],
         }
 
+    # Only the columns, used when the character is embedded in another resource
+    def serialize_summary(self):
+        return {
+            "id": self.Id,
+            "name": self.Name,
+            "height": self.Height,
+            "hair_color": self.HairColor.value,
+            "birth_day": self.BirthDay,
+            "home_world_id": self.HomeWorldId,
+            "favorites_count": self.FavoritesCount,
+        }
+
 
 class Weight(db.Model):
     __tablename__ = "Weights"
     CharacterId: Mapped[int] = mapped_column(
-        db.ForeignKey("Characters.Id"), primary_key=True)
+        db.ForeignKey("Characters.Id", ondelete="CASCADE"), primary_key=True)
     Weight: Mapped[float] = mapped_column()
     WeightUnit: Mapped[enum] = mapped_column(
         Enum(WeightUnitEnum), default=WeightUnitEnum.KG.value)
+    # The weight in kg whatever the unit, set on every insert and update, for the
+    # filters and the sorting by weight
+    WeightKg: Mapped[Optional[float]] = mapped_column(index=True)
 
     Character: Mapped["Character"] = db.relationship(back_populates="Weight")
 
@@ -154,12 +225,37 @@ class Weight(db.Model):
     def __repr__(self):
         return f"Weight(Id={self.CharacterId}, Weight={self.Weight}, Unit={self.WeightUnit.value})"
 
-    def serialize(self):
+    def serialize(self, unit=None):
         return {
             "character_id": self.CharacterId,
-            "weight": f"{self.Weight} {self.WeightUnit.value}",
+            "weight": self.format(unit),
         }
 
+    def serialize_summary(self):
+        return self.serialize()
+
+    def format(self, unit=None):
+        """
+        The weight as "80.0 kg", as entered or converted to another unit
+        """
+        return format_weight(self.Weight, self.WeightUnit, self.WeightKg, unit)
+
+
+def format_weight(weight, weight_unit, weight_kg, unit=None):
+    """
+    Weight.format() from the column values, for the callers without a Weight object
+    """
+    if unit is None or weight_kg is None:
+        return f"{weight} {weight_unit.value}"
+    return f"{round(weight_kg / WEIGHT_UNIT_IN_KG[unit], 2)} {unit.value}"
+
+
+@event.listens_for(Weight, "before_insert")
+@event.listens_for(Weight, "before_update")
+def normalize_weight(mapper, connection, weight):
+    weight.WeightKg = None if weight.Weight is None else \
+        weight.Weight * WEIGHT_UNIT_IN_KG[WeightUnitEnum(weight.WeightUnit)]
+
 
 class Planet(db.Model):
     __tablename__ = "Planets"
@@ -169,12 +265,16 @@ class Planet(db.Model):
         Enum(ClimateEnum), default=ClimateEnum.UNKNOWN.value)
     Terrain: Mapped[enum] = mapped_column(
         Enum(TerrainEnum), default=TerrainEnum.UNKNOWN.value)
+    # Denormalized number of users having this planet as favorite, indexed for the top lists
+    FavoritesCount: Mapped[int] = mapped_column(
+        default=0, server_default="0", index=True)
 
+    # Both in a fixed order, the one of the catalog snapshot too
     Characters: Mapped[Optional[list["Character"]]] = db.relationship(
-        back_populates="HomeWorld")
-
+        back_populates="HomeWorld", passive_deletes=True, order_by="Character.Id")
     Users_Favorites_Association: Mapped[Optional[list["Planet_Favorite"]]] = db.relationship(
-        back_populates="Planet", cascade="all, delete-orphan")
+        back_populates="Planet", cascade="all, delete-orphan", passive_deletes=True,
+        order_by="Planet_Favorite.UserId")
 
     def __str__(self):
         return self.Name
@@ -189,16 +289,27 @@ class Planet(db.Model):
             "climate": self.Climate.value,
             "terrain": self.Terrain.value,
             "characters": [character.Name for character in self.Characters],
+            "favorites_count": self.FavoritesCount,
             "users_favorites": [fav.User.Username for fav in self.Users_Favorites_Association],
         }
 
+    # Only the columns, used when the planet is embedded in another resource
+    def serialize_summary(self):
+        return {
+            "id": self.Id,
+            "name": self.Name,
+            "climate": self.Climate.value,
+            "terrain": self.Terrain.value,
+            "favorites_count": self.FavoritesCount,
+        }
+
 
 class Character_Favorite(db.Model):
     __tablename__ = "Characters_Favorites"
     UserId: Mapped[int] = mapped_column(
-        db.ForeignKey("Users.Id"), primary_key=True)
+        db.ForeignKey("Users.Id", ondelete="CASCADE"), primary_key=True)
     CharacterId: Mapped[int] = mapped_column(
-        db.ForeignKey("Characters.Id"), primary_key=True)
+        db.ForeignKey("Characters.Id", ondelete="CASCADE"), primary_key=True)
 
     User: Mapped["User"] = db.relationship(
         back_populates="Characters_Favorites_Association", uselist=False)
@@ -215,9 +326,9 @@ class Character_Favorite(db.Model):
 class Planet_Favorite(db.Model):
     __tablename__ = "Planets_Favorites"
     UserId: Mapped[int] = mapped_column(
-        db.ForeignKey("Users.Id"), primary_key=True)
+        db.ForeignKey("Users.Id", ondelete="CASCADE"), primary_key=True)
     PlanetId: Mapped[int] = mapped_column(
-        db.ForeignKey("Planets.Id"), primary_key=True)
+        db.ForeignKey("Planets.Id", ondelete="CASCADE"), primary_key=True)
 
     User: Mapped["User"] = db.relationship(
         back_populates="Planets_Favorites_Association", uselist=False)
@@ -229,3 +340,141 @@ class Planet_Favorite(db.Model):
 
     def __repr__(self):
         return f"Planet_Favorite(UserId={self.UserId}, PlanetId={self.PlanetId})"
+
+
+class Stat(db.Model):
+    """
+    Rollup of an aggregate, one row per counted key (e.g. name="hair_colors", key="black").
+    Kept up to date by the write handlers, see stats.py
+    """
+    __tablename__ = "Stats"
+    Name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    Key: Mapped[str] = mapped_column(String(50), primary_key=True)
+    Value: Mapped[int] = mapped_column(default=0)
+
+    def __repr__(self):
+        return f"Stat(Name={self.Name}, Key={self.Key}, Value={self.Value})"
+
+
+class Change(db.Model):
+    """
+    Append-only log of the changes made to the catalog, read by the /changes sync feed.
+    The Id is the cursor clients resume from, see changes.py
+    """
+    __tablename__ = "Changes"
+    Id: Mapped[int] = mapped_column(primary_key=True)
+    Entity: Mapped[str] = mapped_column(String(30))
+    # The primary key of the entity, "UserId:TargetId" for favorites
+    EntityId: Mapped[str] = mapped_column(String(50))
+    Action: Mapped[enum] = mapped_column(Enum(ChangeActionEnum))
+    CreatedAt: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), default=datetime.datetime.now)
+
+    __table_args__ = (db.Index("ix_Changes_Entity_EntityId", "Entity", "EntityId"),)
+
+    def __repr__(self):
+        return f"Change(Id={self.Id}, Entity={self.Entity}, EntityId={self.EntityId}, Action={self.Action.value})"
+
+    def serialize(self):
+        return {
+            "cursor": self.Id,
+            "entity": self.Entity,
+            "id": self.EntityId,
+            "action": self.Action.value,
+        }
+
+
+class ChangeLock(db.Model):
+    """
+    Single row locked by every transaction appending to the Changes table until its
+    commit, so the Ids of the changes are in commit order. See changes.py
+    """
+    __tablename__ = "ChangeLock"
+    Id: Mapped[int] = mapped_column(primary_key=True)
+    Transactions: Mapped[int] = mapped_column(default=0, server_default="0")
+
+    def __repr__(self):
+        return f"ChangeLock(Transactions={self.Transactions})"
+
+
+@event.listens_for(ChangeLock.__table__, "after_create")
+def create_change_lock_row(table, connection, **kwargs):
+    connection.execute(table.insert().values(Id=1, Transactions=0))
+
+
+class Job(db.Model):
+    """
+    Background job: queued by POST /jobs, claimed and run by `flask jobs-worker`.
+    See jobs.py
+    """
+    __tablename__ = "Jobs"
+    Id: Mapped[int] = mapped_column(primary_key=True)
+    Kind: Mapped[str] = mapped_column(String(50))
+    Params: Mapped[dict] = mapped_column(JSON, default=dict)
+    Status: Mapped[enum] = mapped_column(
+        Enum(JobStatusEnum), default=JobStatusEnum.QUEUED.value)
+    # Units of work done out of Total (rows, ids, ...), Total is unknown for some kinds
+    Progress: Mapped[int] = mapped_column(default=0, server_default="0")
+    Total: Mapped[Optional[int]] = mapped_column()
+    Result: Mapped[Optional[dict]] = mapped_column(JSON)
+    Error: Mapped[Optional[str]] = mapped_column(Text())
+    Attempts: Mapped[int] = mapped_column(default=0, server_default="0")
+    MaxAttempts: Mapped[int] = mapped_column(default=3, server_default="3")
+    CancelRequested: Mapped[bool] = mapped_column(Boolean(), default=False, server_default="0")
+    UserId: Mapped[Optional[int]] = mapped_column(
+        db.ForeignKey("Users.Id", ondelete="SET NULL"))
+    # The worker holding the job and the last time it reported, to requeue the jobs of dead workers
+    WorkerId: Mapped[Optional[str]] = mapped_column(String(50))
+    HeartbeatAt: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(timezone=True))
+    # Not claimed before this time, pushed back after a failed attempt
+    RunAfter: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), default=datetime.datetime.now)
+    CreatedAt: Mapped[datetime.datetime] = mapped_column(
+        DateTime(timezone=True), default=datetime.datetime.now)
+    StartedAt: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(timezone=True))
+    FinishedAt: Mapped[Optional[datetime.datetime]] = mapped_column(DateTime(timezone=True))
+
+    __table_args__ = (db.Index("ix_Jobs_Status_RunAfter", "Status", "RunAfter"),)
+
+    def __repr__(self):
+        return f"Job(Id={self.Id}, Kind={self.Kind}, Status={self.Status.value})"
+
+    def serialize(self):
+        return {
+            "id": self.Id,
+            "kind": self.Kind,
+            "params": self.Params,
+            "status": self.Status.value,
+            "progress": self.Progress,
+            "total": self.Total,
+            "result": self.Result,
+            "error": self.Error,
+            "attempts": self.Attempts,
+            "max_attempts": self.MaxAttempts,
+            "cancel_requested": self.CancelRequested,
+            "created_at": self.CreatedAt,
+            "started_at": self.StartedAt,
+            "finished_at": self.FinishedAt,
+        }
+
+
+class IdempotencyKey(db.Model):
+    """
+    Response of a POST sent with an Idempotency-Key header, replayed to its retries.
+    Status is None while the first request runs. See idempotency.py
+    """
+    __tablename__ = "IdempotencyKeys"
+    Key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # The JWT identity of the client, "" without one, and the route: keys are only unique per client
+    UserId: Mapped[str] = mapped_column(String(50), primary_key=True)
+    Endpoint: Mapped[str] = mapped_column(String(200), primary_key=True)
+    # Hash of the request body, a key can't be reused for another request
+    Fingerprint: Mapped[str] = mapped_column(String(64))
+    Status: Mapped[Optional[int]] = mapped_column()
+    Body: Mapped[Optional[bytes]] = mapped_column(LargeBinary())
+    Headers: Mapped[Optional[dict]] = mapped_column(JSON)
+    LockedAt: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True))
+    ExpiresAt: Mapped[datetime.datetime] = mapped_column(DateTime(timezone=True), index=True)
+
+    def __repr__(self):
+        return f"IdempotencyKey(Key={self.Key}, Endpoint={self.Endpoint}, Status={self.Status})"
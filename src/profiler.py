@@ -0,0 +1,168 @@
+"""
+On-demand profiling of single requests, for staging.
+
+With PROFILER_ENABLED=1, an admin (see auth.py) can profile a request by adding
+?profile=cprofile (or ?profile=1) or ?profile=sample, or the X-Profile header with the
+same values. Without the flag nothing is registered at all, so it costs nothing.
+
+- cprofile runs the request under cProfile and saves <id>.pstats, to open with
+  `python -m pstats`, snakeviz, or to turn into a flame graph with flameprof.
+- sample takes a stack sample of the request thread every SAMPLE_INTERVAL seconds
+  and saves <id>.folded, the collapsed stacks format of flamegraph.pl and speedscope.
+  It barely slows the request down, but the GIL lets it take a sample every few
+  milliseconds at best: it's meant for the slow requests.
+
+Both write <id>.json next to it, in PROFILE_DIR (/tmp/profiles by default): route,
+status, total time, time and count of the SQL statements, time spent serializing,
+and for cProfile the functions where the most time was spent. The id is returned
+in the X-Profile-Id header. Profiled requests skip the response cache and the
+single-flight coalescing so the handler really runs.
+"""
+import cProfile
+import collections
+import datetime
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from auth import is_admin
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+# Seconds between two stack samples
+SAMPLE_INTERVAL = 0.001
+# Functions listed in the summary of a cProfile run
+SUMMARY_FUNCTIONS = 20
+MODES = {"1": "cprofile", "cprofile": "cprofile", "sample": "sample"}
+
+
+class Sampler(threading.Thread):
+    """
+    Collects the stacks of another thread, counted by collapsed stack
+    """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as output:
+            for stack, count in self.stacks.items():
+                output.write(f"{stack} {count}\n")
+
+
+def serialization_time(stats):
+    """
+    Cumulative seconds in the serialize methods and in jsonify, outermost calls only
+    """
+    total = 0.0
+    for (filename, line, name), (_, _, _, cumulative, callers) in stats.stats.items():
+        serializing = name.startswith("serialize") or name == "jsonify"
+        # Skip the nested calls, their time is already in their caller's
+        nested = any(caller[2].startswith("serialize") for caller in callers)
+        if serializing and not nested:
+            total += cumulative
+    return total
+
+
+def start_profile():
+    mode = MODES.get(request.args.get("profile") or request.headers.get("X-Profile", ""))
+    if mode is None or not is_admin():
+        return
+    g.profiling = {"mode": mode, "sql_count": 0, "sql_time": 0.0, "start": time.perf_counter()}
+    if mode == "cprofile":
+        g.profiling["profiler"] = cProfile.Profile()
+        g.profiling["profiler"].enable()
+    else:
+        g.profiling["profiler"] = Sampler(threading.get_ident())
+        g.profiling["profiler"].start()
+
+
+def finish_profile(response):
+    profiling = g.pop("profiling", None)
+    if profiling is None:
+        return response
+    duration = time.perf_counter() - profiling["start"]
+    profiler = profiling["profiler"]
+    if profiling["mode"] == "cprofile":
+        profiler.disable()
+    else:
+        profiler.stop()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_id = f"{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-{request.endpoint}"
+    path = os.path.join(PROFILE_DIR, profile_id)
+    summary = {
+        "id": profile_id,
+        "mode": profiling["mode"],
+        "method": request.method,
+        "path": request.full_path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "duration_ms": round(duration * 1000, 2),
+        "sql_statements": profiling["sql_count"],
+        "sql_ms": round(profiling["sql_time"] * 1000, 2),
+    }
+
+    if profiling["mode"] == "cprofile":
+        profiler.dump_stats(f"{path}.pstats")
+        stats = pstats.Stats(profiler)
+        summary["serialization_ms"] = round(serialization_time(stats) * 1000, 2)
+        top = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:SUMMARY_FUNCTIONS]
+        summary["top_functions"] = [
+            {"function": f"{name} ({os.path.basename(filename)}:{line})", "calls": calls,
+             "own_ms": round(own * 1000, 2), "cumulative_ms": round(cumulative * 1000, 2)}
+            for (filename, line, name), (_, calls, own, cumulative, _) in top
+        ]
+    else:
+        profiler.write(f"{path}.folded")
+        summary["samples"] = sum(profiler.stacks.values())
+
+    with open(f"{path}.json", "w") as output:
+        json.dump(summary, output, indent=2)
+    response.headers["X-Profile-Id"] = profile_id
+    return response
+
+
+def before_statement(conn, cursor, statement, parameters, context, executemany):
+    profiling = g.get("profiling") if g else None
+    if profiling is not None:
+        conn.info.setdefault("profile_start", []).append(time.perf_counter())
+
+
+def after_statement(conn, cursor, statement, parameters, context, executemany):
+    profiling = g.get("profiling") if g else None
+    if profiling is not None and conn.info.get("profile_start"):
+        profiling["sql_count"] += 1
+        profiling["sql_time"] += time.perf_counter() - conn.info["profile_start"].pop()
+
+
+def setup_profiler(app):
+    if os.getenv("PROFILER_ENABLED") != "1":
+        return
+    app.before_request(start_profile)
+    app.after_request(finish_profile)
+    event.listen(Engine, "before_cursor_execute", before_statement)
+    event.listen(Engine, "after_cursor_execute", after_statement)
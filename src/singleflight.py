@@ -0,0 +1,121 @@
+"""
+Single-flight coalescing of identical concurrent GET requests.
+
+When many requests for the same URL arrive at once (a cold worker after a deploy, an
+expired cache entry), the first one (the leader) runs the handler and the others wait
+for it and get a copy of its response, so the queries and the serialization run once
+per worker instead of once per request.
+
+Only the response body, status and headers are shared, every waiter builds its own
+Response object. If the leader raises, the waiters raise the same exception, and the
+next request for that URL starts a new flight. A waiter that gives up after
+WAIT_TIMEOUT seconds runs the handler itself.
+
+The request that runs the handler is the one taking an admission slot (see
+admission.py), so the decision is made here, atomically with becoming the leader.
+"""
+import functools
+import threading
+from flask import Response, current_app, g, request
+from admission import admit_deferred
+
+# Seconds a request waits for the leader before running the handler itself
+WAIT_TIMEOUT = 30.0
+
+
+class Flight:
+    """
+    One in-flight computation and the outcome shared with its waiters
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs a function once per key among concurrent callers, with counters
+    """
+
+    def __init__(self, wait_timeout=WAIT_TIMEOUT):
+        self.wait_timeout = wait_timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def do(self, key, fn):
+        """
+        Call fn() if no call for key is running, otherwise wait for that call's result
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.done.wait(self.wait_timeout):
+                with self._lock:
+                    self.timeouts += 1
+                return fn()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+
+        try:
+            flight.response = fn()
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.response
+
+    def serialize(self):
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+        }
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(view):
+    """
+    Decorator for GET handlers: concurrent requests for the same URL share one response
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # A profiled request (see profiler.py) must run the handler
+        if g.get("profiling") is not None:
+            busy = admit_deferred()
+            return busy if busy is not None else view(*args, **kwargs)
+
+        def run():
+            # Only the request running the handler takes a slot, the ones waiting for it don't.
+            # When it's shed, the waiters get the same 503
+            busy = admit_deferred()
+            response = current_app.make_response(busy if busy is not None else view(*args, **kwargs))
+            return response.get_data(), response.status_code, list(response.headers.items())
+
+        data, status, headers = single_flight.do(request.full_path, run)
+        return Response(data, status=status, headers=headers)
+    # Tells admission.py to leave the admission to run()
+    wrapper.coalesced = True
+    return wrapper
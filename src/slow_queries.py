@@ -0,0 +1,194 @@
+"""
+Slow query log.
+
+Engine events time every SQL statement. The statements slower than SLOW_QUERY_MS (100
+by default) are logged as warnings and kept among the recent slow queries, with the
+route that ran them and their parameters. The parameters are redacted when the
+statement touches a password, token or secret column.
+
+When SLOW_QUERY_MS is set, every statement is also added to per-worker totals keyed by
+its normalized text (literals and IN lists replaced by ?), which is how
+GET /slow-queries ranks the top offenders by total time. Normalizing takes a few regex
+passes per statement, so it's off unless asked for.
+
+With SLOW_QUERY_EXPLAIN=1 the plan of a slow statement is captured once per normalized
+statement: EXPLAIN on Postgres, EXPLAIN QUERY PLAN on the SQLite fallback. It runs
+on the same connection right after the statement, so it's meant for staging.
+"""
+import collections
+import logging
+import os
+import re
+import threading
+import time
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+TRACK_STATEMENTS = "SLOW_QUERY_MS" in os.environ
+EXPLAIN_SLOW_QUERIES = os.getenv("SLOW_QUERY_EXPLAIN") == "1"
+# Slow queries kept for the endpoint, the oldest are dropped first
+MAX_RECENT = 100
+# Normalized statements tracked per worker, new ones are ignored once it's full
+MAX_STATEMENTS = 1000
+
+SECRET_PATTERN = re.compile(r"password|token|secret", re.IGNORECASE)
+LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+LIST_PATTERN = re.compile(r"\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*\)")
+SPACE_PATTERN = re.compile(r"\s+")
+FROM_PATTERN = re.compile(r"\sFROM\s", re.IGNORECASE)
+# Statements with a plan, not the DDL
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+def normalize(statement):
+    """
+    Statement text without its literals and with the lists of parameters collapsed,
+    so the same query with other values counts as one
+    """
+    statement = LITERAL_PATTERN.sub("?", statement)
+    statement = LIST_PATTERN.sub("(?)", statement)
+    return SPACE_PATTERN.sub(" ", statement).strip()
+
+
+def redact(statement, parameters):
+    if isinstance(parameters, dict):
+        return {key: "***" if SECRET_PATTERN.search(key) else value for key, value in parameters.items()}
+    # Positional parameters can't be matched to their column, hide them all when a
+    # secret column takes a value. The columns a SELECT only reads don't count
+    if statement.lstrip().upper().startswith("SELECT"):
+        # Without a FROM, everything the SELECT takes is a value
+        from_clause = FROM_PATTERN.search(statement)
+        if from_clause is not None:
+            statement = statement[from_clause.start():]
+    if SECRET_PATTERN.search(statement):
+        return "***"
+    return parameters
+
+
+class QueryLog:
+    """
+    Totals per normalized statement and the recent slow queries of this worker
+    """
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, explain=EXPLAIN_SLOW_QUERIES, track_statements=TRACK_STATEMENTS):
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.track_statements = track_statements
+        self.statements = {}
+        # Plan per normalized statement, captured once
+        self.plans = {}
+        self.recent = collections.deque(maxlen=MAX_RECENT)
+        self._lock = threading.Lock()
+
+    def record(self, connection, statement, parameters, duration_ms, executemany):
+        slow = duration_ms >= self.threshold_ms
+        if not slow and not self.track_statements:
+            return
+        key = normalize(statement)
+        if self.track_statements:
+            self.add_to_totals(key, duration_ms, slow)
+        if not slow:
+            return
+
+        route = f"{request.method} {request.path}" if has_request_context() else None
+        if self.explain and key not in self.plans and not executemany \
+                and statement.lstrip().upper().startswith(EXPLAINABLE):
+            self.plans[key] = explain(connection, statement, parameters)
+        entry = {
+            "statement": statement,
+            "parameters": redact(statement, parameters),
+            "duration_ms": round(duration_ms, 2),
+            "route": route,
+            "plan": self.plans.get(key),
+            "at": time.time(),
+        }
+        self.recent.append(entry)
+        logger.warning(f"Slow query ({entry['duration_ms']} ms) in {route}: {statement} {entry['parameters']}")
+
+    def add_to_totals(self, key, duration_ms, slow):
+        with self._lock:
+            totals = self.statements.get(key)
+            if totals is None:
+                if len(self.statements) >= MAX_STATEMENTS:
+                    return
+                totals = self.statements[key] = {
+                    "statement": key, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "slow": 0}
+            totals["count"] += 1
+            totals["total_ms"] += duration_ms
+            totals["max_ms"] = max(totals["max_ms"], duration_ms)
+            if slow:
+                totals["slow"] += 1
+
+    def top(self, limit):
+        with self._lock:
+            statements = sorted(self.statements.values(), key=lambda totals: totals["total_ms"], reverse=True)
+            return [dict(totals, total_ms=round(totals["total_ms"], 2), max_ms=round(totals["max_ms"], 2),
+                         mean_ms=round(totals["total_ms"] / totals["count"], 2),
+                         plan=self.plans.get(totals["statement"]))
+                    for totals in statements[:limit]]
+
+    def serialize(self, limit):
+        return {
+            "threshold_ms": self.threshold_ms,
+            "tracking_statements": self.track_statements,
+            "top": self.top(limit),
+            "recent": list(self.recent)[-limit:],
+        }
+
+    def reset(self):
+        with self._lock:
+            self.statements.clear()
+            self.plans.clear()
+            self.recent.clear()
+
+
+def explain(connection, statement, parameters):
+    """
+    Plan of a statement as a list of lines, or None if it can't be explained.
+    Runs on the DBAPI cursor, so it isn't timed itself
+    """
+    sqlite = connection.dialect.name == "sqlite"
+    cursor = connection.connection.cursor()
+    savepoint = False
+    try:
+        # On Postgres a failed statement aborts the whole transaction, isolate it
+        if not sqlite:
+            cursor.execute("SAVEPOINT explain_slow_query")
+            savepoint = True
+        cursor.execute(("EXPLAIN QUERY PLAN " if sqlite else "EXPLAIN ") + statement, parameters)
+        plan = [" ".join(str(column) for column in row) for row in cursor.fetchall()]
+        if not sqlite:
+            cursor.execute("RELEASE SAVEPOINT explain_slow_query")
+        return plan
+    except Exception as e:
+        if savepoint:
+            try:
+                cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            except Exception as rollback_error:
+                logger.warning(f"Could not roll back the explain of a slow query: {rollback_error}")
+        logger.warning(f"Could not explain a slow query: {e}")
+        return None
+    finally:
+        cursor.close()
+
+
+query_log = QueryLog()
+
+
+def before_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_start"] = time.perf_counter()
+
+
+def after_statement(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop("query_start", None)
+    if start is not None:
+        query_log.record(conn, statement, parameters, (time.perf_counter() - start) * 1000, executemany)
+
+
+def setup_slow_queries(app):
+    event.listen(Engine, "before_cursor_execute", before_statement)
+    event.listen(Engine, "after_cursor_execute", after_statement)
@@ -0,0 +1,398 @@
+"""
+In-memory snapshot of the catalog, for serving the character and planet reads
+without the database.
+
+With SNAPSHOT_ENABLED=1, each worker keeps the characters (with their weights), the
+planets and the names in their favorites in memory. Records use __slots__ and are
+indexed by id, and each one holds its serialization already encoded as JSON.
+GET /characters (filters, sort and units included), /characters/<id>, /planets and
+/planets/<id> are answered from the snapshot, before the response cache. Only
+?include= falls through to the handlers.
+
+The version stamp of a snapshot is the generation vector of the response cache for
+the characters and planets (see cache.py). It is shared by the workers of a host and
+bumped after every commit that touches them, whether it came from the API, a command
+or another node. Each read compares the stamp with the current vector, which is one
+cache lookup and no database round trip. When they differ, the first request reloads
+the snapshot, with one query per table, and swaps it in with a single assignment, so
+a request always sees one whole version. Snapshots are never modified. Records whose
+values didn't change are reused from the previous snapshot with their JSON, so only
+the changed entities are encoded again.
+
+The favorites (and the users, for their names) change far more often and only touch
+the favorites_count and users_favorites of a few records, so they have a stamp of
+their own. When only that one differs, the snapshot is patched instead: the changes
+logged since its cursor (see changes.py) tell which characters and planets gained or
+lost a fan, and only those records are read again and encoded, in a new snapshot
+sharing the others. Beyond MAX_PATCHED_CHANGES changes it's reloaded.
+
+The stamps and the cursor being read before the data, a write committed during a load
+makes the new snapshot stale right away instead of being missed. The snapshot needs a
+cache backend (CACHE_BACKEND=sqlite or memory).
+"""
+import copy
+import functools
+import logging
+import os
+import threading
+from flask import Response, current_app, g
+from sqlalchemy import select, func
+from models import db, Change, Character, Weight, Planet, Character_Favorite, Planet_Favorite, User, format_weight
+from cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED") == "1"
+# The entities whose changes reload the snapshot
+SOURCES = ("character", "planet")
+# The ones whose changes only patch the favorites of some records
+FAVORITE_SOURCES = ("character_favorite", "planet_favorite", "user")
+# Beyond that many changes to patch, the snapshot is reloaded
+MAX_PATCHED_CHANGES = 1000
+
+
+class CharacterRecord:
+    __slots__ = ("id", "name", "height", "hair_color", "birth_day", "home_world", "favorites_count",
+                 "weight", "weight_unit", "weight_kg", "users_favorites", "json")
+
+    def __init__(self, values):
+        (self.id, self.name, self.height, self.hair_color, self.birth_day, self.home_world,
+         self.favorites_count, self.weight, self.weight_unit, self.weight_kg, self.users_favorites) = values
+        self.json = encode(self.serialize())
+
+    def values(self):
+        return (self.id, self.name, self.height, self.hair_color, self.birth_day, self.home_world,
+                self.favorites_count, self.weight, self.weight_unit, self.weight_kg, self.users_favorites)
+
+    def with_favorites(self, favorites_count, users_favorites):
+        return (self.id, self.name, self.height, self.hair_color, self.birth_day, self.home_world,
+                favorites_count, self.weight, self.weight_unit, self.weight_kg, users_favorites)
+
+    def serialize(self, weight_unit=None):
+        """
+        Same as Character.serialize()
+        """
+        return {
+            "id": self.id,
+            "name": self.name,
+            "height": self.height,
+            "weight": format_weight(self.weight, self.weight_unit, self.weight_kg, weight_unit)
+            if self.weight is not None else None,
+            "hair_color": self.hair_color.value,
+            "birth_day": self.birth_day,
+            "home_world": self.home_world,
+            "favorites_count": self.favorites_count,
+            "users_favorites": list(self.users_favorites),
+        }
+
+
+class PlanetRecord:
+    __slots__ = ("id", "name", "climate", "terrain", "characters", "favorites_count", "users_favorites", "json")
+
+    def __init__(self, values):
+        (self.id, self.name, self.climate, self.terrain, self.characters,
+         self.favorites_count, self.users_favorites) = values
+        self.json = encode(self.serialize())
+
+    def values(self):
+        return (self.id, self.name, self.climate, self.terrain, self.characters,
+                self.favorites_count, self.users_favorites)
+
+    def with_favorites(self, favorites_count, users_favorites):
+        return (self.id, self.name, self.climate, self.terrain, self.characters, favorites_count, users_favorites)
+
+    def serialize(self):
+        """
+        Same as Planet.serialize()
+        """
+        return {
+            "id": self.id,
+            "name": self.name,
+            "climate": self.climate.value,
+            "terrain": self.terrain.value,
+            "characters": list(self.characters),
+            "favorites_count": self.favorites_count,
+            "users_favorites": list(self.users_favorites),
+        }
+
+
+def encode(value):
+    # Compact like jsonify, with the app's handling of dates
+    return current_app.json.dumps(value, separators=(",", ":")).encode()
+
+
+def join(encoded):
+    return b"[" + b",".join(encoded) + b"]"
+
+
+def grouped(rows):
+    """
+    {key: (value, ...)} from (key, value) rows sorted by key
+    """
+    groups = {}
+    for key, value in rows:
+        groups.setdefault(key, []).append(value)
+    return {key: tuple(values) for key, values in groups.items()}
+
+
+def fans_of(favorite_model, target_column, *where):
+    """
+    {target id: (username, ...)} of the favorites, in the order of the relationships
+    """
+    return grouped(db.session.execute(
+        select(target_column, User.Username).select_from(favorite_model).join(User).where(*where)
+        .order_by(target_column, favorite_model.UserId)))
+
+
+def reuse_or_build(record_class, values, previous):
+    """
+    The record of the previous snapshot when its values are the same, a new one else
+    """
+    record = previous.get(values[0]) if previous else None
+    if record is not None and record.values() == values:
+        return record, False
+    return record_class(values), True
+
+
+class Snapshot:
+    """
+    One version of the catalog, never modified once built
+    """
+
+    def __init__(self, stamp, favorites_stamp, previous=None):
+        self.stamp = stamp
+        self.favorites_stamp = favorites_stamp
+        self.encoded = 0
+        # Read first, the favorites changed during the load are patched again
+        self.cursor = db.session.scalar(select(func.coalesce(func.max(Change.Id), 0)))
+
+        planet_rows = db.session.execute(
+            select(Planet.Id, Planet.Name, Planet.Climate, Planet.Terrain, Planet.FavoritesCount)
+            .order_by(Planet.Id)).all()
+        planet_names = {row.Id: row.Name for row in planet_rows}
+        residents = grouped(db.session.execute(
+            select(Character.HomeWorldId, Character.Name)
+            .where(Character.HomeWorldId.is_not(None)).order_by(Character.HomeWorldId, Character.Id)))
+        character_fans = fans_of(Character_Favorite, Character_Favorite.CharacterId)
+        planet_fans = fans_of(Planet_Favorite, Planet_Favorite.PlanetId)
+
+        self.characters = {}
+        rows = db.session.execute(
+            select(Character.Id, Character.Name, Character.Height, Character.HairColor, Character.BirthDay,
+                   Character.HomeWorldId, Character.FavoritesCount,
+                   Weight.Weight, Weight.WeightUnit, Weight.WeightKg)
+            .outerjoin(Weight).order_by(Character.Id))
+        for (id, name, height, hair_color, birth_day, home_world_id, favorites_count,
+             weight, weight_unit, weight_kg) in rows:
+            values = (id, name, height, hair_color, birth_day, planet_names.get(home_world_id),
+                      favorites_count, weight, weight_unit, weight_kg, character_fans.get(id, ()))
+            record, encoded = reuse_or_build(CharacterRecord, values, previous and previous.characters)
+            self.characters[id] = record
+            self.encoded += encoded
+
+        self.planets = {}
+        for id, name, climate, terrain, favorites_count in planet_rows:
+            values = (id, name, climate, terrain, residents.get(id, ()), favorites_count, planet_fans.get(id, ()))
+            record, encoded = reuse_or_build(PlanetRecord, values, previous and previous.planets)
+            self.planets[id] = record
+            self.encoded += encoded
+
+        self.join()
+        # Ids of the characters with a weight, lightest first, for the weight filters and sorts
+        self.by_weight = [record.id for record in sorted(
+            (record for record in self.characters.values() if record.weight_kg is not None),
+            key=lambda record: (record.weight_kg, record.id))]
+
+    def join(self):
+        self.characters_json = join(record.json for record in self.characters.values())
+        self.planets_json = join(record.json for record in self.planets.values())
+
+    def patched(self, favorites_stamp):
+        """
+        A new snapshot with the favorites changed since this one, None when there are
+        too many changes and it must be reloaded
+        """
+        changes = db.session.execute(
+            select(Change.Id, Change.Entity, Change.EntityId)
+            .where(Change.Id > self.cursor, Change.Entity.in_(FAVORITE_SOURCES))
+            .order_by(Change.Id).limit(MAX_PATCHED_CHANGES + 1)).all()
+        if len(changes) > MAX_PATCHED_CHANGES:
+            return None
+
+        character_ids, planet_ids, user_ids = set(), set(), set()
+        for change in changes:
+            if change.Entity == "user":
+                user_ids.add(int(change.EntityId))
+            else:
+                # "UserId:TargetId"
+                target_id = int(change.EntityId.split(":")[1])
+                (character_ids if change.Entity == "character_favorite" else planet_ids).add(target_id)
+        if user_ids:
+            # A renamed user is in the favorites of all it favorited
+            character_ids.update(db.session.execute(
+                select(Character_Favorite.CharacterId).where(Character_Favorite.UserId.in_(user_ids))).scalars())
+            planet_ids.update(db.session.execute(
+                select(Planet_Favorite.PlanetId).where(Planet_Favorite.UserId.in_(user_ids))).scalars())
+
+        snapshot = copy.copy(self)
+        snapshot.favorites_stamp = favorites_stamp
+        snapshot.cursor = changes[-1].Id if changes else self.cursor
+        snapshot.encoded = 0
+        snapshot.characters = snapshot.patch(
+            self.characters, CharacterRecord, Character, Character_Favorite.CharacterId, character_ids)
+        snapshot.planets = snapshot.patch(
+            self.planets, PlanetRecord, Planet, Planet_Favorite.PlanetId, planet_ids)
+        if snapshot.encoded:
+            snapshot.join()
+        return snapshot
+
+    def patch(self, records, record_class, model, target_column, ids):
+        """
+        records with the favorites of ids read again, the same dict when none changed
+        """
+        # The others were created after the load, a reload follows
+        ids = [id for id in ids if id in records]
+        if not ids:
+            return records
+        counts = dict(db.session.execute(select(model.Id, model.FavoritesCount).where(model.Id.in_(ids))).all())
+        fans = fans_of(target_column.class_, target_column, target_column.in_(ids))
+        patched, encoded_before = dict(records), self.encoded
+        for id in ids:
+            # A deleted one is dropped by the reload that follows
+            if id in counts:
+                record, encoded = reuse_or_build(
+                    record_class, records[id].with_favorites(counts[id], fans.get(id, ())), records)
+                patched[id] = record
+                self.encoded += encoded
+        return patched if self.encoded > encoded_before else records
+
+    def records(self, kind):
+        return self.characters if kind == "characters" else self.planets
+
+    def get(self, kind, id):
+        record = self.records(kind).get(id)
+        return record.json if record is not None else None
+
+    def batch(self, kind, ids):
+        """
+        Body of a ?ids= batch read, like get_batch() in app.py
+        """
+        records = self.records(kind)
+        found = [records[id].json for id in ids if id in records]
+        missing = encode([id for id in ids if id not in records])
+        return b'{"results":' + join(found) + b',"missing":' + missing + b"}"
+
+    def character_list(self, unit=None, weight_gte=None, weight_lte=None, sort=None):
+        """
+        Body of /characters with its filters (in kg), sort and unit, like get_characters()
+        """
+        if unit is None and weight_gte is None and weight_lte is None and sort is None:
+            return self.characters_json
+        if weight_gte is None and weight_lte is None and sort is None:
+            records = self.characters.values()
+        else:
+            weighed = [self.characters[id] for id in self.by_weight]
+            records = [record for record in weighed
+                       if (weight_gte is None or record.weight_kg >= weight_gte)
+                       and (weight_lte is None or record.weight_kg <= weight_lte)]
+            if sort == "-weight":
+                # Heaviest first, the ids of equal weights still increasing
+                records.sort(key=lambda record: (-record.weight_kg, record.id))
+            if sort and weight_gte is None and weight_lte is None:
+                # Characters without weight go last either way
+                records += [record for record in self.characters.values() if record.weight_kg is None]
+            elif not sort:
+                records.sort(key=lambda record: record.id)
+        if unit is None:
+            return join(record.json for record in records)
+        return join(encode(record.serialize(unit)) for record in records)
+
+
+class Catalog:
+    """
+    The current snapshot of a worker, reloaded when its stamp is outdated
+    """
+
+    def __init__(self):
+        self.snapshot = None
+        self.loads = 0
+        self.patches = 0
+        self._lock = threading.Lock()
+
+    def stamps(self):
+        """
+        (stamp, favorites stamp), None when the generations can't be read
+        """
+        generations = response_cache.generations(SOURCES + FAVORITE_SOURCES)
+        if generations is None:
+            return None
+        return (tuple((entity, generations[entity]) for entity in SOURCES),
+                tuple((entity, generations[entity]) for entity in FAVORITE_SOURCES))
+
+    def current(self):
+        """
+        The up to date snapshot, None when the stamps can't be read
+        """
+        stamps = self.stamps()
+        if stamps is None:
+            return None
+        stamp, favorites_stamp = stamps
+        snapshot = self.snapshot
+        if snapshot is None or (snapshot.stamp, snapshot.favorites_stamp) != stamps:
+            with self._lock:
+                snapshot = self.snapshot
+                if snapshot is not None and snapshot.stamp == stamp and snapshot.favorites_stamp != favorites_stamp:
+                    patched = snapshot.patched(favorites_stamp)
+                    if patched is not None:
+                        snapshot = self.snapshot = patched
+                        self.patches += 1
+                        logger.debug(f"Catalog snapshot patched: {patched.encoded} encoded")
+                if snapshot is None or snapshot.stamp != stamp or snapshot.favorites_stamp != favorites_stamp:
+                    snapshot = Snapshot(stamp, favorites_stamp, snapshot)
+                    self.snapshot = snapshot
+                    self.loads += 1
+                    logger.info(f"Catalog snapshot loaded: {len(snapshot.characters)} characters, "
+                                f"{len(snapshot.planets)} planets, {snapshot.encoded} encoded")
+        return snapshot
+
+    def serialize(self):
+        snapshot = self.snapshot
+        return {
+            "loads": self.loads,
+            "patches": self.patches,
+            "characters": len(snapshot.characters) if snapshot else None,
+            "planets": len(snapshot.planets) if snapshot else None,
+            "bytes": len(snapshot.characters_json) + len(snapshot.planets_json) if snapshot else None,
+        }
+
+
+catalog = Catalog() if SNAPSHOT_ENABLED and response_cache.backend is not None else None
+
+
+def json_response(body, status=200):
+    # Ends with a newline like the responses of jsonify
+    return Response(body + b"\n", status=status, mimetype="application/json")
+
+
+def served_from_snapshot(serve):
+    """
+    Decorator for the GET handlers of the catalog, above cached(): answer with
+    serve(snapshot, *args), unless the snapshot is disabled or serve returns None
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # A profiled request (see profiler.py) must run the handler
+            if catalog is None or g.get("profiling") is not None:
+                return view(*args, **kwargs)
+            snapshot = catalog.current()
+            response = serve(snapshot, *args, **kwargs) if snapshot is not None else None
+            if response is None:
+                return view(*args, **kwargs)
+            return response
+        return wrapper
+    return decorator
+
+
+def get_snapshot_stats():
+    return catalog.serialize() if catalog is not None else None
@@ -0,0 +1,148 @@
+"""
+Connection settings of the SQLite fallback database (no DATABASE_URL), used by the edge
+nodes and the CI load tests.
+
+SQLite's defaults suit a single process: a rollback journal that blocks the readers
+while a transaction commits, an fsync on every commit and a 2MB page cache. Every
+new connection is set up with PRAGMAs instead, from the environment:
+
+- SQLITE_JOURNAL_MODE (wal): readers and the writer don't block each other, and a
+  commit appends to the log instead of rewriting pages. The mode is stored in the file,
+  it's only switched when it differs, so workers starting together don't fight over it.
+- SQLITE_SYNCHRONOUS (normal): in WAL mode, fsync at checkpoints only. A power loss
+  can drop the last commits, it can't corrupt the file.
+- SQLITE_MMAP_SIZE (256MB) and SQLITE_CACHE_SIZE (-64000, so 64MB): reads from the
+  shared page cache of the OS and more pages kept per connection.
+- SQLITE_BUSY_TIMEOUT (10000 ms): SQLite allows one writer at a time. Gunicorn workers
+  writing at the same time wait up to this long for the lock instead of failing with
+  "database is locked". This relies on the sqlite3 module opening the transaction
+  right before the first write (its default), a transaction that read first couldn't
+  wait for the lock.
+- foreign_keys is always on, SQLite only enforces them (and the ON DELETE cascades)
+  when asked to.
+
+SQLITE_TUNING=0 keeps SQLite's defaults, apart from the foreign keys.
+`flask sqlite-benchmark` compares both with concurrent worker processes.
+"""
+import os
+import sqlite3
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+JOURNAL_MODES = {"delete", "truncate", "persist", "memory", "wal", "off"}
+SYNCHRONOUS_MODES = {"off", "normal", "full", "extra"}
+
+# What SQLite does on its own, apart from the foreign keys
+DEFAULT_PRAGMAS = {"foreign_keys": "on"}
+
+
+def pragmas_from_env():
+    journal_mode = os.getenv("SQLITE_JOURNAL_MODE", "wal").lower()
+    synchronous = os.getenv("SQLITE_SYNCHRONOUS", "normal").lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError(f"SQLITE_JOURNAL_MODE must be one of {', '.join(sorted(JOURNAL_MODES))}")
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"SQLITE_SYNCHRONOUS must be one of {', '.join(sorted(SYNCHRONOUS_MODES))}")
+    return {
+        # First, so that switching the journal mode waits for the lock too
+        "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", "10000")),
+        "synchronous": synchronous,
+        "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+        "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-64000")),
+        "foreign_keys": "on",
+        "journal_mode": journal_mode,
+    }
+
+
+PRAGMAS = DEFAULT_PRAGMAS if os.getenv("SQLITE_TUNING") == "0" else pragmas_from_env()
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            if name == "journal_mode":
+                current = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+                if current.lower() == value:
+                    continue
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        apply_pragmas(dbapi_connection, PRAGMAS)
+
+
+def setup_sqlite():
+    event.listen(Engine, "connect", configure_sqlite_connection)
+
+
+def benchmark(pragmas, workers=4, operations=2000, write_ratio=0.2, rows=10000):
+    """
+    Run worker processes mixing reads by id, small range scans and single row write
+    transactions on a new database file set up with pragmas. Returns the totals:
+    operations per second, seconds and the operations that failed on a locked database
+    """
+    import multiprocessing
+    import random
+    import tempfile
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "benchmark.db")
+    connection = sqlite3.connect(path)
+    apply_pragmas(connection, pragmas)
+    connection.execute("CREATE TABLE Characters (Id INTEGER PRIMARY KEY, Name VARCHAR(50), Height INTEGER)")
+    connection.executemany("INSERT INTO Characters (Name, Height) VALUES (?, ?)",
+                           ((f"Character {n}", n % 250) for n in range(rows)))
+    connection.commit()
+    connection.close()
+
+    def worker(results, seed):
+        connection = sqlite3.connect(path)
+        apply_pragmas(connection, pragmas)
+        rng = random.Random(seed)
+        locked = 0
+        start = time.perf_counter()
+        for n in range(operations):
+            try:
+                if rng.random() < write_ratio:
+                    connection.execute("INSERT INTO Characters (Name, Height) VALUES (?, ?)",
+                                       (f"Worker {seed} {n}", n % 250))
+                    connection.execute("UPDATE Characters SET Height = Height + 1 WHERE Id = ?",
+                                       (rng.randint(1, rows),))
+                    connection.commit()
+                elif rng.random() < 0.9:
+                    connection.execute("SELECT * FROM Characters WHERE Id = ?", (rng.randint(1, rows),)).fetchall()
+                else:
+                    low = rng.randint(0, 240)
+                    connection.execute("SELECT count(*) FROM Characters WHERE Height BETWEEN ? AND ?",
+                                       (low, low + 10)).fetchall()
+            except sqlite3.OperationalError:
+                connection.rollback()
+                locked += 1
+        results.put((time.perf_counter() - start, locked))
+        connection.close()
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(results, seed)) for seed in range(workers)]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    totals = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    seconds = time.perf_counter() - start
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    return {
+        "operations": workers * operations,
+        "per_second": round(workers * operations / seconds),
+        "seconds": round(seconds, 2),
+        "locked": sum(total[1] for total in totals),
+    }
@@ -0,0 +1,239 @@
+"""
+Rollup statistics for the dashboards.
+
+Every aggregate is stored as rows of the Stats table, one per counted key, so reading
+a stat never scans the catalog. The write handlers in app.py update the rollups in the
+same transaction as the change, and `flask rebuild-stats` recomputes them from scratch.
+
+The handlers only add their deltas to the session. They are written when the transaction
+commits, after its other writes, one row per key in sorted order: a Stats row is locked
+from its write to the commit only, always after the catalog rows of the transaction and
+before the change log (see changes.py), so concurrent writers can't deadlock on them.
+"""
+import enum
+from sqlalchemy import select, update, insert, delete, event, func
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Stat, Character, Planet, Character_Favorite, Planet_Favorite
+
+CHARACTERS_PER_PLANET = "characters_per_planet"
+HAIR_COLORS = "hair_colors"
+CLIMATES = "climates"
+TERRAINS = "terrains"
+FAVORITES_PER_USER = "favorites_per_user"
+
+# Key used for rows counted under a null value, e.g. characters without a home world
+NONE_KEY = "none"
+
+
+def stat_key(value):
+    """
+    Convert a grouped column value into the string key stored in the rollup
+    """
+    if value is None:
+        return NONE_KEY
+    if isinstance(value, enum.Enum):
+        return value.value
+    return str(value)
+
+
+# Column grouped by each stat counted from a single table
+GROUPED_COLUMNS = {
+    CHARACTERS_PER_PLANET: Character.HomeWorldId,
+    HAIR_COLORS: Character.HairColor,
+    CLIMATES: Planet.Climate,
+    TERRAINS: Planet.Terrain,
+}
+
+STATS = (*GROUPED_COLUMNS, FAVORITES_PER_USER)
+
+
+def grouped_counts(column, *where):
+    """
+    Count the rows per value of a column, e.g. {"black": 3, "blonde": 1}
+    """
+    rows = db.session.execute(
+        select(column, func.count()).where(*where).group_by(column))
+    return {stat_key(value): count for value, count in rows}
+
+
+def favorites_per_user():
+    """
+    Count the character and planet favorites of each user
+    """
+    counts = grouped_counts(Character_Favorite.UserId)
+    for key, count in grouped_counts(Planet_Favorite.UserId).items():
+        counts[key] = counts.get(key, 0) + count
+    return counts
+
+
+def pending(name, factory):
+    """
+    What the transaction keeps for its commit under name
+    """
+    # In a transaction, even without a statement yet, so that its rollback drops it
+    if not db.session().in_transaction():
+        db.session.begin()
+    return db.session.info.setdefault(name, factory())
+
+
+def update_stat(name, key, delta):
+    """
+    Add delta to the counter of a key when the transaction commits
+    """
+    if not delta:
+        return
+    deltas = pending("stat_deltas", dict)
+    deltas[(name, key)] = deltas.get((name, key), 0) + delta
+
+
+def write_stat(name, key, delta):
+    """
+    Add delta to the counter of a key, creating it when missing (upsert)
+    """
+    if not delta:
+        return
+
+    table = Stat.__table__
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect in ("postgresql", "sqlite"):
+        dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        db.session.execute(
+            dialect_insert(table)
+            .values(Name=name, Key=key, Value=delta)
+            .on_conflict_do_update(
+                index_elements=[table.c.Name, table.c.Key],
+                set_={"Value": table.c.Value + delta})
+        )
+        return
+
+    updated = db.session.execute(
+        update(table)
+        .where(table.c.Name == name, table.c.Key == key)
+        .values(Value=table.c.Value + delta)
+    ).rowcount
+    if not updated:
+        db.session.execute(insert(table).values(Name=name, Key=key, Value=delta))
+
+
+def update_stats(name, counts, sign=1):
+    """
+    Apply a dict of per key deltas to a stat
+    """
+    for key, count in counts.items():
+        update_stat(name, key, sign * count)
+
+
+def move_stat(name, old_value, new_value):
+    """
+    Move one unit of a stat from a key to another, used when an entity is updated
+    """
+    old_key, new_key = stat_key(old_value), stat_key(new_value)
+    if old_key != new_key:
+        update_stat(name, old_key, -1)
+        update_stat(name, new_key, 1)
+
+
+def get_stats(*names):
+    """
+    Read the rollups of the given stats (all of them by default) as
+    {"hair_colors": {"black": 3, ...}, ...}
+    """
+    names = names or STATS
+    result = {name: {} for name in names}
+    rows = db.session.execute(
+        select(Stat.Name, Stat.Key, Stat.Value)
+        .where(Stat.Name.in_(names), Stat.Value != 0)
+        .order_by(Stat.Name, Stat.Key)
+    )
+    for name, key, value in rows:
+        result[name][key] = value
+    return result
+
+
+# ----------------------------------------------------------Write hooks
+
+
+def record_characters_deleted(ids):
+    """
+    Subtract the characters about to be deleted, must run before the DELETE
+    """
+    where = (Character.Id.in_(ids),)
+    update_stats(CHARACTERS_PER_PLANET, grouped_counts(Character.HomeWorldId, *where), -1)
+    update_stats(HAIR_COLORS, grouped_counts(Character.HairColor, *where), -1)
+    update_stats(FAVORITES_PER_USER, grouped_counts(
+        Character_Favorite.UserId, Character_Favorite.CharacterId.in_(ids)), -1)
+
+
+def record_planets_deleted(ids):
+    """
+    Subtract the planets about to be deleted, must run before the DELETE.
+    Their residents are left without home world
+    """
+    where = (Planet.Id.in_(ids),)
+    update_stats(CLIMATES, grouped_counts(Planet.Climate, *where), -1)
+    update_stats(TERRAINS, grouped_counts(Planet.Terrain, *where), -1)
+    residents = grouped_counts(Character.HomeWorldId, Character.HomeWorldId.in_(ids))
+    update_stats(CHARACTERS_PER_PLANET, residents, -1)
+    update_stat(CHARACTERS_PER_PLANET, NONE_KEY, sum(residents.values()))
+    update_stats(FAVORITES_PER_USER, grouped_counts(
+        Planet_Favorite.UserId, Planet_Favorite.PlanetId.in_(ids)), -1)
+
+
+def record_users_deleted(ids):
+    """
+    Drop the favorites counters of the deleted users when the transaction commits
+    """
+    pending("stat_deletes", set).update(
+        (FAVORITES_PER_USER, stat_key(id)) for id in ids)
+
+
+@event.listens_for(db.session, "before_commit", insert=True)
+def write_stat_deltas(session):
+    """
+    Write the deltas and deletes of the transaction, after its other writes and before
+    the change log (this listener is inserted first)
+    """
+    session.flush()
+    deltas = session.info.pop("stat_deltas", {})
+    deletes = session.info.pop("stat_deletes", set())
+    for name, key in sorted(set(deltas) | deletes):
+        if (name, key) in deletes:
+            session.execute(
+                delete(Stat).where(Stat.Name == name, Stat.Key == key)
+                .execution_options(synchronize_session=False))
+        else:
+            write_stat(name, key, deltas[(name, key)])
+
+
+@event.listens_for(db.session, "after_commit")
+@event.listens_for(db.session, "after_soft_rollback")
+def forget_stat_deltas(session, previous_transaction=None):
+    session.info.pop("stat_deltas", None)
+    session.info.pop("stat_deletes", None)
+
+
+# ----------------------------------------------------------Full rebuild
+
+
+def rebuild_stats():
+    """
+    Recompute every rollup from the catalog with GROUP BY queries.
+    Runs in the current transaction, the caller commits
+    """
+    # Counted again from the catalog below
+    forget_stat_deltas(db.session)
+    db.session.execute(delete(Stat).execution_options(synchronize_session=False))
+
+    counts = {name: grouped_counts(column)
+              for name, column in GROUPED_COLUMNS.items()}
+    counts[FAVORITES_PER_USER] = favorites_per_user()
+
+    rows = [
+        {"Name": name, "Key": key, "Value": value}
+        for name, values in counts.items()
+        for key, value in values.items()
+    ]
+    if rows:
+        db.session.execute(insert(Stat.__table__), rows)
+    return counts
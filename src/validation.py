@@ -0,0 +1,234 @@
+"""
+Declarative validation of the request bodies.
+
+Each resource has a Schema: a dict of Fields describing the accepted keys. A schema is
+compiled once, at import, into one converter function per key (enum lookups in a dict
+of the values, a precompiled date pattern instead of strptime, the messages already
+formatted), so validating a body is a loop over the keys it contains.
+
+Schema.load() returns the converted values of the keys present in the body, and checks
+every key before failing: the 400 response lists all the errors at once, as
+{"message": "Invalid input", "errors": {"height": "Height must be an integer", ...}}.
+Schema.check() lets a handler add its own errors (a name already taken) first.
+The same schema serves creations (required keys enforced) and updates (partial=True).
+
+`flask validation-benchmark` compares the compiled validators with the if-chains they
+replaced.
+"""
+import datetime
+import re
+from utils import APIException
+from models import HairColorEnum, ClimateEnum, TerrainEnum, WeightUnitEnum
+
+# DD-MM-YYYY, the day and month may have a single digit like strptime('%d-%m-%Y') allows
+DATE_PATTERN = re.compile(r"(\d{1,2})-(\d{1,2})-(\d{4})")
+
+
+class Field:
+    """
+    Description of a body key: its type, whether it's required and its constraints.
+    The label names the key in the error messages
+    """
+
+    def __init__(self, label, kind=str, required=False, choices=None, min_length=None):
+        self.label = label
+        self.kind = kind
+        self.required = required
+        self.choices = choices
+        self.min_length = min_length
+
+    def compile(self):
+        """
+        Build the converter of the field: value -> converted value, or ValueError(message)
+        """
+        label = self.label
+        if self.choices is not None:
+            members = {member.value: member for member in self.choices}
+            message = f"Invalid {label.lower()}"
+
+            def convert(value):
+                member = members.get(value) if isinstance(value, str) else None
+                if member is None:
+                    raise ValueError(message)
+                return member
+        elif self.kind is str:
+            min_length = self.min_length
+            type_message = f"{label} must be a string"
+            length_message = f"{label} must be at least {min_length} characters long"
+
+            def convert(value):
+                if not isinstance(value, str):
+                    raise ValueError(type_message)
+                if min_length is not None and len(value) < min_length:
+                    raise ValueError(length_message)
+                return value
+        elif self.kind is bool:
+            message = f"{label} must be true or false"
+
+            def convert(value):
+                if not isinstance(value, bool):
+                    raise ValueError(message)
+                return value
+        elif self.kind in (int, float):
+            kind = self.kind
+            message = f"{label} must be {'an integer' if kind is int else 'a float'}"
+
+            def convert(value):
+                # bool is an int subclass, but true isn't a number here
+                if isinstance(value, bool):
+                    raise ValueError(message)
+                try:
+                    return kind(value)
+                except (TypeError, ValueError):
+                    raise ValueError(message)
+        elif self.kind is datetime.date:
+            message = f"{label} must be in DD-MM-YYYY format"
+            match = DATE_PATTERN.fullmatch
+
+            def convert(value):
+                parts = match(value) if isinstance(value, str) else None
+                if parts is None:
+                    raise ValueError(message)
+                day, month, year = parts.groups()
+                try:
+                    return datetime.date(int(year), int(month), int(day))
+                except ValueError:
+                    raise ValueError(message)
+        else:
+            raise TypeError(f"Unsupported field type {self.kind}")
+        return convert
+
+
+class Schema:
+    """
+    Compiled set of fields, keyed by the name of the body keys
+    """
+
+    def __init__(self, **fields):
+        self.converters = {key: field.compile() for key, field in fields.items()}
+        self.required = {key: f"{field.label} is required" for key, field in fields.items() if field.required}
+
+    def validate(self, body, partial=False):
+        """
+        Return (values, errors): the converted values of the valid keys and the
+        message of each invalid one
+        """
+        values = {}
+        errors = {}
+        converters = self.converters
+        for key, value in body.items():
+            convert = converters.get(key)
+            if convert is None:
+                continue
+            try:
+                values[key] = convert(value)
+            except ValueError as e:
+                errors[key] = str(e)
+        if not partial:
+            for key, message in self.required.items():
+                if key not in body:
+                    errors[key] = message
+        return values, errors
+
+    def check(self, body, partial=False):
+        """
+        Validate a request body, for handlers adding their own errors (like a name
+        already taken) before calling raise_errors()
+        """
+        if not body or not isinstance(body, dict):
+            raise APIException("No input data provided")
+        return self.validate(body, partial)
+
+    def load(self, body, partial=False):
+        """
+        Validate a request body, raise a 400 with every error when it's invalid
+        """
+        values, errors = self.check(body, partial)
+        raise_errors(errors)
+        return values
+
+
+def raise_errors(errors):
+    """
+    Raise the 400 listing every error, when there is any
+    """
+    if errors:
+        raise APIException("Invalid input", payload={"errors": errors})
+
+
+USER_SCHEMA = Schema(
+    username=Field("Username", required=True),
+    email=Field("Email", required=True),
+    password=Field("Password", required=True, min_length=8),
+    current_password=Field("Current password"),
+    is_active=Field("Is active", kind=bool),
+)
+
+CHARACTER_SCHEMA = Schema(
+    name=Field("Name", required=True),
+    height=Field("Height", kind=int),
+    hair_color=Field("Hair color", choices=HairColorEnum),
+    birth_day=Field("Birth day", kind=datetime.date),
+    home_world_id=Field("Home world id", kind=int),
+    weight=Field("Weight", kind=float),
+    weight_unit=Field("Weight unit", choices=WeightUnitEnum),
+)
+
+PLANET_SCHEMA = Schema(
+    name=Field("Name", required=True),
+    climate=Field("Climate", choices=ClimateEnum),
+    terrain=Field("Terrain", choices=TerrainEnum),
+)
+
+
+def benchmark(iterations=100000):
+    """
+    Time the validation of a character body with the compiled schema and with the
+    if-chain it replaced. Returns microseconds per body for each
+    """
+    import timeit
+
+    body = {"name": "Luke", "height": "172", "hair_color": "blonde", "birth_day": "25-09-1951",
+            "home_world_id": "1", "weight": "77", "weight_unit": "kg"}
+
+    def if_chain():
+        data = dict(body)
+        if 'name' not in data:
+            return "Name is required"
+        if 'hair_color' in data:
+            if data['hair_color'] not in HairColorEnum.get_all():
+                return "Invalid hair color"
+        if 'height' in data:
+            try:
+                data['height'] = int(data['height'])
+            except ValueError:
+                return "Height must be an integer"
+        if 'birth_day' in data:
+            try:
+                data['birth_day'] = datetime.datetime.strptime(data['birth_day'], '%d-%m-%Y').date()
+            except ValueError:
+                return "Birth day must be in DD-MM-YYYY format"
+        if 'home_world_id' in data:
+            try:
+                data['home_world_id'] = int(data['home_world_id'])
+            except ValueError:
+                return "Home world id must be an integer"
+        if 'weight' in data:
+            try:
+                data['weight'] = float(data['weight'])
+            except ValueError:
+                return "Weight must be a float"
+            if 'weight_unit' in data:
+                if data['weight_unit'] not in WeightUnitEnum.get_all():
+                    return "Invalid weight unit"
+        HairColorEnum(data['hair_color'])
+        WeightUnitEnum(data['weight_unit'])
+        return data
+
+    def compiled():
+        return CHARACTER_SCHEMA.validate(body)
+
+    return {
+        "if_chain": timeit.timeit(if_chain, number=iterations) / iterations * 1e6,
+        "compiled": timeit.timeit(compiled, number=iterations) / iterations * 1e6,
+    }
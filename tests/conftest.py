@@ -0,0 +1,31 @@
+"""
+Test setup: the app runs on a throwaway SQLite database, with the response cache
+off unless a test turns it on. Run with `pipenv run test` (or python -m pytest).
+"""
+import os
+import sys
+import tempfile
+import pytest
+
+DATA_DIR = tempfile.mkdtemp(prefix="api-tests-")
+os.environ.setdefault("JWT_SECRET_KEY", "test-secret-of-at-least-32-bytes-for-hs256")
+os.environ["DATABASE_URL"] = f"sqlite:///{DATA_DIR}/test.db"
+os.environ["CACHE_BACKEND"] = "none"
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+
+@pytest.fixture()
+def app():
+    from app import app as flask_app
+    from models import db
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.remove()
+    yield flask_app
+
+
+@pytest.fixture()
+def client(app):
+    return app.test_client()
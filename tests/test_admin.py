@@ -0,0 +1,17 @@
+import pytest
+from models import db, Planet
+
+
+@pytest.mark.parametrize("view", ["user", "character", "weight", "planet", "character_favorite", "planet_favorite"])
+def test_admin_lists_every_model(client, view):
+    assert client.get(f"/admin/{view}/").status_code == 200
+
+
+def test_admin_is_read_only(app, client):
+    client.post("/planets", json={"name": "Hoth", "climate": "polar"})
+
+    client.post("/admin/planet/new/", data={"Name": "Endor", "Climate": "TEMPERATE", "Terrain": "FOREST"})
+    client.post("/admin/planet/delete/", data={"id": "1"})
+
+    with app.app_context():
+        assert [planet.Name for planet in db.session.execute(db.select(Planet)).scalars()] == ["Hoth"]
@@ -0,0 +1,114 @@
+import threading
+import time
+import pytest
+from flask import Flask
+from flask_jwt_extended import create_access_token
+import admission
+import auth
+from models import Planet
+from singleflight import single_flight
+
+
+@pytest.fixture()
+def restore_pools():
+    pools, endpoint_pools = admission.POOLS, admission.ENDPOINT_POOLS
+    yield
+    admission.POOLS, admission.ENDPOINT_POOLS = pools, endpoint_pools
+
+
+def test_pools_and_endpoints_come_from_the_config(restore_pools):
+    app = Flask(__name__)
+    app.config['ADMISSION_POOLS'] = {"heavy": {"max_active": 9}, "changes": {"max_active": 2}}
+    app.config['ADMISSION_ENDPOINTS'] = {"get_changes_since": "changes", "get_user": "exempt"}
+    admission.setup_admission(app)
+
+    assert admission.POOLS['heavy'].max_active == 9
+    assert admission.POOLS['heavy'].max_waiting == admission.DEFAULT_POOLS['heavy']['max_waiting']
+    # A new pool takes the limits of the default one for what it doesn't set
+    assert admission.POOLS['changes'].max_waiting == admission.DEFAULT_POOLS['default']['max_waiting']
+    assert admission.pool_for('get_changes_since') is admission.POOLS['changes']
+    assert admission.pool_for('get_user') is None
+    assert admission.pool_for('get_characters') is admission.POOLS['heavy']
+
+
+def test_pools_come_from_the_environment(restore_pools, monkeypatch):
+    monkeypatch.setenv('ADMISSION_POOLS', '{"priority": {"max_active": 3, "max_wait": "0.5"}}')
+    admission.setup_admission(Flask(__name__))
+
+    assert admission.POOLS['priority'].max_active == 3
+    assert admission.POOLS['priority'].max_wait == 0.5
+
+
+@pytest.mark.parametrize("pools, endpoints", [
+    ({"heavy": {"max_threads": 2}}, None),
+    ({"heavy": {"max_active": 0}}, None),
+    (None, {"get_users": "missing"}),
+])
+def test_invalid_config_fails_at_startup(restore_pools, pools, endpoints):
+    app = Flask(__name__)
+    app.config['ADMISSION_POOLS'] = pools
+    app.config['ADMISSION_ENDPOINTS'] = endpoints
+    with pytest.raises(ValueError):
+        admission.setup_admission(app)
+
+
+@pytest.mark.parametrize("path", ["/admission", "/singleflight", "/cache", "/slow-queries"])
+def test_counters_are_for_admins_only(app, client, monkeypatch, path):
+    monkeypatch.setattr(auth, "ADMIN_USER_IDS", frozenset({"1"}))
+    with app.app_context():
+        admin, user = create_access_token(identity="1"), create_access_token(identity="2")
+
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={"Authorization": f"Bearer {user}"}).status_code == 403
+    assert client.get(path, headers={"Authorization": f"Bearer {admin}"}).status_code == 200
+
+
+@pytest.fixture()
+def tight_pool(monkeypatch):
+    """
+    GET /planets alone in a pool of one slot, without queue
+    """
+    pool = admission.Pool("tight", max_active=1, max_waiting=0, max_wait=0, retry_after=1)
+    monkeypatch.setattr(admission, "POOLS", dict(admission.POOLS, tight=pool))
+    monkeypatch.setattr(admission, "ENDPOINT_POOLS", {"get_planets": "tight"})
+    return pool
+
+
+def test_requests_joining_a_flight_take_no_slot(app, client, tight_pool, monkeypatch):
+    client.post("/planets", json={"name": "Hoth", "climate": "polar"})
+    entered, release = threading.Event(), threading.Event()
+    serialize = Planet.serialize
+
+    def blocking_serialize(self, *args, **kwargs):
+        entered.set()
+        assert release.wait(5)
+        return serialize(self, *args, **kwargs)
+
+    monkeypatch.setattr(Planet, "serialize", blocking_serialize)
+    coalesced = single_flight.coalesced
+    statuses = []
+    threads = [threading.Thread(target=lambda: statuses.append(app.test_client().get("/planets").status_code))
+               for _ in range(2)]
+    threads[0].start()
+    assert entered.wait(5)
+    assert tight_pool.active == 1
+    threads[1].start()
+    while single_flight.coalesced == coalesced:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert statuses == [200, 200]
+    assert tight_pool.shed == 0 and tight_pool.active == 0
+
+
+def test_request_running_the_handler_needs_a_slot(client, tight_pool):
+    assert tight_pool.acquire()
+    try:
+        response = client.get("/planets")
+    finally:
+        tight_pool.release()
+
+    assert response.status_code == 503
+    assert tight_pool.shed == 1
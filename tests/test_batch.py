@@ -0,0 +1,45 @@
+import admission
+import batch
+
+
+def test_sequential_sub_requests_keep_the_admission_slot_of_the_batch(app, client, monkeypatch):
+    monkeypatch.setattr(batch, "BATCH_THREADS", 1)
+    heavy = admission.POOLS['heavy']
+    active = []
+    get_planets = app.view_functions['get_planets']
+
+    def recording_get_planets(*args, **kwargs):
+        active.append(heavy.active)
+        return get_planets(*args, **kwargs)
+
+    monkeypatch.setitem(app.view_functions, 'get_planets', recording_get_planets)
+    response = client.post("/batch", json={"requests": [
+        {"id": "hoth", "method": "POST", "path": "/planets", "body": {"name": "Hoth", "climate": "polar"}},
+        {"id": "first", "method": "GET", "path": "/planets", "depends_on": ["hoth"]},
+        {"id": "tatooine", "method": "POST", "path": "/planets", "body": {"name": "Tatooine", "climate": "arid"},
+         "depends_on": ["first"]},
+        {"id": "second", "method": "GET", "path": "/planets", "depends_on": ["tatooine"]},
+    ]})
+
+    assert response.status_code == 200
+    statuses = [sub["status"] for sub in response.get_json()["responses"]]
+    assert all(status < 400 for status in statuses), statuses
+    # The batch holds its slot of the heavy pool until its own teardown, not one sub-request's
+    assert active == [1, 1]
+    assert heavy.active == 0
+
+
+def test_sub_requests_see_the_writes_before_them(app, client, monkeypatch):
+    monkeypatch.setattr(batch, "BATCH_THREADS", 1)
+    client.post("/planets", json={"name": "Dagobah", "climate": "tropical"})
+    response = client.post("/batch", json={"requests": [
+        {"id": "before", "method": "GET", "path": "/planets"},
+        {"id": "hoth", "method": "POST", "path": "/planets", "body": {"name": "Hoth", "climate": "polar"},
+         "depends_on": ["before"]},
+        {"id": "after", "method": "GET", "path": "/planets", "depends_on": ["hoth"]},
+    ]})
+
+    before, hoth, after = response.get_json()["responses"]
+    assert hoth["status"] == 201
+    assert [planet["name"] for planet in before["body"]] == ["Dagobah"]
+    assert [planet["name"] for planet in after["body"]] == ["Dagobah", "Hoth"]
@@ -0,0 +1,27 @@
+import pytest
+from flask_jwt_extended import create_access_token
+import auth
+
+
+@pytest.mark.parametrize("path", ["/users", "/characters", "/planets"])
+def test_bulk_deletes_are_for_admins_only(app, client, monkeypatch, path):
+    monkeypatch.setattr(auth, "ADMIN_USER_IDS", frozenset({"1"}))
+    with app.app_context():
+        admin, user = create_access_token(identity="1"), create_access_token(identity="2")
+
+    assert client.delete(path, json={"ids": [1]}).status_code == 401
+    assert client.delete(path, json={"ids": [1]}, headers={"Authorization": f"Bearer {user}"}).status_code == 403
+    assert client.delete(path, json={"ids": [1]}, headers={"Authorization": f"Bearer {admin}"}).status_code == 404
+
+
+def test_admin_deletes_planets_in_bulk(app, client, monkeypatch):
+    monkeypatch.setattr(auth, "ADMIN_USER_IDS", frozenset({"1"}))
+    with app.app_context():
+        admin = create_access_token(identity="1")
+    client.post("/planets", json={"name": "Hoth", "climate": "polar"})
+    client.post("/planets", json={"name": "Endor", "climate": "temperate"})
+
+    response = client.delete("/planets", json={"ids": [1, 2, 3]}, headers={"Authorization": f"Bearer {admin}"})
+
+    assert response.status_code == 200
+    assert response.get_json()["deleted"] == 2
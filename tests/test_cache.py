@@ -0,0 +1,28 @@
+import os
+import stat
+import cache
+from cache import SQLiteCache, create_backend
+
+
+def test_caching_is_off_unless_a_backend_is_set(monkeypatch):
+    monkeypatch.delenv("CACHE_BACKEND", raising=False)
+    assert create_backend() is None
+
+
+def test_sqlite_cache_is_private_to_the_user(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache" / "responses.sqlite")
+    monkeypatch.setenv("CACHE_BACKEND", "sqlite")
+    monkeypatch.setenv("CACHE_PATH", path)
+    previous = os.umask(0o022)
+    try:
+        backend = create_backend()
+    finally:
+        os.umask(previous)
+
+    assert isinstance(backend, SQLiteCache)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode) == 0o700
+
+
+def test_default_cache_path_is_not_shared():
+    assert not cache.DEFAULT_CACHE_PATH.startswith("/tmp")
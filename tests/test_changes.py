@@ -0,0 +1,80 @@
+import pytest
+from flask_jwt_extended import create_access_token
+from sqlalchemy import event
+from models import db
+
+
+@pytest.fixture()
+def statements(app):
+    """
+    The write statements run against the database, in order
+    """
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.split()[0].upper() in ("INSERT", "UPDATE", "DELETE"):
+            executed.append(" ".join(statement.split()[:3]).replace('"', ''))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(engine, "before_cursor_execute", record)
+
+
+def user_with_a_favorite(client):
+    client.post("/users", json={"username": "luke", "email": "luke@rebels.org", "password": "x-wing-pilot"})
+    client.post("/characters", json={"name": "Leia", "hair_color": "brown"})
+    with client.application.app_context():
+        token = create_access_token(identity="1")
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_changes_are_written_last_in_the_commit(app, client, statements):
+    headers = user_with_a_favorite(client)
+    statements.clear()
+
+    response = client.post("/users/1/favorites/characters", json={"character_id": 1}, headers=headers)
+
+    assert response.status_code == 201
+    # Catalog rows first, then the rollups, then the change log with its lock
+    assert statements == [
+        "UPDATE Users SET",
+        "INSERT INTO Characters_Favorites",
+        "UPDATE Characters SET",
+        "INSERT INTO Stats",
+        "UPDATE ChangeLock SET",
+        "INSERT INTO Changes",
+    ]
+
+
+def test_deletes_lock_the_catalog_rows_before_the_rollups(app, client, statements, monkeypatch):
+    headers = user_with_a_favorite(client)
+    client.post("/users/1/favorites/characters", json={"character_id": 1}, headers=headers)
+    statements.clear()
+
+    assert client.delete("/characters/1").status_code == 200
+
+    assert statements == [
+        "UPDATE Users SET",
+        "DELETE FROM Characters",
+        "INSERT INTO Stats",
+        "INSERT INTO Stats",
+        "INSERT INTO Stats",
+        "UPDATE ChangeLock SET",
+        "INSERT INTO Changes",
+    ]
+    changes = client.get("/changes").get_json()["changes"]
+    assert [(change["entity"], change["action"]) for change in changes[-2:]] == \
+        [("character", "delete"), ("character_favorite", "delete")]
+
+
+def test_rolled_back_changes_are_not_written(app, client):
+    with app.app_context():
+        from changes import log_change
+        from models import Planet, ChangeActionEnum
+        log_change(Planet, 1, ChangeActionEnum.UPSERT)
+        db.session.rollback()
+        db.session.commit()
+
+    assert client.get("/changes").get_json()["changes"] == []
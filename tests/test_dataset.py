@@ -0,0 +1,35 @@
+import io
+import json
+import pytest
+from sqlalchemy.exc import IntegrityError
+from models import db, Planet
+from dataset import import_dataset, write_checkpoint
+
+
+def ndjson(*records):
+    return io.StringIO("".join(json.dumps(record) + "\n" for record in records))
+
+
+PLANETS = [{"table": "Planets", "row": {"Id": id, "Name": f"Planet {id}", "Climate": "arid", "Terrain": "desert",
+                                        "FavoritesCount": 0}} for id in range(1, 6)]
+
+
+def test_resumed_import_skips_the_batch_committed_before_the_crash(app, tmp_path):
+    checkpoint = tmp_path / "import.checkpoint"
+    with app.app_context():
+        # The first batch of 2 was committed, the checkpoint wasn't written after it
+        import_dataset(ndjson(*PLANETS[:2]), batch_size=2)
+        write_checkpoint(checkpoint, 0)
+
+        import_dataset(ndjson(*PLANETS), str(checkpoint), batch_size=2)
+
+        assert db.session.execute(db.select(db.func.count(Planet.Id))).scalar() == 5
+        assert checkpoint.read_text() == "5"
+
+
+def test_fresh_import_fails_on_existing_ids(app):
+    with app.app_context():
+        import_dataset(ndjson(*PLANETS[:1]))
+        db.session.remove()
+        with pytest.raises(IntegrityError):
+            import_dataset(ndjson(*PLANETS[:1]))
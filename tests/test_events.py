@@ -0,0 +1,108 @@
+from werkzeug.test import EnvironBuilder
+import events
+from events import Broker, ChangePoller, stream_events
+
+
+def event(cursor, entity="character", id="1", action="upsert"):
+    return {"cursor": cursor, "entity": entity, "id": id, "action": action}
+
+
+def test_subscription_filters_by_entity_and_user():
+    broker = Broker()
+    characters = broker.subscribe(entities=["character"])
+    user = broker.subscribe(user_id=2)
+
+    broker.publish(event(1, "character", "7"))
+    broker.publish(event(2, "planet", "3"))
+    broker.publish(event(3, "character_favorite", "2:7"))
+    broker.publish(event(4, "user", "2"))
+    broker.publish(event(5, "planet_favorite", "12:3"))
+
+    assert [e["cursor"] for e in list(characters.queue.queue)] == [1]
+    assert [e["cursor"] for e in list(user.queue.queue)] == [3, 4]
+
+
+def test_broker_refuses_subscribers_above_the_limit():
+    broker = Broker(max_subscribers=1)
+    assert broker.subscribe() is not None
+    assert broker.subscribe() is None
+
+
+def test_full_queue_overflows_the_stream():
+    subscription = events.broker.subscribe()
+    subscription.queue.maxsize = 2
+    for cursor in range(1, 4):
+        events.broker.publish(event(cursor))
+
+    chunks = list(stream_events(subscription))
+    assert chunks[-1].startswith("event: overflow")
+    assert subscription not in events.broker._subscribers
+
+
+def test_stream_skips_live_events_already_replayed():
+    subscription = events.broker.subscribe()
+    events.broker.publish(event(1))
+    events.broker.publish(event(2))
+    stream = stream_events(subscription, replay=[event(1)], heartbeat=0.01)
+
+    assert next(stream).startswith("retry:")
+    assert next(stream).startswith("id: 1\n")
+    assert next(stream).startswith("id: 2\n")
+    stream.close()
+    assert subscription not in events.broker._subscribers
+
+
+def test_stream_closed_before_its_first_chunk_unsubscribes(app, monkeypatch):
+    monkeypatch.setattr("app.ensure_poller", lambda app: True)
+    count = events.broker.subscriber_count
+    environ = EnvironBuilder(path="/events").get_environ()
+
+    # What the server does with a client gone before the first chunk: close the
+    # body without iterating it
+    body = app.wsgi_app(environ, lambda status, headers: None)
+    assert events.broker.subscriber_count == count + 1
+    body.close()
+
+    assert events.broker.subscriber_count == count
+
+
+def test_poller_publishes_the_committed_changes(app, client):
+    client.post("/characters", json={"name": "Before", "hair_color": "black"})
+    broker = Broker()
+    subscription = broker.subscribe()
+    poller = ChangePoller(app, broker, interval=0.01)
+    poller.start()
+    try:
+        assert poller.ready.wait(5)
+        client.post("/characters", json={"name": "After", "hair_color": "black"})
+        client.post("/planets", json={"name": "Hoth", "climate": "polar"})
+
+        received = [subscription.queue.get(timeout=5) for _ in range(2)]
+    finally:
+        poller.stop()
+        poller.join(5)
+
+    # Only what was committed after the poller started, in order
+    assert [(e["entity"], e["id"]) for e in received] == [("character", "2"), ("planet", "1")]
+    assert received[0]["cursor"] < received[1]["cursor"]
+    assert subscription.queue.empty()
+
+
+def test_restarted_poller_goes_on_from_the_last_cursor(app, client, monkeypatch):
+    client.post("/characters", json={"name": "Published", "hair_color": "black"})
+    client.post("/characters", json={"name": "Missed", "hair_color": "black"})
+    # A poller that published the first change, then died
+    dead = ChangePoller(app, events.broker, cursor=1)
+    monkeypatch.setattr(events, "_poller", dead)
+    subscription = events.broker.subscribe()
+    try:
+        assert events.ensure_poller(app)
+        assert events._poller is not dead and events._poller.ready.is_set()
+
+        received = subscription.queue.get(timeout=5)
+    finally:
+        events._poller.stop()
+        events._poller.join(5)
+        events.broker.unsubscribe(subscription)
+
+    assert (received["cursor"], received["id"]) == (2, "2")
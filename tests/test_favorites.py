@@ -0,0 +1,97 @@
+import pytest
+from flask_jwt_extended import create_access_token
+from app import MAX_FAVORITES_PAGE
+from includes import MAX_INCLUDE_ITEMS
+from models import db, Character, Character_Favorite
+
+
+@pytest.fixture()
+def user(app, client):
+    """
+    User 1, with the characters 1, 3 and 4 (of 5) and the planet 2 as favorites
+    """
+    client.post("/users", json={"username": "luke", "email": "luke@rebels.org", "password": "x-wing-pilot"})
+    with app.app_context():
+        token = create_access_token(identity="1")
+    headers = {"Authorization": f"Bearer {token}"}
+    for name in ("Luke", "Leia", "Han", "Chewbacca", "Yoda"):
+        client.post("/characters", json={"name": name})
+    for name in ("Tatooine", "Alderaan"):
+        client.post("/planets", json={"name": name})
+    for character_id in (4, 1, 3):
+        client.post("/users/1/favorites/characters", json={"character_id": character_id}, headers=headers)
+    client.post("/users/1/favorites/planets", json={"planet_id": 2}, headers=headers)
+    return 1
+
+
+def test_pages_follow_the_cursor_until_has_more_is_false(client, user):
+    first = client.get("/users/1/favorites/characters?limit=2").get_json()
+    second = client.get(f"/users/1/favorites/characters?limit=2&after={first['next_cursor']}").get_json()
+
+    assert [character["id"] for character in first["results"]] == [1, 3]
+    assert (first["next_cursor"], first["has_more"]) == (3, True)
+    assert [character["id"] for character in second["results"]] == [4]
+    assert (second["next_cursor"], second["has_more"]) == (4, False)
+
+
+def test_a_page_ending_on_the_last_favorite_has_no_more(client, user):
+    page = client.get("/users/1/favorites/characters?limit=3").get_json()
+
+    assert [character["id"] for character in page["results"]] == [1, 3, 4]
+    assert (page["next_cursor"], page["has_more"]) == (4, False)
+
+
+def test_past_the_last_favorite_the_page_is_empty_and_keeps_the_cursor(client, user):
+    response = client.get("/users/1/favorites/planets?after=2")
+
+    assert response.status_code == 200
+    assert response.get_json() == {"results": [], "next_cursor": 2, "has_more": False}
+
+
+@pytest.mark.parametrize("query", ["limit=0", "limit=-1", f"limit={MAX_FAVORITES_PAGE + 1}", "after=-1"])
+def test_out_of_range_pages_are_rejected(client, user, query):
+    assert client.get(f"/users/1/favorites/characters?{query}").status_code == 400
+
+
+def test_the_largest_page_is_allowed(client, user):
+    assert client.get(f"/users/1/favorites/characters?limit={MAX_FAVORITES_PAGE}").status_code == 200
+
+
+@pytest.mark.parametrize("kind", ["characters", "planets"])
+def test_an_unknown_user_is_not_an_empty_page(client, user, kind):
+    client.post("/users", json={"username": "leia", "email": "leia@rebels.org", "password": "x-wing-pilot"})
+
+    assert client.get(f"/users/2/favorites/{kind}").get_json() == {"results": [], "next_cursor": 0, "has_more": False}
+    assert client.get(f"/users/99/favorites/{kind}").status_code == 404
+    assert client.get(f"/users/99/favorites/{kind}?ids=1").status_code == 404
+    assert client.get(f"/users/2/favorites/{kind}?ids=1").status_code == 200
+
+
+def test_favorited_ids_are_split_in_the_order_asked(client, user):
+    response = client.get("/users/1/favorites/characters?ids=5,4,99,1")
+
+    assert response.get_json() == {"favorited": [4, 1], "not_favorited": [5, 99]}
+
+
+def test_a_user_embeds_capped_favorites_lists(app, client, user):
+    with app.app_context():
+        characters = [Character(Name=f"Clone {number}") for number in range(MAX_INCLUDE_ITEMS)]
+        db.session.add_all(characters)
+        db.session.flush()
+        db.session.add_all(Character_Favorite(UserId=1, CharacterId=character.Id) for character in characters)
+        db.session.commit()
+
+    user = client.get("/users/1").get_json()
+
+    assert [character["id"] for character in user["characters_favorites"]][:4] == [1, 3, 4, 6]
+    assert len(user["characters_favorites"]) == MAX_INCLUDE_ITEMS
+    assert user["planets_favorites"] == [{"id": 2, "name": "Alderaan"}]
+    assert user["favorites_truncated"] == ["characters_favorites"]
+
+
+def test_a_user_with_few_favorites_has_them_all(client, user):
+    user = client.get("/users/1").get_json()
+
+    assert user["characters_favorites"] == [
+        {"id": 1, "name": "Luke"}, {"id": 3, "name": "Han"}, {"id": 4, "name": "Chewbacca"}]
+    assert "favorites_truncated" not in user
@@ -0,0 +1,160 @@
+import datetime
+import hashlib
+import threading
+import pytest
+from sqlalchemy import func, insert, select
+import app as app_module
+import idempotency
+from models import db, Planet
+
+KEY = {"Idempotency-Key": "0b7c9f4e-6f2d-4c61-9a4e-3c1f2d5b8e70"}
+
+
+@pytest.fixture()
+def handler_runs(monkeypatch):
+    """
+    Counts the runs of the handlers, through the commit they all end with
+    """
+    runs = []
+    commit_session = app_module.commit_session
+
+    def counting_commit(error_message):
+        commit_session(error_message)
+        runs.append(error_message)
+    monkeypatch.setattr(app_module, "commit_session", counting_commit)
+    return runs
+
+
+def planet_count(app):
+    with app.app_context():
+        return db.session.scalar(select(func.count()).select_from(Planet))
+
+
+def test_a_retry_gets_the_stored_response(app, client, handler_runs):
+    first = client.post("/planets", json={"name": "Hoth"}, headers=KEY)
+    retry = client.post("/planets", json={"name": "Hoth"}, headers=KEY)
+
+    assert first.status_code == retry.status_code == 201
+    assert retry.data == first.data
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+    assert len(handler_runs) == 1
+    assert planet_count(app) == 1
+
+
+def test_the_same_key_with_another_body_is_rejected(app, client, handler_runs):
+    client.post("/planets", json={"name": "Hoth"}, headers=KEY)
+
+    response = client.post("/planets", json={"name": "Endor"}, headers=KEY)
+
+    assert response.status_code == 422
+    assert len(handler_runs) == 1
+    assert planet_count(app) == 1
+
+
+@pytest.fixture()
+def held_handler(app, monkeypatch):
+    """
+    Starts a request whose handler stays blocked, after its commit, until released
+    """
+    started, release = threading.Event(), threading.Event()
+    commit_session = app_module.commit_session
+
+    def blocking_commit(error_message):
+        commit_session(error_message)
+        started.set()
+        release.wait(10)
+    monkeypatch.setattr(app_module, "commit_session", blocking_commit)
+
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(
+        app.test_client().post("/planets", json={"name": "Hoth"}, headers=KEY)))
+    thread.start()
+    assert started.wait(10)
+    yield release, responses
+    release.set()
+    thread.join(10)
+
+
+def test_a_duplicate_waits_for_the_response_of_the_first_request(app, client, held_handler):
+    release, responses = held_handler
+    duplicates = []
+    thread = threading.Thread(target=lambda: duplicates.append(
+        client.post("/planets", json={"name": "Hoth"}, headers=KEY)))
+    thread.start()
+    # The duplicate polls the key meanwhile
+    thread.join(0.3)
+    assert not duplicates
+
+    release.set()
+    thread.join(10)
+
+    assert duplicates[0].status_code == 201
+    assert duplicates[0].headers["Idempotent-Replayed"] == "true"
+    assert planet_count(app) == 1
+
+
+def test_a_duplicate_gets_a_409_when_the_first_request_takes_too_long(app, client, held_handler, monkeypatch):
+    monkeypatch.setattr(idempotency, "WAIT_TIMEOUT", 0.2)
+
+    response = client.post("/planets", json={"name": "Hoth"}, headers=KEY)
+
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "1"
+    assert planet_count(app) == 1
+
+
+def test_a_key_locked_by_a_dead_request_is_taken_over(app, client, handler_runs):
+    locked_at = datetime.datetime.now() - datetime.timedelta(seconds=idempotency.LOCK_TIMEOUT + 1)
+    with app.app_context():
+        # What a worker killed while running the handler leaves behind
+        with db.engine.begin() as connection:
+            connection.execute(insert(idempotency.KEYS).values(
+                Key=KEY["Idempotency-Key"], UserId="", Endpoint="POST /planets",
+                Fingerprint=hashlib.sha256(b'{"name":"Hoth"}').hexdigest(),
+                LockedAt=locked_at, ExpiresAt=locked_at + datetime.timedelta(days=1)))
+
+    response = client.post("/planets", data='{"name":"Hoth"}', content_type="application/json", headers=KEY)
+
+    assert response.status_code == 201
+    assert "Idempotent-Replayed" not in response.headers
+    assert len(handler_runs) == 1
+
+
+def test_a_recent_lock_is_not_taken_over(app, client, handler_runs, monkeypatch):
+    monkeypatch.setattr(idempotency, "WAIT_TIMEOUT", 0)
+    now = datetime.datetime.now()
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(insert(idempotency.KEYS).values(
+                Key=KEY["Idempotency-Key"], UserId="", Endpoint="POST /planets",
+                Fingerprint=hashlib.sha256(b'{"name":"Hoth"}').hexdigest(),
+                LockedAt=now, ExpiresAt=now + datetime.timedelta(days=1)))
+
+    response = client.post("/planets", data='{"name":"Hoth"}', content_type="application/json", headers=KEY)
+
+    assert response.status_code == 409
+    assert not handler_runs
+
+
+def test_a_server_error_releases_the_key(app, client, monkeypatch):
+    commit_session = app_module.commit_session
+    failures = [app_module.APIException("Error creating planet", status_code=500)]
+
+    def failing_commit(error_message):
+        if failures:
+            db.session.rollback()
+            raise failures.pop()
+        commit_session(error_message)
+    monkeypatch.setattr(app_module, "commit_session", failing_commit)
+
+    failed = client.post("/planets", json={"name": "Hoth"}, headers=KEY)
+    with app.app_context():
+        with db.engine.connect() as connection:
+            assert connection.execute(select(idempotency.KEYS)).first() is None
+    retry = client.post("/planets", json={"name": "Hoth"}, headers=KEY)
+
+    assert failed.status_code == 500
+    assert retry.status_code == 201
+    assert "Idempotent-Replayed" not in retry.headers
+    assert planet_count(app) == 1
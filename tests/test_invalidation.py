@@ -0,0 +1,141 @@
+import json
+import socket
+import time
+import types
+import pytest
+import invalidation
+from cache import ENTITIES
+from invalidation import InvalidationBus, LoopbackBus, PostgresBus
+
+
+def collecting(bus):
+    received = []
+    bus.subscribe(received.append)
+    return received
+
+
+def message(node, seq, entities=("character",)):
+    return {"node": node, "seq": seq, "entities": list(entities)}
+
+
+def test_bus_without_send_cannot_be_created():
+    with pytest.raises(TypeError):
+        InvalidationBus()
+
+
+def test_loopback_delivers_to_the_other_nodes_only():
+    network = []
+    first, second, third = LoopbackBus(network), LoopbackBus(network), LoopbackBus(network)
+    received = [collecting(bus) for bus in (first, second, third)]
+
+    first.publish({"planet", "character"})
+
+    assert received == [[], [["character", "planet"]], [["character", "planet"]]]
+    assert first.published == 1 and second.received == 1 and third.received == 1
+
+
+def test_gap_in_the_sequence_of_a_node_flushes():
+    bus = LoopbackBus()
+    received = collecting(bus)
+
+    bus.receive(message("other", 4))
+    bus.receive(message("other", 5, ["planet"]))
+    bus.receive(message("other", 7, ["user"]))
+    bus.receive(message("other", 8, ["user"]))
+
+    assert received == [["character"], ["planet"], ENTITIES, ["user"]]
+    assert bus.gaps == 1 and bus.flushes == 1
+
+
+def test_failed_send_shows_up_as_a_gap():
+    network = []
+    sender, receiver = LoopbackBus(network), LoopbackBus(network)
+    received = collecting(receiver)
+    sender.publish({"character"})
+    network.remove(receiver)
+    sender.publish({"planet"})
+    network.append(receiver)
+    sender.publish({"user"})
+
+    assert received == [["character"], ENTITIES]
+    assert receiver.gaps == 1
+
+
+class FakeConnection:
+    """
+    Enough of a psycopg2 connection for the listener, readable through a socket pair
+    """
+
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.closed = False
+        self.notifies = []
+        self._reader, self._writer = socket.socketpair()
+
+    def fileno(self):
+        return self._reader.fileno()
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def poll(self):
+        self._reader.setblocking(False)
+        try:
+            self._reader.recv(1024)
+        except BlockingIOError:
+            pass
+
+    def notify(self, message):
+        self.notifies.append(types.SimpleNamespace(payload=json.dumps(message)))
+        self._writer.send(b"!")
+
+    def close(self):
+        self.closed = True
+        self._reader.close()
+        self._writer.close()
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, statement, *args):
+        if statement == "SELECT 1" and not self.connection.alive:
+            raise OSError("server closed the connection")
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_listener_flushes_on_a_gap_only_not_when_connecting(monkeypatch):
+    monkeypatch.setattr(invalidation, "LISTEN_TIMEOUT", 0.01)
+    monkeypatch.setattr(invalidation, "RECONNECT_DELAY", 0.01)
+    dropped, current = FakeConnection(alive=False), FakeConnection()
+    connections = [dropped, current]
+    bus = PostgresBus("postgresql://unused")
+    monkeypatch.setattr(bus, "_connect", lambda: connections.pop(0))
+    received = collecting(bus)
+    bus.start()
+
+    # The first connection dies, the listener reconnects without flushing
+    wait_for(lambda: not connections)
+    assert dropped.closed and bus.reconnects == 1 and bus.flushes == 0
+
+    current.notify(message("other", 1))
+    wait_for(lambda: bus.received == 1)
+    # Sequence number 2 was sent while this listener wasn't there
+    current.notify(message("other", 3, ["planet"]))
+    wait_for(lambda: bus.received == 2)
+
+    assert received == [["character"], ENTITIES]
+    assert bus.gaps == 1 and bus.flushes == 1
@@ -0,0 +1,40 @@
+import datetime
+import pytest
+from models import db, Job, JobStatusEnum
+from jobs import JobCancelled, JobContext, JobLost, requeue_stale
+
+
+def running_job(worker_id="worker-1", **values):
+    now = datetime.datetime.now()
+    values = dict(dict(Kind="rebuild-stats", Params={}, Status=JobStatusEnum.RUNNING, WorkerId=worker_id,
+                       Attempts=1, RunAfter=now, HeartbeatAt=now), **values)
+    job = Job(**values)
+    db.session.add(job)
+    db.session.commit()
+    return job.Id
+
+
+def test_progress_is_saved_for_the_worker_holding_the_job(app):
+    with app.app_context():
+        job_id = running_job()
+        JobContext(job_id, "worker-1").progress(3, 10)
+        job = db.session.get(Job, job_id, populate_existing=True)
+        assert (job.Progress, job.Total) == (3, 10)
+
+
+def test_progress_raises_when_cancel_was_requested(app):
+    with app.app_context():
+        job_id = running_job(CancelRequested=True)
+        with pytest.raises(JobCancelled):
+            JobContext(job_id, "worker-1").progress(1)
+
+
+def test_stale_worker_is_stopped_by_its_next_progress(app):
+    with app.app_context():
+        job_id = running_job(HeartbeatAt=datetime.datetime.now() - datetime.timedelta(hours=1))
+        assert requeue_stale() == 1
+
+        with pytest.raises(JobLost):
+            JobContext(job_id, "worker-1").progress(5)
+        job = db.session.get(Job, job_id, populate_existing=True)
+        assert job.Status == JobStatusEnum.QUEUED and job.Progress == 0
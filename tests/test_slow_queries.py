@@ -0,0 +1,75 @@
+import pytest
+from flask_jwt_extended import create_access_token
+import auth
+import slow_queries
+from slow_queries import QueryLog, explain, redact
+
+
+def test_redact_hides_the_values_of_secret_columns():
+    assert redact("UPDATE Users SET Password=? WHERE Id=?", ("hash", 1)) == "***"
+    assert redact("SELECT Users.Password FROM Users WHERE Id=?", (1,)) == (1,)
+    assert redact("SELECT Users.Id\nFROM Users WHERE Token=?", ("abc",)) == "***"
+    assert redact("INSERT INTO Users (Email) VALUES (:email)", {"email": "e", "password": "p"}) == \
+        {"email": "e", "password": "***"}
+
+
+def test_redact_select_without_from():
+    assert redact("SELECT crypt(?, gen_salt('bf')) AS password", ("secret",)) == "***"
+    assert redact("SELECT 1", ()) == ()
+
+
+def test_statements_are_normalized_only_when_tracked(monkeypatch):
+    calls = []
+    monkeypatch.setattr(slow_queries, "normalize", lambda statement: calls.append(statement) or statement)
+
+    untracked = QueryLog(threshold_ms=100, explain=False, track_statements=False)
+    untracked.record(None, "SELECT 1", (), 5, False)
+    assert calls == [] and untracked.top(10) == []
+
+    untracked.record(None, "SELECT 2", (), 150, False)
+    assert calls == ["SELECT 2"] and len(untracked.recent) == 1
+
+    tracked = QueryLog(threshold_ms=100, explain=False, track_statements=True)
+    tracked.record(None, "SELECT 1", (), 5, False)
+    assert [totals["count"] for totals in tracked.top(10)] == [1]
+
+
+class FailingCursor:
+    def __init__(self, failing):
+        self.failing = failing
+        self.executed = []
+
+    def execute(self, statement, parameters=None):
+        self.executed.append(statement.split()[0])
+        if statement.startswith(self.failing):
+            raise RuntimeError(f"{self.failing} failed")
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.dialect = type("Dialect", (), {"name": "postgresql"})()
+        self.connection = type("DBAPIConnection", (), {"cursor": lambda _: cursor})()
+
+
+def test_explain_rolls_back_only_a_savepoint_it_created():
+    cursor = FailingCursor("SAVEPOINT")
+    assert explain(FakeConnection(cursor), "SELECT 1", ()) is None
+    assert cursor.executed == ["SAVEPOINT"]
+
+    cursor = FailingCursor("EXPLAIN")
+    assert explain(FakeConnection(cursor), "SELECT 1", ()) is None
+    assert cursor.executed == ["SAVEPOINT", "EXPLAIN", "ROLLBACK"]
+
+
+@pytest.mark.parametrize("limit, status", [("-5", 400), ("0", 400), ("1001", 400), ("1", 200)])
+def test_slow_queries_limit_is_checked(app, client, monkeypatch, limit, status):
+    monkeypatch.setattr(auth, "ADMIN_USER_IDS", frozenset({"1"}))
+    with app.app_context():
+        admin = create_access_token(identity="1")
+
+    response = client.get(f"/slow-queries?limit={limit}", headers={"Authorization": f"Bearer {admin}"})
+
+    assert response.status_code == status
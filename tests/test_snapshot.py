@@ -0,0 +1,111 @@
+import pytest
+from flask_jwt_extended import create_access_token
+import snapshot
+from cache import MemoryCache, response_cache
+
+URLS = [
+    "/characters",
+    "/characters?unit=lb",
+    "/characters?unit=oz",
+    "/characters?weight_gte=70",
+    "/characters?weight_lte=100&unit=lb",
+    "/characters?weight_gte=50&weight_lte=90",
+    "/characters?sort=weight",
+    "/characters?sort=-weight",
+    "/characters?sort=-weight&unit=lb",
+    "/characters?sort=-weight&weight_gte=60",
+    "/characters?weight_gte=500",
+    "/characters?ids=3,1,99",
+    "/characters/1",
+    "/characters/4",
+    "/characters/99",
+    "/planets",
+    "/planets?ids=2,1,99",
+    "/planets/1",
+    "/planets/99",
+]
+
+
+@pytest.fixture()
+def catalog(app, monkeypatch):
+    monkeypatch.setattr(response_cache, "backend", MemoryCache())
+    monkeypatch.setattr(snapshot, "catalog", snapshot.Catalog())
+    return snapshot.catalog
+
+
+def from_handler(client, monkeypatch, url):
+    with monkeypatch.context() as patch:
+        patch.setattr(snapshot, "catalog", None)
+        patch.setattr(response_cache, "backend", None)
+        return client.get(url)
+
+
+def assert_same_responses(client, monkeypatch):
+    for url in URLS:
+        served, handled = client.get(url), from_handler(client, monkeypatch, url)
+        assert (served.status_code, served.mimetype, served.data) == \
+            (handled.status_code, handled.mimetype, handled.data), url
+
+
+@pytest.fixture()
+def favorites(app, client):
+    """
+    Adds favorites, as users 1 and 2
+    """
+    for username in ("luke", "leia"):
+        client.post("/users", json={"username": username, "email": f"{username}@rebels.org",
+                                    "password": "x-wing-pilot"})
+    with app.app_context():
+        tokens = {user_id: create_access_token(identity=str(user_id)) for user_id in (1, 2)}
+
+    def add(user_id, kind, target_id):
+        response = client.post(f"/users/{user_id}/favorites/{kind}", json={f"{kind[:-1]}_id": target_id},
+                               headers={"Authorization": f"Bearer {tokens[user_id]}"})
+        assert response.status_code == 201
+    return add
+
+
+@pytest.fixture()
+def galaxy(client, favorites):
+    client.post("/planets", json={"name": "Tatooine", "climate": "arid"})
+    client.post("/planets", json={"name": "Alderaan", "climate": "temperate"})
+    client.post("/characters", json={"name": "Luke", "home_world_id": 1, "weight": 77, "weight_unit": "kg"})
+    client.post("/characters", json={"name": "Leia", "home_world_id": 2, "weight": 108, "weight_unit": "lb"})
+    client.post("/characters", json={"name": "Chewbacca", "weight": 112, "weight_unit": "kg"})
+    client.post("/characters", json={"name": "R2-D2"})
+    client.post("/characters", json={"name": "Yoda", "weight": 17, "weight_unit": "kg"})
+    favorites(1, "characters", 1)
+    favorites(2, "characters", 1)
+    favorites(2, "planets", 2)
+
+
+def test_snapshot_responses_are_the_handler_responses(client, monkeypatch, catalog, galaxy):
+    assert_same_responses(client, monkeypatch)
+    assert catalog.loads == 1
+
+
+def test_an_empty_catalog_is_served_like_the_handlers(client, monkeypatch, catalog):
+    assert_same_responses(client, monkeypatch)
+
+
+def test_favorites_patch_the_snapshot_instead_of_reloading_it(client, monkeypatch, catalog, galaxy, favorites):
+    client.get("/characters")
+
+    favorites(1, "characters", 3)
+    favorites(1, "planets", 2)
+    assert_same_responses(client, monkeypatch)
+    # A renamed user shows in the favorites of all it favorited
+    client.put("/users/2", json={"username": "organa"})
+    assert_same_responses(client, monkeypatch)
+
+    assert (catalog.loads, catalog.patches) == (1, 2)
+    assert catalog.snapshot.encoded == 2
+
+
+def test_catalog_changes_reload_the_snapshot(client, monkeypatch, catalog, galaxy):
+    client.get("/characters")
+
+    client.put("/characters/4", json={"weight": 32, "weight_unit": "kg"})
+
+    assert_same_responses(client, monkeypatch)
+    assert catalog.loads == 2